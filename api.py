@@ -0,0 +1,226 @@
+"""Versioned JSON API, mounted at /api/v1.
+
+The mobile app and partner sites used to scrape the html pages. The API
+serves the same control.py queries as JSON:
+
+    GET /api/v1/rescues                      every rescue
+    GET /api/v1/rescues/<id>                 one rescue
+    GET /api/v1/rescues/<id>/animals         its available animals
+    GET /api/v1/animals/<id>                 one animal
+
+Lists take cursor (from the previous page's next_cursor) and limit (up to
+MAX_LIMIT) and answer {"data": [...], "next_cursor": ...}. They select plain
+columns only and are streamed: rows are read from the database (a server
+side cursor on PostgreSQL) and written out as JSON one at a time, so a page
+of thousands of animals is never held in memory as objects or as a string.
+
+Responses are compressed with brotli (when the brotli package is installed)
+or gzip, whichever the client's Accept-Encoding prefers.
+"""
+
+import json
+import zlib
+from flask import Blueprint, abort, current_app, jsonify, request, stream_with_context
+import control as c
+import images
+import lookups
+import model as m
+import pagination
+import replicas
+import storage
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 1000
+
+# rows fetched from the database at a time while streaming
+FETCH_SIZE = 500
+
+# smaller bodies aren't worth compressing
+MIN_COMPRESS_SIZE = 500
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+_encoder = json.JSONEncoder(separators=(',', ':'))
+
+
+def _image(img_url, img_variants):
+    """ URLs of a photo and its resized variants """
+
+    variants = images.load_variants(img_variants)
+    for variant in variants.values():
+        for fmt, pil_format, extension, options in images.FORMATS:
+            variant[fmt] = storage.url(variant[fmt])
+
+    return {'url': storage.url(img_url), 'variants': variants}
+
+
+def _rescue(rescue):
+    return {'rescue_id': rescue.rescue_id,
+            'name': rescue.name,
+            'phone': rescue.phone,
+            'address': rescue.address,
+            'email': rescue.email,
+            'latitude': rescue.latitude,
+            'longitude': rescue.longitude,
+            'image': _image(rescue.img_url, rescue.img_variants)}
+
+
+def _animal(animal):
+    return {'animal_id': animal.animal_id,
+            'rescue_id': animal.rescue_id,
+            'name': animal.name,
+            'gender': lookups.get_label('gender', animal.gender_id),
+            'age': lookups.get_label('age', animal.age_id),
+            'size': lookups.get_label('size', animal.size_id),
+            'breed': lookups.get_label('breed', animal.breed_id),
+            'image': _image(animal.img_url, animal.img_variants)}
+
+
+def _stream_page(query, column, after, limit, serialize):
+    """ Generate one page of a query as JSON text, row by row
+    Inputs: SQLAlchemy query, unique column to seek on, last key(int) of the
+    previous page or None, page size(int), function making a row JSON-ready
+    Output: generator of strings
+    """
+
+    if after is not None:
+        query = query.filter(column > after)
+    # one extra row tells whether there is a next page
+    rows = query.order_by(column).limit(limit + 1).execution_options(
+        stream_results=True).yield_per(FETCH_SIZE)
+
+    yield '{"data":['
+    count = 0
+    last_key = None
+    more = False
+    # the query runs here, after the view has returned
+    with replicas.reading():
+        for row in rows:
+            if count == limit:
+                more = True
+                break
+            yield (',' if count else '') + _encoder.encode(serialize(row))
+            last_key = getattr(row, column.key)
+            count += 1
+
+    next_cursor = pagination.encode_cursor(last_key) if more else None
+    yield '],"next_cursor":%s}' % _encoder.encode(next_cursor)
+
+
+def _page_response(query, column, serialize):
+    """ Streamed response of the page of query the request asks for """
+
+    try:
+        after = pagination.decode_cursor(request.args.get('cursor'))
+    except pagination.InvalidCursor:
+        abort(400)
+    limit = request.args.get('limit', DEFAULT_LIMIT, type=int)
+    if not 1 <= limit <= MAX_LIMIT:
+        abort(400)
+
+    # the request context (and its database session) lives until the last
+    # row is sent
+    body = stream_with_context(_stream_page(query, column, after, limit, serialize))
+    return current_app.response_class(body, mimetype='application/json')
+
+
+@api.route('/rescues')
+def rescues():
+    """ Every rescue """
+
+    return _page_response(c.get_rescues_query(), m.Rescue.rescue_id, _rescue)
+
+
+@api.route('/rescues/<int:rescue_id>')
+def rescue(rescue_id):
+    """ One rescue """
+
+    rescue = c.get_rescue(rescue_id)
+    if rescue is None:
+        abort(404)
+
+    return jsonify(_rescue(rescue))
+
+
+@api.route('/rescues/<int:rescue_id>/animals')
+def rescue_animals(rescue_id):
+    """ A rescue's animals that are available for adoption """
+
+    if c.get_rescue(rescue_id) is None:
+        abort(404)
+
+    return _page_response(c.get_available_animals_query(rescue_id, profile='api'),
+                          m.Animal.animal_id, _animal)
+
+
+@api.route('/animals/<int:animal_id>')
+def animal(animal_id):
+    """ One animal, with the bio """
+
+    animal = c.get_animal(animal_id)
+    if animal is None:
+        abort(404)
+
+    details = _animal(animal)
+    details['bio'] = animal.bio
+
+    return jsonify(details)
+
+
+@api.errorhandler(400)
+@api.errorhandler(404)
+def error(e):
+    """ Errors as JSON too """
+
+    response = jsonify(error=e.name)
+    response.status_code = e.code
+    return response
+
+
+def _compress_stream(chunks, process, finish):
+    for chunk in chunks:
+        data = process(chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+@api.after_request
+def compress(response):
+    """ Compress a response with the best encoding the client accepts """
+
+    if (response.status_code != 200 or 'Content-Encoding' in response.headers
+            or response.mimetype != 'application/json'):
+        return response
+    response.vary.add('Accept-Encoding')
+
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    encoding = request.accept_encodings.best_match(offered)
+    if encoding is None:
+        return response
+
+    if not response.is_streamed and len(response.get_data()) < MIN_COMPRESS_SIZE:
+        return response
+
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        process, finish = compressor.process, compressor.finish
+    else:
+        # 16 + MAX_WBITS writes the gzip header and trailer
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        process, finish = compressor.compress, compressor.flush
+
+    response.response = _compress_stream(response.iter_encoded(), process, finish)
+    response.headers.pop('Content-Length', None)
+    response.headers['Content-Encoding'] = encoding
+
+    return response
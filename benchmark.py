@@ -0,0 +1,269 @@
+"""HTTP load benchmark for the public routes.
+
+Serves server.app on a local port against the database given with --db,
+optionally (re)loading it first from generated seed files, then drives each
+route with concurrent workers and reports throughput, latency percentiles
+and, from instrumentation.py, SQL queries and DB/render time per request.
+The page and fragment cache (cache.py) is off unless --page-cache is given,
+so the numbers are those of pages actually rendered; --page-cache memory
+measures cache hits instead. Results are written as JSON so runs on
+different commits can be compared:
+
+    python generate_seed.py --out /tmp/big --rescues 500 --animals 500000
+    python benchmark.py --db postgresql:///bench --load /tmp/big --out before.json
+    ... change things ...
+    python benchmark.py --db postgresql:///bench --out after.json --compare before.json
+"""
+
+import argparse
+import json
+import random
+import subprocess
+import threading
+import time
+import urllib2
+from sqlalchemy import func
+from werkzeug.serving import make_server, WSGIRequestHandler
+from model import connect_to_db, db
+import cache
+import instrumentation
+import model as m
+import pagination
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """ Doesn't log every request, the benchmark sends thousands """
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def percentile(sorted_values, fraction):
+    """ Nearest-rank percentile of an already sorted list """
+
+    if not sorted_values:
+        return None
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def build_routes(rng, samples, depth):
+    """ Pick the URLs to request for each route from the loaded data
+    Inputs: random.Random, number of URLs per route(int), how many pages deep
+    the infinite scroll requests start(int)
+    Output: dictionary of route name -> list of URLs
+    """
+
+    # the biggest rescue is the one whose pages get slow first
+    biggest_rescue_id, biggest_count = m.db.session.query(
+        m.Animal.rescue_id, func.count(m.Animal.animal_id)).filter(
+        m.ANIMAL_IS_AVAILABLE).group_by(m.Animal.rescue_id).order_by(
+        func.count(m.Animal.animal_id).desc()).first()
+    rescue_ids = [rescue_id for rescue_id, in m.db.session.query(m.Rescue.rescue_id)]
+    max_animal_id = m.db.session.query(func.max(m.Animal.animal_id)).scalar()
+
+    # cursor that starts the infinite scroll `depth` pages into the rescue
+    deep_id = m.db.session.query(m.Animal.animal_id).filter(
+        m.Animal.rescue_id == biggest_rescue_id, m.ANIMAL_IS_AVAILABLE).order_by(
+        m.Animal.animal_id).offset(min(depth * pagination.PAGE_SIZE,
+                                       biggest_count - 1)).limit(1).scalar()
+    deep_cursor = pagination.encode_cursor(deep_id)
+
+    animal_rows = []
+    for _ in xrange(samples):
+        animal = m.db.session.query(m.Animal.animal_id, m.Animal.rescue_id).filter(
+            m.Animal.animal_id >= rng.randint(1, max_animal_id)).order_by(
+            m.Animal.animal_id).first()
+        animal_rows.append(animal)
+    m.db.session.remove()
+
+    return {
+        'homepage': ['/'] * samples,
+        'rescue': ['/rescue/%d' % rng.choice(rescue_ids) for _ in xrange(samples)],
+        'rescue_biggest': ['/rescue/%d' % biggest_rescue_id] * samples,
+        'animal': ['/rescue/%d/animal/%d' % (rescue_id, animal_id)
+                   for animal_id, rescue_id in animal_rows],
+        'handle_loading_deep': ['/handle-loading?rescueid=%d&cursor=%s' % (
+            biggest_rescue_id, deep_cursor)] * samples,
+    }
+
+
+def drive(base_url, urls, workers):
+    """ Request every URL once, spread over a number of worker threads
+    Output: (list of latencies in seconds, number of errors, wall seconds)
+    """
+
+    pending = list(urls)
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                url = pending.pop()
+            started = time.time()
+            try:
+                urllib2.urlopen(base_url + url).read()
+            except Exception:
+                with lock:
+                    errors[0] += 1
+                continue
+            elapsed = time.time() - started
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=worker) for _ in xrange(workers)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return latencies, errors[0], time.time() - started
+
+
+def server_totals(stats):
+    """ Add up instrumentation's per-route counters """
+
+    totals = {'requests': 0, 'db_queries': 0, 'db_time': 0.0,
+              'render_time': 0.0, 'slow_queries': 0, 'max_db_queries': 0}
+    for route_stats in stats.values():
+        for key in totals:
+            if key == 'max_db_queries':
+                totals[key] = max(totals[key], route_stats[key])
+            else:
+                totals[key] += route_stats[key]
+
+    return totals
+
+
+def run(app, routes, workers, warmup):
+    """ Serve the app on a local port and benchmark each route in turn
+    Output: dictionary of route name -> results
+    """
+
+    server = make_server('127.0.0.1', 0, app, threaded=True,
+                         request_handler=QuietRequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base_url = 'http://127.0.0.1:%d' % server.server_port
+
+    results = {}
+    try:
+        for name, urls in sorted(routes.items()):
+            drive(base_url, urls[:warmup], workers)
+
+            # one route runs at a time, so the server side totals of the run
+            # all belong to this route
+            instrumentation.reset()
+            latencies, errors, wall = drive(base_url, urls, workers)
+            totals = server_totals(instrumentation.snapshot())
+
+            latencies.sort()
+            done = len(latencies)
+            served = float(totals['requests'] or 1)
+            results[name] = {
+                'requests': done,
+                'errors': errors,
+                'requests_per_sec': round(done / wall, 1) if wall else None,
+                'mean_ms': round(1000 * sum(latencies) / done, 2) if done else None,
+                'p50_ms': round(1000 * percentile(latencies, 0.50), 2) if done else None,
+                'p90_ms': round(1000 * percentile(latencies, 0.90), 2) if done else None,
+                'p99_ms': round(1000 * percentile(latencies, 0.99), 2) if done else None,
+                'max_ms': round(1000 * latencies[-1], 2) if done else None,
+                'queries_per_request': round(totals['db_queries'] / served, 2),
+                'max_queries_per_request': totals['max_db_queries'],
+                'db_ms_per_request': round(1000 * totals['db_time'] / served, 2),
+                'render_ms_per_request': round(1000 * totals['render_time'] / served, 2),
+                'slow_queries': totals['slow_queries'],
+            }
+    finally:
+        server.shutdown()
+
+    return results
+
+
+def current_commit():
+    """ Git commit being benchmarked, or None outside a checkout """
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """ Print each route's change against an earlier results file """
+
+    print "%-22s %14s %14s %14s" % ('route', 'req/s', 'p99 ms', 'queries/req')
+    for name, result in sorted(results['routes'].items()):
+        before = baseline['routes'].get(name)
+        if before is None:
+            continue
+        cells = []
+        for key in ('requests_per_sec', 'p99_ms', 'queries_per_request'):
+            if before[key] and result[key] is not None:
+                cells.append('%+.1f%%' % (100.0 * (result[key] - before[key]) / before[key]))
+            else:
+                cells.append('n/a')
+        print "%-22s %14s %14s %14s" % tuple([name] + cells)
+
+
+if __name__ == "__main__":
+    from server import app
+    import seed
+
+    parser = argparse.ArgumentParser(description='Benchmark the public routes')
+    parser.add_argument('--db', default='postgresql:///benchmark')
+    parser.add_argument('--load', metavar='DATA_DIR',
+                        help='drop, recreate and fast-seed the database from DATA_DIR first')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests per route')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--warmup', type=int, default=20,
+                        help='requests per route sent before measuring')
+    parser.add_argument('--depth', type=int, default=500,
+                        help='pages into the biggest rescue the scroll requests start')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--page-cache', choices=['none', 'memory', 'redis'], default='none',
+                        help="the app's RESPONSE_CACHE for the run")
+    parser.add_argument('--out', help='write the results as JSON to this file')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='results file of an earlier run to compare against')
+    args = parser.parse_args()
+
+    connect_to_db(app, args.db)
+    app.config['RESPONSE_CACHE'] = args.page_cache
+    cache.init_app(app)
+
+    if args.load:
+        db.drop_all()
+        db.create_all()
+        seed.fast_load_all(args.load)
+
+    rng = random.Random(args.seed)
+    results = {
+        'commit': current_commit(),
+        'database': db.get_engine(app).dialect.name,
+        'animals': m.db.session.query(func.count(m.Animal.animal_id)).scalar(),
+        'rescues': m.db.session.query(func.count(m.Rescue.rescue_id)).scalar(),
+        'workers': args.workers,
+        'page_cache': args.page_cache,
+        'routes': run(app, build_routes(rng, args.requests, args.depth),
+                      args.workers, args.warmup),
+    }
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as out:
+            out.write(output + '\n')
+    else:
+        print output
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline))
@@ -0,0 +1,192 @@
+"""Server-side cache of rendered public pages.
+
+The homepage and rescue pages only change when an admin adds an animal or a
+rescue, yet every anonymous visit used to query the database and render the
+template again. Rendered html is kept in a pluggable backend under one key
+per page, and control.py deletes exactly the keys a write makes stale.
+
+Backends (RESPONSE_CACHE config):
+    'memory' - per-process LRU with a TTL (default). Writes only invalidate
+               the process that made them, so other workers can serve a page
+               up to RESPONSE_CACHE_TTL seconds old.
+    'redis'  - shared by every worker, RESPONSE_CACHE_REDIS_URL points at
+               Redis or anything speaking its protocol. Needs the redis package.
+    'none'   - no caching.
+"""
+
+from collections import OrderedDict
+from functools import wraps
+import threading
+import time
+from flask import g, session
+import replicas
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+HOMEPAGE_KEY = 'page:homepage'
+
+
+def rescue_page_key(rescue_id):
+    """ Cache key of a rescue's page """
+
+    return 'page:rescue:%s' % rescue_id
+
+
+def _row_version(updated_at):
+    return updated_at.isoformat() if updated_at is not None else 'none'
+
+
+def animal_tile_key(animal_id, updated_at):
+    """ Cache key of an animal's linked thumbnail in the lists. A write bumps
+    the animal's updated_at and so moves its tile to a new key in every
+    process, nothing has to be deleted.
+    """
+
+    return 'fragment:animal:%s:%s:tile' % (animal_id, _row_version(updated_at))
+
+
+def rescue_header_key(rescue_id, updated_at):
+    """ Cache key of the top of a rescue's page: name, logo and contacts,
+    versioned like animal_tile_key()
+    """
+
+    return 'fragment:rescue:%s:%s:header' % (rescue_id, _row_version(updated_at))
+
+
+class MemoryCache(object):
+    """ Thread-safe LRU cache whose entries expire after a TTL """
+
+    def __init__(self, max_entries=1000, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                return None
+            # re-inserting moves the key to the most recently used end
+            self.entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + (ttl if ttl is not None else self.ttl)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (expires, value)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class RedisCache(object):
+    """ Cache shared between processes through a Redis compatible server """
+
+    def __init__(self, url, ttl=60, prefix='project:'):
+        if redis is None:
+            raise RuntimeError('the redis package is needed for RESPONSE_CACHE = "redis"')
+        self.client = redis.StrictRedis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.setex(self.prefix + key, ttl if ttl is not None else self.ttl,
+                          value.encode('utf-8'))
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+backend = MemoryCache()
+
+
+def init_app(app):
+    """ Pick the cache backend from the app's config """
+
+    global backend
+
+    kind = app.config.get('RESPONSE_CACHE', 'memory')
+    ttl = app.config.get('RESPONSE_CACHE_TTL', 60)
+    if kind == 'redis':
+        backend = RedisCache(app.config.get('RESPONSE_CACHE_REDIS_URL',
+                                            'redis://localhost:6379/0'), ttl)
+    elif kind == 'none':
+        backend = None
+    else:
+        backend = MemoryCache(app.config.get('RESPONSE_CACHE_SIZE', 1000), ttl)
+
+
+def delete(*keys):
+    """ Drop pages from the cache, called by the control.py writes """
+
+    if backend is not None:
+        backend.delete(*keys)
+
+
+def clear():
+    """ Drop every cached page """
+
+    if backend is not None:
+        backend.clear()
+
+
+def cached_page(make_key):
+    """ Decorator for views that render a public page. The rendered html is
+    cached under make_key(**view_args), together with the page's ETag when
+    conditional.conditional_page runs first: html cached for another version
+    of the data is rendered again rather than served under this version's
+    ETag. Pages are rendered for the cache from the primary database, a
+    lagging replica would store a stale page right after a write dropped it.
+    Responses that aren't plain html (redirects, errors) are never cached, and
+    requests with flashed messages waiting to be shown always render.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**view_args):
+            if backend is None or '_flashes' in session:
+                return view(**view_args)
+
+            key = make_key(**view_args)
+            version = g.get('page_etag', '')
+            cached = backend.get(key)
+            if cached is not None:
+                cached_version, html = cached.split('\n', 1)
+                if cached_version == version:
+                    return html
+
+            with replicas.on_primary():
+                html = view(**view_args)
+            if not isinstance(html, basestring):
+                return html
+            backend.set(key, version + '\n' + html)
+
+            return html
+        return wrapper
+    return decorator
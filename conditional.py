@@ -0,0 +1,91 @@
+"""Conditional GET (ETag / Last-Modified) for public pages.
+
+Each cacheable page has a version stamp read with one small query: the
+updated_at of the rows it shows, which control.py bumps on every write that
+changes the page. The stamp becomes a strong ETag and the Last-Modified
+header, and a request whose If-None-Match/If-Modified-Since still matches is
+answered with 304 before any template is rendered. The ETag is left in
+g.page_etag for cache.cached_page, which keeps it with the cached html.
+"""
+
+from functools import wraps
+import hashlib
+import os
+from flask import current_app, g, make_response, request, session
+
+
+_template_stamp = None
+
+
+def _markup_version():
+    """ Newest template modification time. Part of every ETag so pages cached
+    by browsers are refetched after a deploy that changes the markup.
+    """
+
+    global _template_stamp
+
+    if _template_stamp is None:
+        folder = os.path.join(current_app.root_path, current_app.template_folder)
+        _template_stamp = max([os.path.getmtime(os.path.join(folder, name))
+                               for name in os.listdir(folder)] or [0])
+
+    return _template_stamp
+
+
+def make_etag(key, updated_at):
+    """ Strong ETag of a version of a page
+    Inputs: key(string) naming the page, updated_at(datetime) of its data
+    Output: etag(string) without quotes
+    """
+
+    version = '%s|%s|%s|%s' % (current_app.config.get('ETAG_SALT', ''),
+                               _markup_version(), key, updated_at.isoformat())
+    return hashlib.sha1(version).hexdigest()
+
+
+def _not_modified(etag, last_modified):
+    """ Whether the client's copy of the page is still current """
+
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since:
+        return request.if_modified_since >= last_modified
+
+    return False
+
+
+def conditional_page(get_stamp):
+    """ Decorator for views of public pages. get_stamp(**view_args) returns
+    (key, updated_at) for the page, or None when the page has no stamp yet
+    (rows written before updated_at existed), in which case the page is
+    always rendered.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**view_args):
+            # flashed messages aren't part of the stamp
+            if '_flashes' in session:
+                return view(**view_args)
+
+            stamp = get_stamp(**view_args)
+            if stamp is None or stamp[1] is None:
+                return view(**view_args)
+
+            key, updated_at = stamp
+            etag = make_etag(key, updated_at)
+            # HTTP dates have whole seconds
+            last_modified = updated_at.replace(microsecond=0)
+
+            if _not_modified(etag, last_modified):
+                response = current_app.response_class(status=304)
+            else:
+                g.page_etag = etag
+                response = make_response(view(**view_args))
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.cache_control.no_cache = True
+
+            return response
+        return wrapper
+    return decorator
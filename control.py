@@ -1,8 +1,76 @@
+from collections import namedtuple
+import datetime
+import uuid
+from sqlalchemy.orm import joinedload, load_only, noload
 import sqlalchemy
+import cache
+import geo
+import images
+import imagestore
+import jobs
 import model as m
+import lookups
+import pagination
+import replicas
+import storage
+import uploads
 import os
 
 
+AnimalDetails = namedtuple('AnimalDetails', [
+    'animal_id', 'img_url', 'img_variants', 'name', 'rescue_id', 'bio', 'gender_id',
+    'gender_type', 'age_id', 'age_category', 'size_id', 'size_category',
+    'breed_id', 'breed_type'])
+
+# what the admin pages need to know about the logged in admin
+AdminRecord = namedtuple('AdminRecord', ['admin_id', 'email', 'rescue_id'])
+
+# Admin records change only when an admin adds their rescue, so each process
+# keeps them for a while instead of querying them on every dashboard request.
+# update_admin_row() stores a new version of the record under
+# admin_version_key() in the page cache backend, and a process whose copy has
+# another version queries it again. With the per-process memory backend
+# other processes don't see the new version and keep their copy for up to
+# ADMIN_CACHE_TTL seconds, but the session's rescue id (set by the process
+# that made the change) is never replaced by an older empty one.
+ADMIN_CACHE_TTL = 300
+# kept well past ADMIN_CACHE_TTL, a lost version only costs one query
+ADMIN_VERSION_TTL = 86400
+_admins = cache.MemoryCache(max_entries=1000, ttl=ADMIN_CACHE_TTL)
+
+# How each view loads its list of animals: (what to select, loader options).
+# Every profile loads a page in one query, so a list costs the same number of
+# queries whatever its page size. Relationships a profile doesn't join are
+# switched off (noload) rather than lazy loaded, so they don't run a query per
+# animal; a template that reaches for one quietly gets None or an empty list
+# (SQLAlchemy 1.0 has no raiseload), so add what a template uses here.
+ANIMAL_LIST_PROFILES = {
+    # infinite scroll html: only the link and the photo, and the version
+    # of the cached tile
+    'scroll': ([m.Animal.animal_id, m.Animal.img_url, m.Animal.img_variants,
+                m.Animal.updated_at], []),
+    # rescue page tiles: name, link and photo
+    'tile': ([m.Animal], [load_only('animal_id', 'name', 'img_url',
+                                    'img_variants', 'updated_at'),
+                          noload('*')]),
+    # JSON API: plain columns, labels come from the lookup cache
+    'api': ([m.Animal.animal_id, m.Animal.rescue_id, m.Animal.name,
+             m.Animal.img_url, m.Animal.img_variants, m.Animal.gender_id,
+             m.Animal.age_id, m.Animal.size_id, m.Animal.breed_id], []),
+    # lists that show the lookup labels and the rescue
+    'full': ([m.Animal], [joinedload('rescue'), joinedload('gender'),
+                          joinedload('age'), joinedload('size'),
+                          joinedload('breed')]),
+}
+
+
+# What the public sees of a rescue
+RESCUE_COLUMNS = [m.Rescue.rescue_id, m.Rescue.name, m.Rescue.phone,
+                  m.Rescue.address, m.Rescue.email, m.Rescue.img_url,
+                  m.Rescue.img_variants, m.Rescue.latitude, m.Rescue.longitude]
+
+
+@replicas.read_only
 def get_rescue(rescue_id):
     """ Get rescue details
     Input: id(int) of a rescue from the rescues table
@@ -13,33 +81,159 @@ def get_rescue(rescue_id):
         m.Rescue.rescue_id == rescue_id).first()
 
 
+def get_rescues_query():
+    """ Query of every rescue's public details, without the Rescue objects
+    Output: unordered SQLAlchemy query of RESCUE_COLUMNS
+    """
+
+    return m.db.session.query(*RESCUE_COLUMNS)
+
+
+@replicas.read_only
+def get_homepage_stamp():
+    """ Version of the homepage's list of rescues
+    Output: tuple of (key(string), newest rescue updated_at(datetime))
+    """
+
+    count, updated_at = m.db.session.query(
+        sqlalchemy.func.count(m.Rescue.rescue_id),
+        sqlalchemy.func.max(m.Rescue.updated_at)).one()
+
+    # the count catches deleted rescues, which don't leave an updated_at behind
+    return 'homepage:%s' % count, updated_at
+
+
+@replicas.read_only
+def get_rescue_stamp(rescue_id):
+    """ Version of a rescue's page
+    Input: id(int) of a rescue from the rescues table
+    Output: tuple of (key(string), updated_at(datetime) or None when there is
+    no stamp)
+    """
+
+    updated_at = m.db.session.query(m.Rescue.updated_at).filter(
+        m.Rescue.rescue_id == rescue_id).scalar()
+
+    return 'rescue:%s' % rescue_id, updated_at
+
+
+@replicas.read_only
+def get_animal_stamp(animal_id):
+    """ Version of an animal's page
+    Input: id(int) of an animal from the animals table
+    Output: tuple of (key(string), updated_at(datetime) or None when there is
+    no stamp)
+    """
+
+    updated_at = m.db.session.query(m.Animal.updated_at).filter(
+        m.Animal.animal_id == animal_id).scalar()
+
+    return 'animal:%s' % animal_id, updated_at
+
+
+@replicas.read_only
 def get_animal(animal_id):
     """ Get animal details
     Input: id(int) of an animal from the animals table
-    Output: Animal model object
+    Output: AnimalDetails named tuple with the lookup labels filled in from
+    the reference table cache, or None
     """
 
-    return m.db.session.query(m.Animal.animal_id, m.Animal.img_url,
-                              m.Animal.name, m.Animal.rescue_id,
-                              m.Animal.gender_id, m.Animal.bio,
-                              m.Gender.gender_type, m.Age.age_id,
-                              m.Age.age_category, m.Size.size_category,
-                              m.Breed.breed_type).outerjoin(
-                              m.Gender, m.Age, m.Size,
-                              m.Breed).filter(
-                              m.Animal.animal_id == animal_id).first()
+    animal = m.db.session.query(m.Animal.animal_id, m.Animal.img_url,
+                                m.Animal.img_variants, m.Animal.name, m.Animal.rescue_id,
+                                m.Animal.bio, m.Animal.gender_id,
+                                m.Animal.age_id, m.Animal.size_id,
+                                m.Animal.breed_id).filter(
+                                m.Animal.animal_id == animal_id).first()
+    if animal is None:
+        return None
+
+    return AnimalDetails(animal_id=animal.animal_id,
+                         img_url=animal.img_url,
+                         img_variants=animal.img_variants,
+                         name=animal.name,
+                         rescue_id=animal.rescue_id,
+                         bio=animal.bio,
+                         gender_id=animal.gender_id,
+                         gender_type=lookups.get_label('gender', animal.gender_id),
+                         age_id=animal.age_id,
+                         age_category=lookups.get_label('age', animal.age_id),
+                         size_id=animal.size_id,
+                         size_category=lookups.get_label('size', animal.size_id),
+                         breed_id=animal.breed_id,
+                         breed_type=lookups.get_label('breed', animal.breed_id))
+
+
+def get_available_animals(rescue_id, profile='tile'):
+    """ Get animals that are currently available for adoption
+    Inputs: id(int) of a rescue from the rescues table, name(string) of one of
+    ANIMAL_LIST_PROFILES
+    Output: List of Animal model objects (first page only)
+    """
 
+    animals, next_cursor = get_available_animals_page(rescue_id, profile=profile)
 
-def get_available_animals(rescue_id):
-    """ Get animals that are currently available for adoption
-    Input: id(int) of a rescue from the rescues table
-    Output: List of Animal model objects
+    return animals
+
+
+@replicas.read_only
+def get_available_animals_page(rescue_id, cursor=None, profile='tile'):
+    """ Get one page of animals that are currently available for adoption
+    Inputs: id(int) of a rescue from the rescues table, cursor(string) returned
+    with the previous page or None for the first page, name(string) of one of
+    ANIMAL_LIST_PROFILES
+    Output: tuple of (list of Animal model objects, or rows of the profile's
+    columns, cursor(string) for the next page or None when there are no more
+    animals)
     """
 
-    return m.db.session.query(m.Animal).filter(
-        m.Animal.rescue_id == rescue_id, m.Animal.is_adopted == 'f', m.Animal.is_visible == 't').limit(10).all()
+    query = get_available_animals_query(rescue_id, profile)
 
+    return pagination.seek(query, m.Animal.animal_id, cursor)
 
+
+def get_available_animals_query(rescue_id, profile='tile'):
+    """ Query of the animals that are currently available for adoption,
+    for callers that page through it themselves
+    Inputs: id(int) of a rescue from the rescues table, name(string) of one of
+    ANIMAL_LIST_PROFILES
+    Output: unordered SQLAlchemy query
+    """
+
+    entities, options = ANIMAL_LIST_PROFILES[profile]
+
+    return m.db.session.query(*entities).options(*options).filter(
+        m.Animal.rescue_id == rescue_id, m.ANIMAL_IS_AVAILABLE)
+
+
+@replicas.read_only
+def get_first_available_animals(rescue_ids, per_rescue=pagination.PAGE_SIZE):
+    """ Get the first animals available for adoption at several rescues, in
+    one query
+    Inputs: list of rescue ids(int), number of animals per rescue(int)
+    Output: dictionary of rescue id -> list of rows of the 'scroll' profile's
+    columns
+    """
+
+    if not rescue_ids:
+        return {}
+
+    entities, options = ANIMAL_LIST_PROFILES['scroll']
+    position = sqlalchemy.func.row_number().over(
+        partition_by=m.Animal.rescue_id, order_by=m.Animal.animal_id).label('position')
+    ranked = m.db.session.query(m.Animal.rescue_id, position, *entities).filter(
+        m.Animal.rescue_id.in_(rescue_ids), m.ANIMAL_IS_AVAILABLE).subquery()
+
+    animals = dict((rescue_id, []) for rescue_id in rescue_ids)
+    for animal in m.db.session.query(ranked).filter(
+            ranked.c.position <= per_rescue).order_by(ranked.c.rescue_id,
+                                                      ranked.c.animal_id):
+        animals[animal.rescue_id].append(animal)
+
+    return animals
+
+
+@replicas.read_only
 def get_admin_by_id(admin_id):
     """ Get admin by id
     Input: id(int) of an admin from the admins table
@@ -59,6 +253,94 @@ def get_admin_by_session(email):
     return m.db.session.query(m.Admin).filter(m.Admin.email == email).first()
 
 
+def get_admin_record(admin_id):
+    """ Get the cached record of an admin, see ADMIN_CACHE_TTL
+    Input: id(int) of an admin from the admins table
+    Output: AdminRecord or None when there is no such admin
+    """
+
+    version = _admin_version(admin_id)
+    cached = _admins.get(admin_id)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    # from the primary: a lagging replica's row would be kept for minutes
+    row = m.db.session.query(m.Admin.admin_id, m.Admin.email, m.Admin.rescue_id).filter(
+        m.Admin.admin_id == admin_id).first()
+    if row is None:
+        return None
+    record = AdminRecord(*row)
+    _admins.set(admin_id, (version, record))
+
+    return record
+
+
+def admin_version_key(admin_id):
+    """ Cache key of the version of an admin's record """
+
+    return 'admin:%s:version' % admin_id
+
+
+def _admin_version(admin_id):
+    if cache.backend is None:
+        return None
+
+    return cache.backend.get(admin_version_key(admin_id))
+
+
+def remember_admin(admin_session, admin):
+    """ Keep who is logged in in the session, the cookie is signed with the
+    app's SECRET_KEY so it can't be altered by the visitor
+    Inputs: session dictionary, Admin model object or AdminRecord
+    Output: No output, just updates the session
+    """
+
+    admin_session['current_admin'] = admin.email
+    admin_session['admin_id'] = admin.admin_id
+    admin_session['rescue_id'] = admin.rescue_id
+    _admins.set(admin.admin_id, (_admin_version(admin.admin_id),
+                                 AdminRecord(admin.admin_id, admin.email, admin.rescue_id)))
+
+
+def forget_admins():
+    """ Drop every cached admin record, e.g. after reloading the admins table """
+
+    _admins.clear()
+
+
+def get_logged_in_admin(admin_session):
+    """ Get the admin logged in with a session, without a query while the
+    admin's record is cached
+    Input: session dictionary
+    Output: AdminRecord or None when no admin is logged in
+    """
+
+    email = admin_session.get('current_admin')
+    if email is None:
+        return None
+
+    admin_id = admin_session.get('admin_id')
+    if admin_id is None:
+        # logged in before the session held the admin id
+        admin = get_admin_by_session(email)
+        if admin is None:
+            return None
+        remember_admin(admin_session, admin)
+        admin_id = admin.admin_id
+
+    record = get_admin_record(admin_id)
+    if record is None or record.email != email:
+        return None
+    if record.rescue_id is None and admin_session.get('rescue_id') is not None:
+        # a copy from before this admin added their rescue, an admin's
+        # rescue is never taken away
+        record = record._replace(rescue_id=admin_session['rescue_id'])
+    elif admin_session.get('rescue_id') != record.rescue_id:
+        admin_session['rescue_id'] = record.rescue_id
+
+    return record
+
+
 def allowed_file(filename, ALLOWED_EXTENSIONS):
     """ Return whether the file is an allowed file or not
     Inputs: filename of uploaded file(string), set of strings
@@ -69,6 +351,139 @@ def allowed_file(filename, ALLOWED_EXTENSIONS):
         filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def _commit_with_upload(instance, uploaded_file, upload_folder):
+    """ Put an upload in the image store, point the row at it and commit both
+    at once, together with a background job that makes the resized variants
+    unless the same image was stored before. If storing the file or the
+    commit fails, the transaction is rolled back and a newly stored file
+    removed so a row never outlives its image or the other way around.
+    Inputs: Animal or Rescue model object, uploaded file(FileStorage),
+    upload directory path(string)
+    Output: No output, commits the session
+    """
+
+    blob = None
+    try:
+        extension = uploaded_file.filename.rsplit('.', 1)[1].lower()
+        blob = imagestore.store_upload(uploaded_file, upload_folder, extension)
+        instance.img_url = blob.path
+        instance.img_variants = blob.img_variants
+        if blob.img_variants is None:
+            jobs.enqueue('image_variants', path=blob.path)
+        m.db.session.commit()
+    except Exception:
+        m.db.session.rollback()
+        if blob is not None:
+            # kept when a concurrent upload of the same bytes committed it
+            imagestore.discard(blob)
+        raise
+
+
+def _commit_with_direct_upload(instance, key):
+    """ Point the row at a photo the browser uploaded straight to the storage
+    and commit, together with the job that moves it into the image store
+    Inputs: Animal or Rescue model object, key(string) from
+    storage.presigned_upload()
+    Output: No output, commits the session
+    """
+
+    if not storage.is_incoming_key(key):
+        raise ValueError('%s is not an uploaded file' % key)
+
+    instance.img_url = key
+    instance.img_variants = None
+    jobs.enqueue('ingest_upload', key=key)
+    m.db.session.commit()
+
+
+def _commit_with_photo(instance, admin_request, upload_folder):
+    """ Commit a new row with the photo of its form, uploaded with the form
+    or straight to the storage beforehand
+    """
+
+    uploaded_key = admin_request.form.get('uploaded_key')
+    if uploaded_key:
+        _commit_with_direct_upload(instance, uploaded_key)
+    else:
+        _commit_with_upload(instance, admin_request.files['file'], upload_folder)
+
+
+def _update_image_rows(key, values):
+    """ Set values on the animals and rescues showing an image, and give
+    their pages a new version
+    Inputs: key(string) of the image, dictionary of column values
+    Output: set of cache keys of the pages to drop once committed
+    """
+
+    now = datetime.datetime.utcnow()
+    pages = set()
+    for model in (m.Animal, m.Rescue):
+        for row in m.db.session.query(model).filter(model.img_url == key):
+            for column, value in values.items():
+                setattr(row, column, value)
+            row.updated_at = now
+            rescue = row if model is m.Rescue else row.rescue
+            if rescue is not None:
+                # the rescue's page shows the photo too
+                rescue.updated_at = now
+                pages.add(cache.rescue_page_key(rescue.rescue_id))
+
+    return pages
+
+
+@jobs.handler('image_variants')
+def make_image_variants(path):
+    """ Background job: resize a stored image once and record the variants
+    on the rows showing it. Rows are matched on img_url, which also covers
+    bulk intake rows whose ids the importer never learns.
+    Input: path(string) key of the image
+    Output: No output, commits the session
+    """
+
+    blob = m.db.session.query(m.ImageBlob).filter(m.ImageBlob.path == path).first()
+    if blob is not None and blob.img_variants is not None:
+        variants = blob.img_variants
+    else:
+        variants = images.dump_variants(imagestore.make_variants(path))
+        if blob is not None:
+            blob.img_variants = variants
+
+    pages = _update_image_rows(path, {'img_variants': variants})
+    m.db.session.commit()
+    cache.delete(*pages)
+
+
+@jobs.handler('ingest_upload')
+def ingest_upload(key):
+    """ Background job: check a photo uploaded straight to the storage, move
+    it into the image store and point its rows at the stored image
+    Input: key(string) from storage.presigned_upload()
+    Output: No output, commits the session
+    """
+
+    if not any(m.db.session.query(model.img_url).filter(model.img_url == key).first()
+               for model in (m.Animal, m.Rescue)):
+        # moved already by an earlier run, or the row was deleted
+        storage.backend.delete(key)
+        return
+
+    extension = key.rsplit('.', 1)[1]
+    with storage.backend.local_copy(key) as path:
+        with open(path, 'rb') as source:
+            if not uploads.sniff(extension, source.read(uploads.SNIFF_SIZE)):
+                raise ValueError('%s is not a valid .%s file' % (key, extension))
+            source.seek(0)
+            blob = imagestore.store_stream(source, os.path.dirname(path), extension)
+
+    if blob.img_variants is None:
+        jobs.enqueue('image_variants', path=blob.path)
+    pages = _update_image_rows(key, {'img_url': blob.path,
+                                     'img_variants': blob.img_variants})
+    m.db.session.commit()
+    cache.delete(*pages)
+    storage.backend.delete(key)
+
+
 def add_animal(admin_request, admin_session, upload_folder):
     """ Add new animal to the database
     Inputs: request object, session dictionary, upload directory path(string)
@@ -82,26 +497,21 @@ def add_animal(admin_request, admin_session, upload_folder):
     size = admin_request.form.get('size')
     breed = admin_request.form.get('breeds')
     bio = admin_request.form.get('bio')
-    is_adopted = admin_request.form.get('is_adopted')
-    is_visible = admin_request.form.get('is_visible')
-
-    gender_id = m.db.session.query(m.Gender.gender_id).filter(
-        m.Gender.gender_type == gender).first()
-    age_id = m.db.session.query(m.Age.age_id).filter(
-        m.Age.age_category == age).first()
-    size_id = m.db.session.query(m.Size.size_id).filter(
-        m.Size.size_category == size).first()
-    breed_id = m.db.session.query(m.Breed.breed_id).filter(
-        m.Breed.breed_type == breed).first()
+    # the form's selects send 't' or 'f'
+    is_adopted = admin_request.form.get('is_adopted') == 't'
+    is_visible = admin_request.form.get('is_visible') == 't'
 
-    # return the rescue that belongs to the logged in admin, func will be returning this!
-    rescue = m.db.session.query(m.Rescue).join(m.Admin).filter(
-        m.Admin.email == admin_session['current_admin']).first()
+    gender_id = lookups.get_id('gender', gender)
+    age_id = lookups.get_id('age', age)
+    size_id = lookups.get_id('size', size)
+    breed_id = lookups.get_id('breed', breed)
 
-    # temporary filename
-    user_filename = admin_request.files['file'].filename
-    # Store the extension of uploaded file to add to user_filename
-    extension = user_filename.rsplit('.', 1)[1].lower()
+    # return the rescue that belongs to the logged in admin, func will be returning this!
+    if admin_session.get('rescue_id') is not None:
+        rescue = m.db.session.query(m.Rescue).get(admin_session['rescue_id'])
+    else:
+        rescue = m.db.session.query(m.Rescue).join(m.Admin).filter(
+            m.Admin.email == admin_session['current_admin']).first()
 
     animal = m.Animal(name=name, rescue=rescue,
                       gender_id=gender_id, age_id=age_id, size_id=size_id,
@@ -110,18 +520,14 @@ def add_animal(admin_request, admin_session, upload_folder):
 
     # Adding the animal instance to the animals table
     m.db.session.add(animal)
-    m.db.session.commit()
-
-    # animal id of animal just added to db
-    a_id = animal.animal_id
 
-    # rename filename
-    user_filename = str(rescue.rescue_id) + '-' + str(a_id) + '.' + extension
-    path = os.path.join(upload_folder, user_filename)
-    admin_request.files['file'].save(path)
+    # the rescue's page lists its animals, so it has a new version too
+    rescue.updated_at = datetime.datetime.utcnow()
 
-    animal.img_url = path
-    m.db.session.commit()
+    # Saving the photo and the animal in one commit
+    _commit_with_photo(animal, admin_request, upload_folder)
+    # the page lists the new animal; its tile is new, no fragment is stale
+    cache.delete(cache.rescue_page_key(rescue.rescue_id))
 
     return rescue
 
@@ -137,45 +543,34 @@ def add_rescue(admin_request, admin_session, upload_folder):
     address = admin_request.form.get('address')
     email = admin_request.form.get('email')
 
-    # temporary filename
-    user_filename = admin_request.files['file'].filename
-    # storing the extension of uploaded file
-    extension = user_filename.rsplit('.', 1)[1].lower()
-
     # setting up the population with new data from form input to the rescue table
     rescue = m.Rescue(name=rescue_name, phone=phone, address=address,
-                      email=email)
+                      email=email, **geo.locate(address))
 
     # adding new instance/row to the rescue table
     m.db.session.add(rescue)
-    # commit the new instance
-    m.db.session.commit()
-
-    # getting rescue_id of rescue that was just commited
-    r_id = rescue.rescue_id
-
-    # Create file name based on the rescue's id
-    user_filename = str(r_id) + '.' + extension
-    # Move the file from the temporal folder to the upload folder that was set up
-    path = os.path.join(upload_folder, user_filename)
-    # Saving the file to the upload folder
-    admin_request.files['file'].save(path)
-
-    # Updating the rescues table with rescue's image url
-    rescue.img_url = path
-    m.db.session.commit()
+    # Saving the logo and the rescue in one commit
+    _commit_with_photo(rescue, admin_request, upload_folder)
+    cache.delete(cache.HOMEPAGE_KEY)
 
     return rescue
 
 
 def update_admin_row(admin, rescue):
     """ Update row of admin table with rescue_id of newly added rescue
-    Inputs: Admin model object, Rescue model object
+    Inputs: Admin model object or AdminRecord, Rescue model object
     Output: No output, just updates a row in the admin table
     """
 
-    admin.rescue_id = rescue.rescue_id
+    m.db.session.query(m.Admin).filter(m.Admin.admin_id == admin.admin_id).update(
+        {'rescue_id': rescue.rescue_id}, synchronize_session='evaluate')
     m.db.session.commit()
+    _admins.delete(admin.admin_id)
+    if cache.backend is not None:
+        # every process' copy is out of date
+        cache.backend.set(admin_version_key(admin.admin_id), uuid.uuid4().hex,
+                          ADMIN_VERSION_TTL)
+    cache.delete(cache.HOMEPAGE_KEY, cache.rescue_page_key(rescue.rescue_id))
 
 
 def get_last_rescue_added():
@@ -0,0 +1,197 @@
+"""Generate large, realistic seed files for load testing.
+
+Writes the same pipe-delimited u.* files as seed_data/, so the output
+directory can be loaded with seed.py (python seed.py --fast --data-dir DIR).
+Everything is derived from one random seed, so the same arguments always
+produce the same files, and rows are written as they are generated so
+millions of animals never sit in memory.
+
+Animals are spread over rescues with a Zipf-like skew: a few large shelters
+hold most of the animals and most rescues only have a handful, which is what
+the real data looks like and what exposes per-rescue scaling problems.
+
+    python generate_seed.py --rescues 5000 --animals 5000000 --out /tmp/big
+"""
+
+import argparse
+import bisect
+import os
+import random
+import shutil
+
+
+SEED_DIR = 'seed_data'
+
+# Reference tables that are copied as they are
+COPIED_FILES = ['u.species', 'u.age', 'u.gender', 'u.size']
+
+PET_NAMES = ['Archie', 'Max', 'Fluffy', 'Bella', 'Luna', 'Charlie', 'Lucy',
+             'Cooper', 'Daisy', 'Milo', 'Bailey', 'Sadie', 'Rocky', 'Molly',
+             'Buddy', 'Maggie', 'Bear', 'Sophie', 'Duke', 'Chloe', 'Tucker',
+             'Penny', 'Jack', 'Zoey', 'Oliver', 'Lola', 'Toby', 'Rosie',
+             'Leo', 'Ginger', 'Oscar', 'Pepper', 'Simba', 'Nala', 'Bruno',
+             'Coco', 'Gus', 'Willow', 'Zeus', 'Honey']
+
+RESCUE_WORDS = ['Happy Wag', 'Second Chance', 'Paws', 'Furever Home',
+                'Whiskers', 'Safe Haven', 'Lucky Tails', 'Forgotten Friends',
+                'Hope', 'Rescue Ranch', 'Guardian Angels', 'Little Paws']
+
+RESCUE_KINDS = ['Rescue', 'Animal Services', 'Pet Rescue', 'Humane Society',
+                'Animal Shelter', 'SPCA']
+
+# city, state, zip
+CITIES = [('Miami', 'FL', '33101'), ('Gainesville', 'FL', '32601'),
+          ('Tampa', 'FL', '33602'), ('Orlando', 'FL', '32801'),
+          ('Atlanta', 'GA', '30303'), ('Austin', 'TX', '78701'),
+          ('Denver', 'CO', '80202'), ('Seattle', 'WA', '98101'),
+          ('Portland', 'OR', '97201'), ('San Francisco', 'CA', '94103'),
+          ('Los Angeles', 'CA', '90012'), ('Chicago', 'IL', '60601'),
+          ('New York', 'NY', '10001'), ('Boston', 'MA', '02108'),
+          ('Phoenix', 'AZ', '85003'), ('Nashville', 'TN', '37203')]
+
+STREETS = ['Main St.', 'Oak Ave.', 'South Beach Dr.', 'Essex St.',
+           'Kingston Dr.', 'Maple Rd.', 'Park Blvd.', 'Cedar Ln.']
+
+
+def count_rows(path):
+    """ Number of non-empty rows in a seed file """
+
+    with open(path) as seed_file:
+        return sum(1 for row in seed_file if row.strip())
+
+
+def skewed_picker(rng, count, skew):
+    """ Build a function that picks ids 1..count with Zipf-like weights. Ids
+    are shuffled first so the biggest rescues aren't simply the first ones.
+    Inputs: random.Random, number of ids(int), skew exponent(float), 0 means
+    uniform
+    Output: function taking no arguments and returning an id(int)
+    """
+
+    ids = range(1, count + 1)
+    rng.shuffle(ids)
+
+    cumulative = []
+    total = 0.0
+    for rank in xrange(1, count + 1):
+        total += 1.0 / rank ** skew
+        cumulative.append(total)
+
+    def pick():
+        return ids[bisect.bisect_left(cumulative, rng.random() * total)]
+
+    return pick
+
+
+def write_breeds(rng, source_dir, out_dir, extra_breeds):
+    """ Copy u.breeds and append generated breeds
+    Output: list of breed ids(int)
+    """
+
+    breeds = []
+    with open(os.path.join(out_dir, 'u.breeds'), 'w') as out:
+        with open(os.path.join(source_dir, 'u.breeds')) as source:
+            for row in source:
+                row = row.rstrip('\r\n')
+                if not row:
+                    continue
+                breed_id, breed_type, species_id = row.split('|')
+                breeds.append((int(breed_id), int(species_id), breed_type))
+                out.write(row + '\n')
+
+        base_breeds = list(breeds)
+        for i in xrange(extra_breeds):
+            breed_id = len(breeds) + 1
+            parent_id, species_id, parent_type = rng.choice(base_breeds)
+            breed_type = '%s Mix %d' % (parent_type, i + 1)
+            breeds.append((breed_id, species_id, breed_type))
+            out.write('%d|%s|%d\n' % (breed_id, breed_type, species_id))
+
+    return [breed_id for breed_id, species_id, breed_type in breeds]
+
+
+def write_rescues(rng, out_dir, rescues):
+    """ Write u.rescue """
+
+    with open(os.path.join(out_dir, 'u.rescue'), 'w') as out:
+        for rescue_id in xrange(1, rescues + 1):
+            city, state, zipcode = rng.choice(CITIES)
+            name = '%s %s %s' % (city, rng.choice(RESCUE_WORDS),
+                                 rng.choice(RESCUE_KINDS))
+            phone = '%03d-%03d-%04d' % (rng.randint(200, 999),
+                                        rng.randint(200, 999),
+                                        rng.randint(0, 9999))
+            address = '%d %s %s, %s %s' % (rng.randint(1, 9999),
+                                           rng.choice(STREETS), city, state,
+                                           zipcode)
+            email = 'rescue%d@example.com' % rescue_id
+            out.write('%d|%s|%s|%s|%s\n' % (rescue_id, name, phone, address,
+                                            email))
+
+
+def write_animals(rng, out_dir, animals, pick_rescue, breeds, genders, ages,
+                  sizes):
+    """ Write u.animal, one row at a time """
+
+    with open(os.path.join(out_dir, 'u.animal'), 'w') as out:
+        for animal_id in xrange(1, animals + 1):
+            out.write('%d|%s|%d|%d|%d|%d|%d\n' % (
+                animal_id, rng.choice(PET_NAMES), pick_rescue(),
+                rng.randint(1, genders), rng.randint(1, ages),
+                rng.randint(1, sizes), rng.choice(breeds)))
+
+
+def write_admins(rng, out_dir, rescues, admins_without_rescue):
+    """ Write u.admin: one admin per rescue, plus admins that signed up but
+    haven't added their rescue yet
+    """
+
+    with open(os.path.join(out_dir, 'u.admin'), 'w') as out:
+        total = rescues + admins_without_rescue
+        for admin_id in xrange(1, total + 1):
+            rescue_id = str(admin_id) if admin_id <= rescues else ''
+            out.write('%d|admin%d@example.com|%04d|%s\n' % (
+                admin_id, admin_id, rng.randint(0, 9999), rescue_id))
+
+
+def generate(out_dir, rescues=5000, animals=5000000, admins_without_rescue=100,
+             extra_breeds=0, skew=1.1, seed=0, source_dir=SEED_DIR):
+    """ Generate a full set of seed files
+    Inputs: output directory(string), row counts(int), Zipf skew of animals
+    per rescue(float), random seed(int), directory of the reference seed files
+    Output: No output, writes u.* files to out_dir
+    """
+
+    rng = random.Random(seed)
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    for seed_file in COPIED_FILES:
+        shutil.copy(os.path.join(source_dir, seed_file),
+                    os.path.join(out_dir, seed_file))
+    genders = count_rows(os.path.join(out_dir, 'u.gender'))
+    ages = count_rows(os.path.join(out_dir, 'u.age'))
+    sizes = count_rows(os.path.join(out_dir, 'u.size'))
+
+    breeds = write_breeds(rng, source_dir, out_dir, extra_breeds)
+    write_rescues(rng, out_dir, rescues)
+    write_animals(rng, out_dir, animals, skewed_picker(rng, rescues, skew),
+                  breeds, genders, ages, sizes)
+    write_admins(rng, out_dir, rescues, admins_without_rescue)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate large seed files')
+    parser.add_argument('--out', required=True, help='output directory')
+    parser.add_argument('--rescues', type=int, default=5000)
+    parser.add_argument('--animals', type=int, default=5000000)
+    parser.add_argument('--admins-without-rescue', type=int, default=100)
+    parser.add_argument('--extra-breeds', type=int, default=0)
+    parser.add_argument('--skew', type=float, default=1.1,
+                        help='Zipf exponent of animals per rescue, 0 is uniform')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    generate(args.out, args.rescues, args.animals, args.admins_without_rescue,
+             args.extra_breeds, args.skew, args.seed)
@@ -0,0 +1,271 @@
+"""Where rescues are, and which ones are near a place.
+
+Rescue.address is free text, so finding the rescues near someone meant
+reading every row. Rescues get a latitude and longitude when they're added,
+looked up offline in seed_data/u.geocode (city|state|latitude|longitude, add
+rows or point GEOCODE_FILE at a bigger table), never over the network.
+
+Each rescue also gets its geohash, a string whose prefixes are nested grid
+cells, in an indexed column. A search around a point picks the cell size
+that fits the radius, asks the index for the rescues in the few cells
+covering the circle with prefix LIKEs, and only measures the distance of
+those. The same works with PostGIS or without.
+
+Rescues added before the coordinates existed are filled in with:
+
+    python geo.py --backfill
+"""
+
+import argparse
+import math
+import os
+import re
+import threading
+import sqlalchemy
+import model as m
+import replicas
+
+
+GEOCODE_FILE = os.path.join('seed_data', 'u.geocode')
+
+# characters of a stored geohash, about 5 meters
+GEOHASH_PRECISION = 9
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+EARTH_RADIUS_MILES = 3958.8
+
+DEFAULT_RADIUS = 25
+MAX_RADIUS = 500
+
+# "..., FL 32601" at the end of an address
+STATE = re.compile(r'^(.*),\s*([A-Za-z]{2})\b[^,]*$')
+
+# "29.65, -82.32"
+COORDINATES = re.compile(r'^\s*(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)\s*$')
+
+_lock = threading.Lock()
+_places = None
+
+
+def _normalize(words):
+    return ' '.join(words.lower().replace('.', ' ').split())
+
+
+def load(path=None):
+    """ (Re)load the geocoding table
+    Input: path(string) of the table, GEOCODE_FILE by default
+    Output: No output, fills the module level dictionary
+    """
+
+    global _places
+
+    places = {}
+    with open(path or GEOCODE_FILE) as geocode_file:
+        for row in geocode_file:
+            row = row.rstrip('\r\n')
+            if not row:
+                continue
+            city, state, latitude, longitude = row.split('|')
+            places[(_normalize(city), state.upper())] = (float(latitude), float(longitude))
+
+    with _lock:
+        _places = places
+
+
+def geocode(text):
+    """ Coordinates of an address or a place
+    Input: text(string) ending in "City, ST" with anything before the city,
+    e.g. "631 South Beach Dr. Miami, FL 33101", or "latitude, longitude"
+    Output: tuple of (latitude(float), longitude(float)) or None when the
+    place isn't in the table
+    """
+
+    if not text:
+        return None
+
+    coordinates = COORDINATES.match(text)
+    if coordinates is not None:
+        latitude, longitude = float(coordinates.group(1)), float(coordinates.group(2))
+        if -90 <= latitude <= 90 and -180 <= longitude <= 180:
+            return latitude, longitude
+        return None
+
+    match = STATE.match(text.strip())
+    if match is None:
+        return None
+
+    if _places is None:
+        load()
+    words = _normalize(match.group(1)).split()
+    state = match.group(2).upper()
+    # the street comes first, try the longest city name that ends the text
+    for length in xrange(min(len(words), 4), 0, -1):
+        place = _places.get((' '.join(words[-length:]), state))
+        if place is not None:
+            return place
+
+    return None
+
+
+def encode_geohash(latitude, longitude, precision=GEOHASH_PRECISION):
+    """ Geohash of a point
+    Inputs: latitude(float), longitude(float), number of characters(int)
+    Output: geohash(string)
+    """
+
+    latitude_range = [-90.0, 90.0]
+    longitude_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    value = 0
+    even = True
+    while len(geohash) < precision:
+        # bits alternate between longitude and latitude, longitude first
+        if even:
+            interval, coordinate = longitude_range, longitude
+        else:
+            interval, coordinate = latitude_range, latitude
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            geohash.append(GEOHASH_ALPHABET[value])
+            bits = value = 0
+
+    return ''.join(geohash)
+
+
+def _cell_size(precision):
+    """ (latitude, longitude) degrees spanned by a geohash cell """
+
+    bits = 5 * precision
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** ((bits + 1) // 2)
+
+
+def covering_cells(latitude, longitude, radius):
+    """ Geohash prefixes whose cells together cover a circle
+    Inputs: latitude(float), longitude(float), radius in miles(float)
+    Output: set of geohash prefixes(strings)
+    """
+
+    latitude_delta = math.degrees(radius / EARTH_RADIUS_MILES)
+    cos_latitude = math.cos(math.radians(latitude))
+    longitude_delta = (min(latitude_delta / cos_latitude, 180.0)
+                       if cos_latitude > 1e-6 else 180.0)
+
+    # the longest prefixes whose cells are at least half the circle's box, so
+    # the cells of a 3x3 grid of points over the box cover all of it
+    precision = 1
+    while precision < GEOHASH_PRECISION:
+        latitude_size, longitude_size = _cell_size(precision + 1)
+        if latitude_size < latitude_delta or longitude_size < longitude_delta:
+            break
+        precision += 1
+
+    cells = set()
+    for latitude_step in (-1, 0, 1):
+        for longitude_step in (-1, 0, 1):
+            point_latitude = max(-90.0, min(90.0, latitude + latitude_step * latitude_delta))
+            point_longitude = longitude + longitude_step * longitude_delta
+            # wrap around the antimeridian
+            point_longitude = (point_longitude + 180.0) % 360.0 - 180.0
+            cells.add(encode_geohash(point_latitude, point_longitude, precision))
+
+    return cells
+
+
+def distance(latitude, longitude, other_latitude, other_longitude):
+    """ Great circle distance in miles between two points """
+
+    latitude, longitude, other_latitude, other_longitude = map(
+        math.radians, (latitude, longitude, other_latitude, other_longitude))
+    a = (math.sin((other_latitude - latitude) / 2) ** 2 +
+         math.cos(latitude) * math.cos(other_latitude) *
+         math.sin((other_longitude - longitude) / 2) ** 2)
+
+    return 2 * EARTH_RADIUS_MILES * math.asin(min(1.0, math.sqrt(a)))
+
+
+def locate(address):
+    """ Location columns of a rescue at an address
+    Input: address(string)
+    Output: dictionary of latitude, longitude and geohash, all None when the
+    address can't be geocoded
+    """
+
+    place = geocode(address)
+    if place is None:
+        return {'latitude': None, 'longitude': None, 'geohash': None}
+
+    return {'latitude': place[0], 'longitude': place[1],
+            'geohash': encode_geohash(*place)}
+
+
+@replicas.read_only
+def nearby_rescues(latitude, longitude, radius=DEFAULT_RADIUS, limit=None):
+    """ Rescues within a radius of a point, nearest first
+    Inputs: latitude(float), longitude(float), radius in miles(float),
+    largest number of rescues(int) or None for all of them
+    Output: list of tuples of (Rescue model object, distance in miles(float))
+    """
+
+    radius = min(radius, MAX_RADIUS)
+    cells = sorted(covering_cells(latitude, longitude, radius))
+    candidates = m.db.session.query(m.Rescue).filter(sqlalchemy.or_(
+        *[m.Rescue.geohash.like(cell + '%') for cell in cells]))
+
+    rescues = []
+    for rescue in candidates:
+        miles = distance(latitude, longitude, rescue.latitude, rescue.longitude)
+        if miles <= radius:
+            rescues.append((rescue, miles))
+    rescues.sort(key=lambda (rescue, miles): (miles, rescue.rescue_id))
+
+    return rescues[:limit] if limit is not None else rescues
+
+
+def backfill():
+    """ Geocode the rescues that have no coordinates yet
+    Output: number of rescues located(int)
+    """
+
+    located = 0
+    for rescue in m.db.session.query(m.Rescue).filter(m.Rescue.geohash == None):
+        location = locate(rescue.address)
+        if location['geohash'] is not None:
+            for column, value in location.items():
+                setattr(rescue, column, value)
+            located += 1
+    m.db.session.commit()
+
+    return located
+
+
+def init_app(app):
+    """ Use the app's GEOCODE_FILE if it has one """
+
+    global GEOCODE_FILE, _places
+
+    GEOCODE_FILE = app.config.get('GEOCODE_FILE', GEOCODE_FILE)
+    _places = None
+
+
+if __name__ == "__main__":
+    from server import app
+
+    parser = argparse.ArgumentParser(description='Geocode rescues')
+    parser.add_argument('--db', default='postgresql:///project')
+    parser.add_argument('--backfill', action='store_true',
+                        help='geocode rescues that have no coordinates yet')
+    args = parser.parse_args()
+
+    m.connect_to_db(app, args.db)
+    if args.backfill:
+        print "Located %d rescues" % backfill()
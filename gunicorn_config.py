@@ -0,0 +1,17 @@
+"""gunicorn settings, used with: gunicorn -c gunicorn_config.py wsgi:app"""
+
+import multiprocessing
+import os
+
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+
+# build and warm up the app once, in the master, see wsgi.py
+preload_app = True
+
+
+def post_fork(server, worker):
+    # the connections of the master's pools can't be shared with the worker
+    from model import dispose_engines
+    dispose_engines()
@@ -0,0 +1,125 @@
+"""Resized, metadata-free variants of uploaded photos.
+
+Phone photos are often several megabytes, and the rescue page used to send
+the original for every animal in the list. Each upload gets a thumbnail, a
+medium and a full size copy, as JPEG and WebP, re-encoded from the pixels
+only so EXIF data (including GPS position) is dropped. The variants are
+recorded on the row as JSON and the templates offer them with srcset, so
+list pages download kilobytes per animal.
+
+Pillow is needed to make variants. Without it uploads keep working and
+pages fall back to the original image.
+"""
+
+import json
+import os
+import storage
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+
+# name, longest side in pixels
+VARIANTS = [('thumb', 200), ('medium', 600), ('full', 1600)]
+
+# format, Pillow format name, file extension, save options
+FORMATS = [('jpeg', 'JPEG', 'jpg', {'quality': 82, 'optimize': True,
+                                    'progressive': True}),
+           ('webp', 'WEBP', 'webp', {'quality': 80, 'method': 4})]
+
+
+def variant_path(path, name, extension):
+    """ Where a variant of an image is saved, next to the original
+    e.g. static/images/1-45.png -> static/images/1-45-thumb.webp
+    """
+
+    base, original_extension = os.path.splitext(path)
+    return '%s-%s.%s' % (base, name, extension)
+
+
+def _load(path):
+    """ Open an image upright and flattened to RGB """
+
+    image = Image.open(path)
+    # phones store the camera orientation in EXIF instead of rotating pixels,
+    # and EXIF is about to be dropped
+    if hasattr(ImageOps, 'exif_transpose'):
+        image = ImageOps.exif_transpose(image)
+
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        return background
+
+    return image.convert('RGB')
+
+
+def make_variants(path):
+    """ Write every variant of an image
+    Input: path(string) of the original image
+    Output: dictionary of variant name -> {'width': int, 'jpeg': path,
+    'webp': path}, or None when Pillow isn't installed
+    """
+
+    if Image is None:
+        return None
+
+    original = _load(path)
+    variants = {}
+    try:
+        for name, size in VARIANTS:
+            image = original.copy()
+            # never scales up, keeps the aspect ratio
+            image.thumbnail((size, size), Image.LANCZOS)
+            variant = variants[name] = {'width': image.size[0]}
+            for key, pil_format, extension, options in FORMATS:
+                target = variant_path(path, name, extension)
+                image.save(target, pil_format, **options)
+                variant[key] = target
+    except Exception:
+        # don't leave half a set of files behind
+        remove_variants(variants)
+        raise
+
+    return variants
+
+
+def remove_variants(variants):
+    """ Delete the files of a make_variants() result """
+
+    for variant in (variants or {}).values():
+        for key, pil_format, extension, options in FORMATS:
+            if variant.get(key) and os.path.exists(variant[key]):
+                os.remove(variant[key])
+
+
+def dump_variants(variants):
+    """ Variants as stored in an img_variants column """
+
+    return json.dumps(variants) if variants else None
+
+
+def load_variants(value):
+    """ Jinja filter: img_variants column -> dictionary, {} when empty """
+
+    return json.loads(value) if value else {}
+
+
+def srcset(variants, key):
+    """ Jinja filter: srcset attribute of one format of the variants
+    e.g. "/images/1-45-thumb.webp 200w, /images/1-45-medium.webp 600w"
+    """
+
+    return ', '.join('%s %sw' % (storage.url(variants[name][key]),
+                                 variants[name]['width'])
+                     for name, size in VARIANTS if name in variants)
+
+
+def init_app(app):
+    """ Register the template filters """
+
+    app.jinja_env.filters['image_variants'] = load_variants
+    app.jinja_env.filters['srcset'] = srcset
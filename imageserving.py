@@ -0,0 +1,183 @@
+"""Serving images from the local image storage.
+
+Uploaded images used to go through Flask's static handler, in the same
+workers as the pages and without byte ranges. They are served from
+/images/<name> now, with cache headers that fit them (a year and immutable
+for content-addressed images, a day for older uploads), ETag/Last-Modified
+revalidation and single byte ranges. IMAGE_SERVING picks who sends the bytes:
+
+    'app'        - the app, through wsgi.file_wrapper so servers like
+                   gunicorn send whole files with sendfile() (default)
+    'x-sendfile' - Apache mod_xsendfile or lighttpd, from the X-Sendfile header
+    'x-accel'    - nginx, from an internal location the X-Accel-Redirect
+                   header points at (IMAGE_ACCEL_PREFIX, default /_images/)
+
+With the last two a worker only looks the file up. nginx can also serve the
+images without asking the app at all, print its config with:
+
+    python imageserving.py --nginx
+"""
+
+import argparse
+import datetime
+import mimetypes
+import os
+from flask import abort, current_app, request, safe_join
+from werkzeug.datastructures import ContentRange
+from werkzeug.http import is_resource_modified
+from werkzeug.wsgi import wrap_file
+import imagestore
+import storage
+
+
+URL_PREFIX = '/images/'
+
+# images uploaded before the image store can still be replaced in place
+LEGACY_CACHE_CONTROL = 'public, max-age=86400'
+
+CHUNK_SIZE = 64 * 1024
+
+
+def cache_control(name):
+    """ Cache-Control of an image """
+
+    if imagestore.BLOB_URL.search('/' + name):
+        return storage.IMMUTABLE_CACHE_CONTROL
+
+    return LEGACY_CACHE_CONTROL
+
+
+def _read_range(path, start, stop):
+    """ Stream bytes start to stop of a file """
+
+    with open(path, 'rb') as source:
+        source.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = source.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def _if_range_matches(etag, last_modified):
+    """ Whether a Range request may be answered with part of the file """
+
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return if_range.date >= last_modified
+
+    return True
+
+
+def serve_image(name):
+    """ Send an image of the local storage """
+
+    if not isinstance(storage.backend, storage.LocalStorage):
+        abort(404)
+
+    # raises NotFound for names reaching outside the folder
+    path = safe_join(os.path.abspath(storage.backend.folder), name)
+    if not os.path.isfile(path):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    response = current_app.response_class(mimetype=mimetype,
+                                          direct_passthrough=True)
+    response.headers['Cache-Control'] = cache_control(name)
+
+    mode = current_app.config.get('IMAGE_SERVING', 'app')
+    if mode == 'x-accel':
+        # nginx answers conditional and range requests itself
+        response.headers['X-Accel-Redirect'] = (
+            current_app.config.get('IMAGE_ACCEL_PREFIX', '/_images/') + name)
+        return response
+    if mode == 'x-sendfile':
+        response.headers['X-Sendfile'] = path
+        return response
+
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = '%x-%x' % (int(stat.st_mtime), size)
+    last_modified = datetime.datetime.utcfromtimestamp(int(stat.st_mtime))
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Accept-Ranges'] = 'bytes'
+
+    if not is_resource_modified(request.environ, etag, last_modified=last_modified):
+        response.status_code = 304
+        return response
+
+    if request.range is not None and _if_range_matches(etag, last_modified):
+        span = request.range.range_for_length(size)
+        if span is None:
+            response.status_code = 416
+            response.headers['Content-Range'] = 'bytes */%d' % size
+            return response
+        start, stop = span
+        response.status_code = 206
+        response.content_range = ContentRange('bytes', start, stop, size)
+        response.content_length = stop - start
+        response.response = _read_range(path, start, stop)
+        return response
+
+    response.content_length = size
+    response.response = wrap_file(request.environ, open(path, 'rb'), CHUNK_SIZE)
+    return response
+
+
+def nginx_config(app):
+    """ nginx locations serving the images, for the server block in front of
+    the app
+    Output: config(string)
+    """
+
+    folder = os.path.join(os.path.abspath(app.config.get('UPLOAD_FOLDER',
+                                                        'static/images/')), '')
+    accel_prefix = app.config.get('IMAGE_ACCEL_PREFIX', '/_images/')
+
+    return '\n'.join([
+        '# Content-addressed images never change',
+        'location ~ "^%s(?<image>[0-9a-f]{2}/[0-9a-f]{64}(-[a-z]+)?\\.[a-z]+)$" {' % URL_PREFIX,
+        '    alias %s$image;' % folder,
+        '    add_header Cache-Control "%s";' % storage.IMMUTABLE_CACHE_CONTROL,
+        '}',
+        '',
+        '# Older uploads',
+        'location %s {' % URL_PREFIX,
+        '    alias %s;' % folder,
+        '    add_header Cache-Control "%s";' % LEGACY_CACHE_CONTROL,
+        '}',
+        '',
+        '# Target of X-Accel-Redirect with IMAGE_SERVING = "x-accel"',
+        'location %s {' % accel_prefix,
+        '    internal;',
+        '    alias %s;' % folder,
+        '}',
+        '',
+        'location /static/ {',
+        '    alias %s;' % os.path.join(os.path.abspath(app.static_folder), ''),
+        '    expires 12h;',
+        '}',
+        ''])
+
+
+def init_app(app):
+    """ Add the image route to the app """
+
+    app.add_url_rule(URL_PREFIX + '<path:name>', 'serve_image', serve_image)
+
+
+if __name__ == "__main__":
+    from server import app
+
+    parser = argparse.ArgumentParser(description='Image serving helpers')
+    parser.add_argument('--nginx', action='store_true',
+                        help='print the nginx config serving the images')
+    args = parser.parse_args()
+
+    if args.nginx:
+        print nginx_config(app)
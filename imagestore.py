@@ -0,0 +1,257 @@
+"""Content-addressed store of uploaded images.
+
+Uploads used to be saved as <rescue_id>-<animal_id>.<ext>, so a photo posted
+for several animals was stored several times and a URL could show different
+bytes over time. Now every image is saved once, in the storage backend (see
+storage.py), under the key
+
+    <UPLOAD_FOLDER or S3_PREFIX>/<first 2 hex digits>/<sha256>.<ext>
+
+with an image_blobs row, and animals and rescues point their img_url at it.
+The same bytes always get the same URL, so responses for them are marked
+immutable and cached by browsers for a year (see imageserving.py), and an image uploaded again
+reuses the stored file and its resized variants.
+
+References are the img_url columns themselves. A blob nothing points at any
+more is deleted by collect_garbage(), run from cron:
+
+    python imagestore.py --gc
+
+Uploads of the same bytes and the collector can run at the same time. On
+PostgreSQL each takes a transaction-level advisory lock on the image's hash
+before touching its row or file, so a file is never deleted while another
+transaction is about to point a row at it.
+"""
+
+import argparse
+import datetime
+import hashlib
+import os
+import re
+import tempfile
+import sqlalchemy
+import images
+import model as m
+import storage
+import uploads
+
+
+# a blob is only collected once it's older than this, so an upload whose
+# row isn't committed yet isn't taken for garbage
+GC_GRACE = datetime.timedelta(hours=1)
+
+# URLs of stored images and their variants
+BLOB_URL = re.compile(r'/[0-9a-f]{2}/[0-9a-f]{64}(-[a-z]+)?\.[a-z]+$')
+
+
+def blob_key(digest, extension):
+    """ Key of the image with this content hash """
+
+    return storage.backend.key('%s/%s.%s' % (digest[:2], digest, extension))
+
+
+def _lock(digest, wait=True):
+    """ Hold the lock of one image until the transaction ends
+    Inputs: sha256(string) of the image, whether to wait for another holder
+    Output: True, or False when wait is False and another transaction holds it
+    """
+
+    if m.db.engine.dialect.name != 'postgresql':
+        # writes are serialized by the database already
+        return True
+
+    lock = sqlalchemy.func.pg_advisory_xact_lock if wait else sqlalchemy.func.pg_try_advisory_xact_lock
+    # the advisory lock takes a bigint, 60 bits of the hash fit
+    return m.db.session.execute(sqlalchemy.select([lock(int(digest[:15], 16))])).scalar() is not False
+
+
+def _add(temp_path, digest, extension):
+    """ Move a complete temporary file into the store, unless the same
+    content is already there
+    Output: ImageBlob model object, added to the session if new. Its
+    stored_file attribute tells whether this call put the file in the storage.
+    """
+
+    # until commit, the collector and other uploads of these bytes wait
+    _lock(digest)
+    blob = m.db.session.query(m.ImageBlob).get(digest)
+    if blob is not None:
+        if storage.backend.exists(blob.path):
+            os.remove(temp_path)
+            blob.stored_file = False
+        else:
+            # the collector deleted the files, then failed to commit
+            storage.backend.put(temp_path, blob.path)
+            blob.img_variants = None
+            blob.stored_file = True
+        return blob
+
+    key = blob_key(digest, extension)
+    blob = m.ImageBlob(sha256=digest, path=key, size=os.path.getsize(temp_path))
+    m.db.session.add(blob)
+    # a file without a row is left behind when a commit fails
+    if storage.backend.exists(key):
+        os.remove(temp_path)
+        blob.stored_file = False
+    else:
+        storage.backend.put(temp_path, key)
+        blob.stored_file = True
+
+    return blob
+
+
+def discard(blob):
+    """ Delete the file of a blob whose transaction was rolled back, unless
+    the file was there before or another transaction committed a row for it
+    Input: ImageBlob model object from store_upload() or store_stream()
+    Output: No output, ends the current transaction
+    """
+
+    if not getattr(blob, 'stored_file', False):
+        return
+
+    try:
+        _lock(blob.sha256)
+        if m.db.session.query(m.ImageBlob.sha256).filter(
+                m.ImageBlob.sha256 == blob.sha256).first() is None:
+            storage.backend.delete(blob.path)
+    finally:
+        m.db.session.rollback()
+
+
+def store_upload(uploaded_file, folder, extension):
+    """ Store an uploaded image
+    Inputs: uploaded file(FileStorage), local directory for temporary
+    files(string), extension(string)
+    Output: ImageBlob model object
+    """
+
+    handle, temp_path = tempfile.mkstemp(dir=folder, prefix='.upload-')
+    os.close(handle)
+    try:
+        uploads.save(uploaded_file, temp_path)
+        stream = getattr(uploaded_file, 'stream', None)
+        if isinstance(stream, uploads.UploadFile):
+            # hashed while it streamed in
+            digest = stream.sha256.hexdigest()
+        else:
+            digest = _hash_file(temp_path)
+        return _add(temp_path, digest, extension)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def store_stream(source, folder, extension):
+    """ Store an image read from a file object, e.g. a member of a zip
+    Inputs: file object, local directory for temporary files(string),
+    extension(string)
+    Output: ImageBlob model object
+    """
+
+    sha256 = hashlib.sha256()
+    handle, temp_path = tempfile.mkstemp(dir=folder, prefix='.upload-')
+    try:
+        with os.fdopen(handle, 'wb') as target:
+            for chunk in iter(lambda: source.read(uploads.CHUNK_SIZE), ''):
+                sha256.update(chunk)
+                target.write(chunk)
+        return _add(temp_path, sha256.hexdigest(), extension)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _hash_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(uploads.CHUNK_SIZE), ''):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def make_variants(key):
+    """ Make the resized variants of a stored image and store them next to it
+    Input: key(string) of the image
+    Output: dictionary like images.make_variants() with keys instead of local
+    paths, or None when Pillow isn't installed
+    """
+
+    with storage.backend.local_copy(key) as path:
+        made = images.make_variants(path)
+        if made is None:
+            return None
+
+        variants = {}
+        for name, variant in made.items():
+            variants[name] = {'width': variant['width']}
+            for fmt, pil_format, extension, options in images.FORMATS:
+                variants[name][fmt] = images.variant_path(key, name, extension)
+                storage.backend.put(variant[fmt], variants[name][fmt])
+
+    return variants
+
+
+def collect_garbage(grace=GC_GRACE):
+    """ Delete blobs that no animal or rescue points at any more
+    Input: timedelta a blob must be older than
+    Output: number of blobs deleted(int)
+    """
+
+    cutoff = datetime.datetime.utcnow() - grace
+
+    def unreferenced(query):
+        return query.filter(
+            m.ImageBlob.created_at < cutoff,
+            ~m.db.session.query(m.Animal.animal_id).filter(
+                m.Animal.img_url == m.ImageBlob.path).exists(),
+            ~m.db.session.query(m.Rescue.rescue_id).filter(
+                m.Rescue.img_url == m.ImageBlob.path).exists())
+
+    digests = [digest for digest, in unreferenced(m.db.session.query(m.ImageBlob.sha256))]
+    m.db.session.commit()
+
+    deleted = 0
+    for digest in digests:
+        try:
+            # an upload of these bytes is in progress, next run
+            if not _lock(digest, wait=False):
+                continue
+            # a row may point at it since the list was read
+            blob = unreferenced(m.db.session.query(m.ImageBlob).filter(
+                m.ImageBlob.sha256 == digest)).first()
+            if blob is None:
+                continue
+
+            # files go while the lock keeps uploads from reusing them. A
+            # crash before the commit leaves the row, which _add() repairs
+            # when the image is uploaded again and the next run deletes
+            for variant in images.load_variants(blob.img_variants).values():
+                for fmt, pil_format, extension, options in images.FORMATS:
+                    storage.backend.delete(variant[fmt])
+            storage.backend.delete(blob.path)
+            m.db.session.delete(blob)
+            m.db.session.commit()
+            deleted += 1
+        finally:
+            # releases the lock of a skipped blob
+            m.db.session.rollback()
+
+    return deleted
+
+
+if __name__ == "__main__":
+    from server import app
+
+    parser = argparse.ArgumentParser(description='Maintain the image store')
+    parser.add_argument('--db', default='postgresql:///project')
+    parser.add_argument('--gc', action='store_true',
+                        help='delete images nothing points at any more')
+    args = parser.parse_args()
+
+    m.connect_to_db(app, args.db)
+    if args.gc:
+        print "Deleted %d unreferenced images" % collect_garbage()
@@ -0,0 +1,162 @@
+"""Lightweight per-request SQL and template timing.
+
+SQLAlchemy engine events count every statement and its time against the
+current request, Flask's template signals time rendering, and at the end of
+each request the numbers are added to per-route totals kept in memory. The
+cost per request is a few time.time() calls and a dictionary update, so it
+stays on in production.
+
+Statements slower than SLOW_QUERY_THRESHOLD seconds are logged with the line
+in control.py/server.py that ran them. The totals are served as JSON from
+/_stats to logged in admins, or to anyone when STATS_ENABLED is set (for a
+server only reachable internally, e.g. while benchmarking). The peer address
+can't be trusted for this: behind a proxy every client comes from 127.0.0.1.
+
+The totals are kept per process. Under gunicorn or uWSGI each worker counts
+only the requests it served, and /_stats shows those of the worker that
+answered it (its pid is in the response).
+"""
+
+import logging
+import os
+import threading
+import time
+import traceback
+from flask import (g, request, session, jsonify, abort, has_request_context,
+                   before_render_template, template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+logger = logging.getLogger(__name__)
+
+# Files whose frames are reported as the call site of a slow query
+CALL_SITE_FILES = set(['control.py', 'server.py'])
+
+slow_query_threshold = 0.1
+
+stats_enabled = False
+
+_lock = threading.Lock()
+_stats = {}
+
+
+def _call_site():
+    """ Innermost frame of our own code that led to the current statement """
+
+    for filename, line_number, function, text in reversed(traceback.extract_stack()):
+        if os.path.basename(filename) in CALL_SITE_FILES:
+            return '%s:%s in %s()' % (os.path.basename(filename), line_number,
+                                      function)
+    return 'unknown'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_started', []).append(time.time())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    elapsed = time.time() - conn.info['query_started'].pop()
+
+    if has_request_context() and hasattr(g, 'db_queries'):
+        g.db_queries += 1
+        g.db_time += elapsed
+
+    if elapsed >= slow_query_threshold:
+        if has_request_context() and hasattr(g, 'slow_queries'):
+            g.slow_queries += 1
+        logger.warning('slow query %.1fms at %s: %s', elapsed * 1000,
+                       _call_site(), ' '.join(statement.split()))
+
+
+def _before_request():
+    g.request_started = time.time()
+    g.db_queries = 0
+    g.db_time = 0.0
+    g.render_time = 0.0
+    g.slow_queries = 0
+
+
+def _before_render(sender, template, context, **extra):
+    g.render_started = time.time()
+
+
+def _after_render(sender, template, context, **extra):
+    if hasattr(g, 'render_started'):
+        g.render_time += time.time() - g.pop('render_started')
+
+
+def _teardown_request(exception=None):
+    if not hasattr(g, 'request_started'):
+        return
+
+    route = request.url_rule.rule if request.url_rule else '(no route)'
+    elapsed = time.time() - g.request_started
+
+    with _lock:
+        stats = _stats.get(route)
+        if stats is None:
+            stats = _stats[route] = {'requests': 0, 'time': 0.0,
+                                     'db_queries': 0, 'db_time': 0.0,
+                                     'render_time': 0.0, 'slow_queries': 0,
+                                     'max_db_queries': 0}
+        stats['requests'] += 1
+        stats['time'] += elapsed
+        stats['db_queries'] += g.db_queries
+        stats['db_time'] += g.db_time
+        stats['render_time'] += g.render_time
+        stats['slow_queries'] += g.slow_queries
+        stats['max_db_queries'] = max(stats['max_db_queries'], g.db_queries)
+
+
+def snapshot():
+    """ Copy of the per-route totals
+    Output: dictionary of route -> dictionary of counters
+    """
+
+    with _lock:
+        return dict((route, dict(stats)) for route, stats in _stats.items())
+
+
+def reset():
+    """ Forget all totals """
+
+    with _lock:
+        _stats.clear()
+
+
+def stats_view():
+    """ Per-route totals and averages as JSON """
+
+    if not stats_enabled and 'current_admin' not in session:
+        abort(404)
+
+    routes = snapshot()
+    for stats in routes.values():
+        requests = float(stats['requests'])
+        stats['avg_ms'] = round(1000 * stats['time'] / requests, 2)
+        stats['avg_db_queries'] = round(stats['db_queries'] / requests, 2)
+        stats['avg_db_ms'] = round(1000 * stats['db_time'] / requests, 2)
+        stats['avg_render_ms'] = round(1000 * stats['render_time'] / requests, 2)
+
+    return jsonify(routes=routes, pid=os.getpid())
+
+
+def init_app(app):
+    """ Hook the request timing into a Flask app and add the /_stats route """
+
+    global slow_query_threshold, stats_enabled
+
+    slow_query_threshold = app.config.get('SLOW_QUERY_THRESHOLD',
+                                          slow_query_threshold)
+    stats_enabled = app.config.get('STATS_ENABLED', stats_enabled)
+
+    app.before_request(_before_request)
+    app.teardown_request(_teardown_request)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+    app.add_url_rule('/_stats', 'instrumentation_stats', stats_view)
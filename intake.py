@@ -0,0 +1,317 @@
+"""Bulk animal intake from CSV or JSON files.
+
+Shelters send spreadsheets of hundreds of animals at a time. Rows are read
+as a stream, validated against the reference tables in memory (lookups.py)
+and written with one multi-row INSERT per batch, so a file of thousands of
+animals costs a handful of round trips instead of one form post each.
+
+Each row has the columns:
+    name, gender, age, size, breed, bio, is_adopted, is_visible, photo
+where gender/age/size/breed are labels as shown on the admin form and photo
+is the name of a file inside the optional zip of photos.
+
+Run from the command line:
+    python intake.py animals.csv --rescue-id 3 --photos photos.zip
+"""
+
+import argparse
+import csv
+import datetime
+import json
+import time
+import zipfile
+import sqlalchemy
+import cache
+import imagestore
+import jobs
+import model as m
+import control as c
+import lookups
+
+
+BATCH_SIZE = 1000
+
+PHOTO_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
+
+TRUE_VALUES = set(['t', 'true', 'y', 'yes', '1'])
+
+
+class RowError(ValueError):
+    """ Raised for a row that can't be imported, the message goes in the report """
+
+
+def _message(e):
+    """ Text of an exception for the report, its message may be unicode or
+    utf-8 bytes (a label read from a CSV file)
+    """
+
+    try:
+        return unicode(e)
+    except UnicodeError:
+        return str(e).decode('utf-8', 'replace')
+
+
+def read_csv(fileobj):
+    """ Stream rows from a CSV file with a header line
+    Input: file object
+    Output: generator of dictionaries
+    """
+
+    for row in csv.DictReader(fileobj):
+        yield row
+
+
+def read_json(fileobj):
+    """ Stream rows from a JSON file. Either one object per line (JSON lines,
+    read one line at a time) or a single array of objects. Text that isn't
+    JSON is yielded as a RowError in place of its row, so the import reports
+    it and goes on with the next line.
+    Input: file object
+    Output: generator of dictionaries (or RowErrors)
+    """
+
+    first = fileobj.read(1)
+    while first.isspace():
+        first = fileobj.read(1)
+
+    if first == '[':
+        # a single array can't be parsed incrementally with the json module
+        try:
+            rows = json.loads(first + fileobj.read())
+        except ValueError as e:
+            yield RowError('the file is not valid JSON: %s' % e)
+            return
+        for row in rows:
+            yield row
+        return
+
+    line_number = 1
+    line = first + fileobj.readline()
+    while line:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                yield RowError('line %d is not valid JSON: %s' % (line_number, e))
+        line_number += 1
+        line = fileobj.readline()
+
+
+def read_rows(fileobj, filename):
+    """ Pick the reader from the file's extension
+    Inputs: file object, filename(string)
+    Output: generator of dictionaries
+    """
+
+    if filename.lower().endswith('.csv'):
+        return read_csv(fileobj)
+    elif filename.lower().rsplit('.', 1)[-1] in ('json', 'jsonl'):
+        return read_json(fileobj)
+
+    raise RowError('%s is not a .csv, .json or .jsonl file' % filename)
+
+
+def _lookup(kind, label, default=None):
+    """ Resolve a label to its id, blank labels get the default label """
+
+    label = (label or '').strip() or default
+    if label is None:
+        return None
+
+    lookup_id = lookups.get_id(kind, label)
+    if lookup_id is None:
+        raise RowError('unknown %s "%s"' % (kind, label))
+
+    return lookup_id
+
+
+def _flag(value, default):
+    """ Parse a yes/no column, blank means the default """
+
+    value = ('%s' % value).strip().lower() if value is not None else ''
+    if value == '':
+        return default
+
+    return value in TRUE_VALUES
+
+
+def _column_default(column):
+    """ Python side default of an Animal column, multi-row INSERTs need every
+    row to spell out every column
+    """
+
+    default = m.Animal.__table__.c[column].default
+    return default.arg if default is not None else None
+
+
+def build_row(row, rescue_id):
+    """ Validate one input row and turn it into animals table values
+    Inputs: dictionary from a reader, id(int) of the rescue
+    Output: dictionary of column values
+    """
+
+    if not isinstance(row, dict):
+        raise RowError('row is not an object')
+
+    name = (row.get('name') or '').strip()
+    if not name:
+        raise RowError('name is required')
+
+    return {
+        'name': name.title(),
+        'rescue_id': rescue_id,
+        'gender_id': _lookup('gender', row.get('gender'), 'Unknown'),
+        'age_id': _lookup('age', row.get('age'), 'Unknown'),
+        'size_id': _lookup('size', row.get('size'), 'Unknown'),
+        'breed_id': _lookup('breed', row.get('breed')),
+        'bio': (row.get('bio') or '').strip() or _column_default('bio'),
+        'is_adopted': _flag(row.get('is_adopted'), False),
+        'is_visible': _flag(row.get('is_visible'), True),
+        'img_url': _column_default('img_url'),
+        'img_variants': None,
+    }
+
+
+def _extract_photo(photos, member, upload_folder):
+    """ Copy one photo out of the zip into the image store
+    Output: ImageBlob model object
+    """
+
+    if not c.allowed_file(member, PHOTO_EXTENSIONS):
+        raise RowError('photo %s is not an image' % member)
+    try:
+        info = photos.getinfo(member)
+    except KeyError:
+        raise RowError('photo %s is not in the zip' % member)
+
+    extension = member.rsplit('.', 1)[1].lower()
+    with photos.open(info) as source:
+        blob = imagestore.store_stream(source, upload_folder, extension)
+
+    return blob
+
+
+def _insert_batch(batch, report):
+    """ Write one batch of (row number, values, ImageBlob of a newly stored
+    photo or None) in one INSERT
+    """
+
+    if not batch:
+        return
+
+    blobs = dict((blob.sha256, blob) for row_number, values, blob in batch if blob)
+    try:
+        m.db.session.execute(m.Animal.__table__.insert().values(
+            [values for row_number, values, blob in batch]))
+        # new photos are resized in the background, see jobs.py. Ones stored
+        # before already have their variants or a job making them
+        for blob in blobs.values():
+            jobs.enqueue('image_variants', path=blob.path)
+        m.db.session.commit()
+        report['inserted'] += len(batch)
+    except Exception as e:
+        for row_number, values, blob in batch:
+            report['errors'].append({'row': row_number, 'error': _message(e)})
+        _discard_batch(batch)
+
+
+def _discard_batch(batch):
+    """ Roll back a batch and delete the photos it newly stored """
+
+    m.db.session.rollback()
+    # the files are in the storage backend, local or not
+    for blob in set(blob for row_number, values, blob in batch if blob):
+        imagestore.discard(blob)
+
+
+def import_animals(rows, rescue_id, upload_folder, photos=None,
+                   batch_size=BATCH_SIZE):
+    """ Import animals for one rescue
+    Inputs: iterable of row dictionaries (see read_rows), id(int) of the
+    rescue, upload directory path(string), zipfile.ZipFile of photos or None,
+    rows per INSERT(int)
+    Output: report dictionary with the number of animals inserted, the per
+    row errors (row numbers start at 1) and the time taken
+    """
+
+    started = time.time()
+    report = {'inserted': 0, 'errors': []}
+
+    try:
+        _import_rows(rows, rescue_id, upload_folder, photos, batch_size, report)
+    finally:
+        # also when reading the file failed half way, the committed batches
+        # are on the rescue's page
+        if report['inserted']:
+            m.db.session.query(m.Rescue).filter(m.Rescue.rescue_id == rescue_id).update(
+                {'updated_at': datetime.datetime.utcnow()}, synchronize_session=False)
+            m.db.session.commit()
+        cache.delete(cache.rescue_page_key(rescue_id))
+
+    report['seconds'] = round(time.time() - started, 3)
+    return report
+
+
+def _import_rows(rows, rescue_id, upload_folder, photos, batch_size, report):
+    """ Validate and insert the rows in batches, counting them in report """
+
+    batch = []
+    try:
+        for row_number, row in enumerate(rows, 1):
+            new_blob = None
+            try:
+                if isinstance(row, RowError):
+                    raise row
+                values = build_row(row, rescue_id)
+                if photos is not None and row.get('photo'):
+                    blob = _extract_photo(photos, row['photo'], upload_folder)
+                    values['img_url'] = blob.path
+                    values['img_variants'] = blob.img_variants
+                    # a new row, or a stored file its row lost
+                    if sqlalchemy.inspect(blob).pending or blob.stored_file:
+                        new_blob = blob
+            except RowError as e:
+                report['errors'].append({'row': row_number, 'error': _message(e)})
+                continue
+
+            batch.append((row_number, values, new_blob))
+            if len(batch) >= batch_size:
+                _insert_batch(batch, report)
+                batch = []
+    except Exception:
+        # e.g. a broken CSV file: the batch being read is dropped
+        _discard_batch(batch)
+        raise
+
+    _insert_batch(batch, report)
+
+
+def import_file(path, rescue_id, upload_folder, photos_path=None):
+    """ Import a CSV/JSON file from disk, with an optional zip of photos
+    Output: report dictionary, see import_animals
+    """
+
+    photos = zipfile.ZipFile(photos_path) if photos_path else None
+    try:
+        with open(path, 'rb') as fileobj:
+            return import_animals(read_rows(fileobj, path), rescue_id,
+                                  upload_folder, photos)
+    finally:
+        if photos is not None:
+            photos.close()
+
+
+if __name__ == "__main__":
+    from server import app
+
+    parser = argparse.ArgumentParser(description='Bulk import animals for a rescue')
+    parser.add_argument('path', help='CSV, JSON or JSON lines file of animals')
+    parser.add_argument('--rescue-id', type=int, required=True)
+    parser.add_argument('--photos', help='zip of the photos named in the photo column')
+    parser.add_argument('--upload-folder', default='static/images/')
+    parser.add_argument('--db', default='postgresql:///project')
+    args = parser.parse_args()
+
+    m.connect_to_db(app, args.db)
+    print json.dumps(import_file(args.path, args.rescue_id, args.upload_folder,
+                                 args.photos), indent=2)
@@ -0,0 +1,197 @@
+"""Background jobs kept in the database.
+
+Slow work that follows a write, like resizing an uploaded photo, is queued
+as a row of the jobs table in the same transaction as the write, so a job
+exists exactly when the row it works on does and the request returns as soon
+as it commits. One or more worker processes run the jobs:
+
+    python jobs.py              # keeps polling for work
+    python jobs.py --burst      # runs what is queued, then exits
+    python jobs.py --status     # number of jobs in each status
+
+A worker claims a job with a conditional UPDATE, so any number of workers
+can share the table without locking each other out. A job whose handler
+raises is retried with exponential backoff until it runs out of attempts
+and is marked failed with the error kept in last_error. Jobs left running
+by a worker that died are queued again after STALE_AFTER.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import socket
+import time
+import traceback
+import sqlalchemy
+import model as m
+
+
+logger = logging.getLogger(__name__)
+
+# seconds before the first retry, doubled for every attempt after it
+RETRY_DELAY = 30
+
+# a running job that hasn't finished after this long is assumed abandoned
+STALE_AFTER = datetime.timedelta(minutes=15)
+
+HANDLERS = {}
+
+
+def handler(name):
+    """ Decorator registering a function as the handler of a kind of job. It
+    is called with the job's payload as keyword arguments.
+    """
+
+    def decorator(function):
+        HANDLERS[name] = function
+        return function
+    return decorator
+
+
+def enqueue(name, max_attempts=5, **payload):
+    """ Queue a job in the current transaction, it is committed with the
+    caller's own writes
+    Inputs: name(string) of a registered handler, keyword arguments for it
+    (must be JSON serialisable)
+    Output: Job model object
+    """
+
+    job = m.Job(name=name, payload=json.dumps(payload),
+                max_attempts=max_attempts)
+    m.db.session.add(job)
+
+    return job
+
+
+def worker_name():
+    """ Identifies this worker process in locked_by """
+
+    return '%s:%s' % (socket.gethostname(), os.getpid())
+
+
+def claim(worker):
+    """ Take the oldest job that is due
+    Input: worker name(string)
+    Output: Job model object now running, or None when nothing is due
+    """
+
+    while True:
+        now = datetime.datetime.utcnow()
+        job_id = m.db.session.query(m.Job.job_id).filter(
+            m.Job.status == 'queued', m.Job.run_after <= now).order_by(
+            m.Job.run_after, m.Job.job_id).limit(1).scalar()
+        if job_id is None:
+            m.db.session.commit()
+            return None
+
+        # only one worker's UPDATE still finds the job queued
+        claimed = m.db.session.query(m.Job).filter(
+            m.Job.job_id == job_id, m.Job.status == 'queued').update(
+            {'status': 'running', 'attempts': m.Job.attempts + 1,
+             'locked_by': worker, 'locked_at': now},
+            synchronize_session=False)
+        m.db.session.commit()
+        if claimed:
+            return m.db.session.query(m.Job).get(job_id)
+
+
+def run(job):
+    """ Run a claimed job and record how it went
+    Input: Job model object
+    Output: status(string) the job ended up in
+    """
+
+    try:
+        function = HANDLERS[job.name]
+        function(**json.loads(job.payload))
+    except Exception:
+        m.db.session.rollback()
+        job.last_error = traceback.format_exc()
+        if job.attempts < job.max_attempts:
+            job.status = 'queued'
+            job.run_after = datetime.datetime.utcnow() + datetime.timedelta(
+                seconds=RETRY_DELAY * 2 ** (job.attempts - 1))
+        else:
+            job.status = 'failed'
+        logger.warning('job %s (%s) failed, attempt %s of %s', job.job_id,
+                       job.name, job.attempts, job.max_attempts)
+    else:
+        job.status = 'done'
+        job.last_error = None
+
+    job.locked_by = None
+    job.locked_at = None
+    m.db.session.commit()
+
+    return job.status
+
+
+def requeue_stale():
+    """ Queue jobs again whose worker stopped before finishing them
+    Output: number of jobs queued again(int)
+    """
+
+    count = m.db.session.query(m.Job).filter(
+        m.Job.status == 'running',
+        m.Job.locked_at < datetime.datetime.utcnow() - STALE_AFTER).update(
+        {'status': 'queued', 'locked_by': None, 'locked_at': None},
+        synchronize_session=False)
+    m.db.session.commit()
+
+    return count
+
+
+def status_counts():
+    """ Number of jobs in each status
+    Output: dictionary of status -> count
+    """
+
+    return dict(m.db.session.query(m.Job.status, sqlalchemy.func.count(
+        m.Job.job_id)).group_by(m.Job.status).all())
+
+
+def work(burst=False, poll=1.0):
+    """ Run jobs until stopped, or with burst=True until none are due
+    Output: number of jobs run(int)
+    """
+
+    worker = worker_name()
+    count = 0
+    requeue_stale()
+    while True:
+        job = claim(worker)
+        if job is None:
+            if burst:
+                return count
+            time.sleep(poll)
+            requeue_stale()
+            continue
+        run(job)
+        count += 1
+        m.db.session.remove()
+
+
+if __name__ == "__main__":
+    # registers the job handlers
+    from server import app
+
+    parser = argparse.ArgumentParser(description='Run background jobs')
+    parser.add_argument('--db', default='postgresql:///project')
+    parser.add_argument('--burst', action='store_true',
+                        help='exit once no jobs are due')
+    parser.add_argument('--poll', type=float, default=1.0,
+                        help='seconds between looks for new jobs')
+    parser.add_argument('--status', action='store_true',
+                        help='print the number of jobs in each status and exit')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    m.connect_to_db(app, args.db)
+
+    if args.status:
+        for status, count in sorted(status_counts().items()):
+            print "%-8s %d" % (status, count)
+    else:
+        print "Ran %d jobs" % work(args.burst, args.poll)
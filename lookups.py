@@ -0,0 +1,167 @@
+"""Process-wide cache of the reference tables animals point at.
+
+Genders, ages, sizes, breeds and species are a few dozen rows that only
+change when the database is seeded, yet every upload looked them up by label
+and every animal detail page joined all of them. They are loaded once per
+process into two dictionaries per table (label -> id and id -> label).
+
+A commit that wrote one of the tables through the ORM (or a call to
+invalidate(), e.g. after seeding) drops this process's copy and stores a new
+version under VERSION_KEY in the cache backend (see cache.py). Every process
+compares its copy's version with that one at most every VERSION_CHECK_INTERVAL
+seconds, so with the Redis backend all workers reload within seconds. With
+the per-process memory backend other workers only notice when their copy is
+LOOKUP_TTL seconds old.
+"""
+
+import threading
+import time
+import uuid
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+import cache
+import model as m
+
+
+# kind: (model class, id column name, label column name)
+TABLES = {
+    'gender': (m.Gender, 'gender_id', 'gender_type'),
+    'age': (m.Age, 'age_id', 'age_category'),
+    'size': (m.Size, 'size_id', 'size_category'),
+    'breed': (m.Breed, 'breed_id', 'breed_type'),
+    'species': (m.Species, 'species_id', 'species_type'),
+}
+
+# seconds a loaded copy is used at most
+LOOKUP_TTL = 300
+
+VERSION_KEY = 'lookups:version'
+VERSION_CHECK_INTERVAL = 5
+# kept well past LOOKUP_TTL, a lost version only causes one reload
+VERSION_TTL = 86400
+
+_lock = threading.Lock()
+_ids = None
+_labels = None
+_version = None
+_loaded_at = 0
+_checked_at = 0
+
+
+def _shared_version():
+    if cache.backend is None:
+        return None
+
+    return cache.backend.get(VERSION_KEY)
+
+
+def load():
+    """ (Re)load every reference table into memory
+    Output: No output, fills the module level dictionaries
+    """
+
+    global _ids, _labels, _version, _loaded_at, _checked_at
+
+    # read first, a change committed while loading makes the next check reload
+    version = _shared_version()
+    ids = {}
+    labels = {}
+    for kind, (model, id_name, label_name) in TABLES.items():
+        id_column = getattr(model, id_name)
+        label_column = getattr(model, label_name)
+        ids[kind] = {}
+        labels[kind] = {}
+        for lookup_id, label in m.db.session.query(id_column, label_column).order_by(id_column):
+            # labels aren't unique (breeds repeat "Mixed breed"), keep the
+            # lowest id like the old .first() lookups did
+            ids[kind].setdefault(label, lookup_id)
+            labels[kind][lookup_id] = label
+
+    with _lock:
+        _ids, _labels, _version = ids, labels, version
+        _loaded_at = _checked_at = time.time()
+
+
+def invalidate():
+    """ Drop the cached tables so the next lookup reloads them, in this
+    process and, through the cache backend, in the others
+    """
+
+    global _ids, _labels
+
+    if cache.backend is not None:
+        cache.backend.set(VERSION_KEY, uuid.uuid4().hex, VERSION_TTL)
+    with _lock:
+        _ids = _labels = None
+
+
+def _is_stale():
+    """ Whether the loaded copy is too old or another process changed the
+    tables since it was loaded
+    """
+
+    global _checked_at
+
+    now = time.time()
+    if now - _loaded_at > LOOKUP_TTL:
+        return True
+    if now - _checked_at > VERSION_CHECK_INTERVAL:
+        _checked_at = now
+        return _shared_version() != _version
+
+    return False
+
+
+def _tables():
+    """ Return the cached dictionaries, loading them on first use """
+
+    ids, labels = _ids, _labels
+    if ids is None or labels is None or _is_stale():
+        load()
+        ids, labels = _ids, _labels
+
+    return ids, labels
+
+
+def get_id(kind, label):
+    """ Resolve a label to its id
+    Inputs: kind(string) one of TABLES, label(string) e.g. 'Female'
+    Output: id(int) or None if there is no such label
+    """
+
+    return _tables()[0][kind].get(label)
+
+
+def get_label(kind, lookup_id):
+    """ Resolve an id to its label
+    Inputs: kind(string) one of TABLES, id(int)
+    Output: label(string) or None if there is no such id
+    """
+
+    return _tables()[1][kind].get(lookup_id)
+
+
+def _written(mapper, connection, target):
+    # only takes effect once committed, a rolled back row was never there
+    object_session(target).info['lookups_written'] = True
+
+
+for _model, _id_name, _label_name in TABLES.values():
+    for _event in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_model, _event, _written)
+
+
+@event.listens_for(Session, 'after_commit')
+def _committed(session):
+    if session.info.pop('lookups_written', False):
+        invalidate()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _rolled_back(session):
+    global _ids, _labels
+
+    if session.info.pop('lookups_written', False):
+        # a load in the transaction may have read the rolled back rows
+        with _lock:
+            _ids = _labels = None
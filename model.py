@@ -1,7 +1,19 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.schema import CreateColumn, CreateIndex, DDL
+import datetime
+import sqlalchemy
+import replicas
 
 
-db = SQLAlchemy()
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy whose sessions can read from replicas """
+
+    def create_session(self, options):
+        return replicas.RoutingSession(self, **options)
+
+
+db = RoutingSQLAlchemy()
 
 
 ##############################################################################
@@ -29,7 +41,7 @@ class Breed(db.Model):
 
     breed_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     breed_type = db.Column(db.String(50), nullable=True)
-    species_id = db.Column(db.Integer, db.ForeignKey('species.species_id'), nullable=True)
+    species_id = db.Column(db.Integer, db.ForeignKey('species.species_id'), nullable=True, index=True)
 
     species = db.relationship('Species', backref=db.backref("breeds", order_by=breed_id))
 
@@ -97,6 +109,17 @@ class Rescue(db.Model):
     address = db.Column(db.String(200), nullable=True)
     email = db.Column(db.String(64), nullable=True)
     img_url = db.Column(db.String(300), nullable=True, default='static/images/GPR.png')
+    # JSON of the resized copies of img_url, see images.py
+    img_variants = db.Column(db.Text, nullable=True)
+    # Geocoded from the address, see geo.py. NULL when the address isn't in
+    # the geocoding table.
+    latitude = db.Column(db.Float, nullable=True)
+    longitude = db.Column(db.Float, nullable=True)
+    geohash = db.Column(db.String(12), nullable=True)
+    # Bumped by any write that changes the rescue's page, including adding
+    # animals to it. Used for ETag/Last-Modified.
+    updated_at = db.Column(db.DateTime, nullable=True, default=datetime.datetime.utcnow,
+                           onupdate=datetime.datetime.utcnow)
 
     def __repr__(self):
         """Provide helpful representation when printed."""
@@ -111,9 +134,9 @@ class Admin(db.Model):
     __tablename__ = 'admins'
 
     admin_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
-    email = db.Column(db.String(64), nullable=True)
+    email = db.Column(db.String(64), nullable=True, unique=True, index=True)
     password = db.Column(db.String(64), nullable=True)
-    rescue_id = db.Column(db.Integer, db.ForeignKey('rescues.rescue_id'), nullable=True)  # just a number, not an object!
+    rescue_id = db.Column(db.Integer, db.ForeignKey('rescues.rescue_id'), nullable=True, index=True)  # just a number, not an object!
 
     def __repr__(self):
         """Provide helpful representation when printed."""
@@ -131,15 +154,23 @@ class Animal(db.Model):
 
     animal_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     img_url = db.Column(db.String(300), nullable=True, default='static/images/dog.png')
+    # JSON of the resized copies of img_url, see images.py
+    img_variants = db.Column(db.Text, nullable=True)
     name = db.Column(db.String(40), nullable=True)
     bio = db.Column(db.Text, nullable=True, default='Loving and very sweet. Looking for furever home!')
     is_adopted = db.Column(db.Boolean, nullable=True, default=False)  # will be a True or False
     is_visible = db.Column(db.Boolean, nullable=True, default=True)  # will be a True or False
-    rescue_id = db.Column(db.Integer, db.ForeignKey('rescues.rescue_id'), nullable=True)
-    gender_id = db.Column(db.Integer, db.ForeignKey('genders.gender_id'), nullable=True)
-    age_id = db.Column(db.Integer, db.ForeignKey('ages.age_id'), nullable=True)
-    size_id = db.Column(db.Integer, db.ForeignKey('sizes.size_id'), nullable=True)
-    breed_id = db.Column(db.Integer, db.ForeignKey('breeds.breed_id'), nullable=True)
+    rescue_id = db.Column(db.Integer, db.ForeignKey('rescues.rescue_id'), nullable=True, index=True)
+    gender_id = db.Column(db.Integer, db.ForeignKey('genders.gender_id'), nullable=True, index=True)
+    age_id = db.Column(db.Integer, db.ForeignKey('ages.age_id'), nullable=True, index=True)
+    size_id = db.Column(db.Integer, db.ForeignKey('sizes.size_id'), nullable=True, index=True)
+    breed_id = db.Column(db.Integer, db.ForeignKey('breeds.breed_id'), nullable=True, index=True)
+    updated_at = db.Column(db.DateTime, nullable=True, default=datetime.datetime.utcnow,
+                           onupdate=datetime.datetime.utcnow)
+    # Full-text search document of name and bio, kept up to date by the
+    # ANIMAL_SEARCH_TRIGGER below on PostgreSQL and left empty elsewhere
+    search_vector = db.Column(db.Text().with_variant(TSVECTOR(), 'postgresql'),
+                              nullable=True)
 
     # Defining relationships
     # point to the Rescue class and load multiple of those. backref is a simple way to declare a new property on the Rescue class
@@ -155,19 +186,202 @@ class Animal(db.Model):
                                                   self.name)
 
 
+class ImageBlob(db.Model):
+    """ Uploaded image stored once under the hash of its content, see
+    imagestore.py. Rows use it through their img_url.
+    """
+
+    __tablename__ = 'image_blobs'
+
+    sha256 = db.Column(db.String(64), primary_key=True)
+    path = db.Column(db.String(300), nullable=False, unique=True)
+    size = db.Column(db.Integer, nullable=True)
+    # JSON of the resized copies, made once per blob, see images.py
+    img_variants = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        """Provide helpful representation when printed."""
+
+        return '<ImageBlob sha256=%s path=%s>' % (self.sha256, self.path)
+
+
+class Job(db.Model):
+    """ Background work queued by requests and run by jobs.py workers """
+
+    __tablename__ = 'jobs'
+
+    job_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    name = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False)  # JSON keyword arguments
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done or failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    locked_by = db.Column(db.String(100), nullable=True)
+    locked_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=True, default=datetime.datetime.utcnow,
+                           onupdate=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        """Provide helpful representation when printed."""
+
+        return '<Job job_id=%s name=%s status=%s>' % (self.job_id, self.name,
+                                                      self.status)
+
+
+# Workers look for the oldest queued job that is due
+db.Index('ix_jobs_ready', Job.status, Job.run_after)
+
+
+# Animals that show up on a rescue's page. Queries for available animals must
+# filter with this exact expression so the planner can match them to the
+# partial index below.
+ANIMAL_IS_AVAILABLE = db.and_(Animal.is_adopted == False,
+                              Animal.is_visible == True)
+
+# Rescue pages seek through available animals by (rescue_id, animal_id); the
+# index only holds available animals so it stays small as adoptions pile up
+db.Index('ix_animals_available', Animal.rescue_id, Animal.animal_id,
+         postgresql_where=ANIMAL_IS_AVAILABLE,
+         sqlite_where=ANIMAL_IS_AVAILABLE)
+
+# Nearby searches look up geohash prefixes with LIKE 'prefix%', which only
+# uses a PostgreSQL index with the pattern operator class
+db.Index('ix_rescues_geohash', Rescue.geohash,
+         postgresql_ops={'geohash': 'varchar_pattern_ops'})
+
+# Search only looks at available animals too, see search.py
+db.Index('ix_animals_search', Animal.search_vector,
+         postgresql_using='gin', postgresql_where=ANIMAL_IS_AVAILABLE)
+
+# Names weigh more than bios when ranking. A trigger rather than app code so
+# bulk intake, COPY in seed.py and manual SQL keep the vectors right too.
+ANIMAL_SEARCH_TRIGGER = DDL("""
+CREATE OR REPLACE FUNCTION animals_search_vector() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('english', coalesce(NEW.name, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(NEW.bio, '')), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS animals_search_vector ON animals;
+
+CREATE TRIGGER animals_search_vector BEFORE INSERT OR UPDATE OF name, bio
+    ON animals FOR EACH ROW EXECUTE PROCEDURE animals_search_vector();
+""").execute_if(dialect='postgresql')
+
+sqlalchemy.event.listen(Animal.__table__, 'after_create', ANIMAL_SEARCH_TRIGGER)
 
 
 ##############################################################################
 # Helper functions
 
+# Connection pool of each worker process, for server databases. Every key
+# can be overridden in the app's config.
+POOL_DEFAULTS = {
+    'SQLALCHEMY_POOL_SIZE': 10,
+    'SQLALCHEMY_MAX_OVERFLOW': 20,
+    'SQLALCHEMY_POOL_TIMEOUT': 10,
+    # below the server's and any proxy's idle timeout
+    'SQLALCHEMY_POOL_RECYCLE': 1800,
+    # test connections as they leave the pool, so a restarted database or a
+    # dropped idle connection costs a reconnect rather than a 500
+    'SQLALCHEMY_POOL_PRE_PING': True,
+}
+
+
+def _ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """ Pool checkout listener: raising DisconnectionError makes the pool
+    drop the connection and check out a fresh one
+    """
+
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        raise sqlalchemy.exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
 def connect_to_db(app, db_uri='postgresql:///project'):
     """Connect the database to our Flask app."""
 
     # Configure to use our PstgreSQL database
     app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
+    # SQLite files get no pool
+    if not db_uri.startswith('sqlite'):
+        for key, value in POOL_DEFAULTS.items():
+            app.config.setdefault(key, value)
     db.app = app
     db.init_app(app)
 
+    # read only queries go to these when set, see replicas.py
+    pool_options = {}
+    if not db_uri.startswith('sqlite'):
+        pool_options = {'pool_size': app.config['SQLALCHEMY_POOL_SIZE'],
+                        'max_overflow': app.config['SQLALCHEMY_MAX_OVERFLOW'],
+                        'pool_timeout': app.config['SQLALCHEMY_POOL_TIMEOUT'],
+                        'pool_recycle': app.config['SQLALCHEMY_POOL_RECYCLE']}
+    replicas.configure(app.config.get('SQLALCHEMY_REPLICA_URIS') or [], **pool_options)
+
+    if app.config.get('SQLALCHEMY_POOL_PRE_PING'):
+        for engine in [db.get_engine(app)] + replicas.engines():
+            sqlalchemy.event.listen(engine.pool, 'checkout', _ping_connection)
+
+
+def dispose_engines():
+    """ Drop every pooled connection. A forked worker must call it before
+    using the database, sockets opened by the parent can't be shared.
+    """
+
+    db.get_engine(db.get_app()).dispose()
+    replicas.dispose()
+
+
+def upgrade_db():
+    """Bring an existing database up to date with the models.
+
+    create_all() skips tables that already exist, so columns and indexes
+    added to the models later are created here. New columns are added as
+    nullable. On PostgreSQL indexes are built CONCURRENTLY so a big animals
+    table keeps taking writes while the index builds.
+    """
+
+    db.create_all()
+
+    engine = db.engine
+    inspector = sqlalchemy.inspect(engine)
+    for table in db.metadata.sorted_tables:
+        columns = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in columns:
+                engine.execute('ALTER TABLE %s ADD COLUMN %s' % (
+                    table.name, CreateColumn(column).compile(dialect=engine.dialect)))
+
+        if table is Animal.__table__ and engine.dialect.name == 'postgresql':
+            ANIMAL_SEARCH_TRIGGER.execute(engine, table)
+            # the trigger fills in rows written before it existed
+            engine.execute('UPDATE animals SET name = name WHERE search_vector IS NULL')
+
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            ddl = str(CreateIndex(index).compile(dialect=engine.dialect))
+            if engine.dialect.name == 'postgresql':
+                ddl = ddl.replace(' INDEX ', ' INDEX CONCURRENTLY ', 1)
+                # CONCURRENTLY can't run inside a transaction block
+                with engine.connect() as conn:
+                    conn.execution_options(isolation_level='AUTOCOMMIT').execute(ddl)
+            else:
+                engine.execute(ddl)
+
 
 if __name__ == "__main__":
     # As a convenience, if we run this module interactively, it will leave
@@ -175,5 +389,5 @@ if __name__ == "__main__":
 
     from server import app
     connect_to_db(app)
-    db.create_all()
+    upgrade_db()
     print "Connected to DB."
@@ -0,0 +1,66 @@
+"""Keyset (cursor) pagination shared by the animal list pages.
+
+Instead of LIMIT/OFFSET, every page is fetched with a seek on an indexed,
+unique column (``WHERE column > last_seen ORDER BY column LIMIT n``), so the
+database jumps straight to the start of the page no matter how deep the
+client has scrolled. The last key of a page is handed to the client as an
+opaque cursor string.
+"""
+
+import base64
+
+
+PAGE_SIZE = 10
+
+
+class InvalidCursor(ValueError):
+    """ Raised when a client sends a cursor we did not issue """
+
+
+def encode_cursor(key):
+    """ Turn the last seen key of a page into an opaque cursor
+    Input: key(int) of the last row on a page
+    Output: url-safe cursor(string)
+    """
+
+    return base64.urlsafe_b64encode(str(int(key))).rstrip('=')
+
+
+def decode_cursor(cursor):
+    """ Turn a cursor back into the key it was made from
+    Input: cursor(string) as returned by encode_cursor, or None/empty
+    Output: key(int) or None when there is no cursor
+    """
+
+    if not cursor:
+        return None
+
+    cursor = str(cursor)
+    padding = '=' * (-len(cursor) % 4)
+    try:
+        return int(base64.urlsafe_b64decode(cursor + padding))
+    except (TypeError, ValueError):
+        raise InvalidCursor(cursor)
+
+
+def seek(query, column, cursor=None, limit=PAGE_SIZE):
+    """ Fetch one page of a query using keyset pagination
+    Inputs: SQLAlchemy query, unique column to seek on, cursor(string) of the
+    previous page or None for the first page, page size(int)
+    Output: tuple of (list of rows, cursor(string) of the next page or None
+    when this is the last page)
+    """
+
+    after = decode_cursor(cursor)
+    if after is not None:
+        query = query.filter(column > after)
+
+    # Ask for one extra row to find out if there is a next page
+    rows = query.order_by(column).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(getattr(rows[-1], column.key))
+
+    return rows, next_cursor
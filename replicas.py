@@ -0,0 +1,215 @@
+"""Read replicas for the public pages' queries.
+
+Every query used to go to the primary database. With
+SQLALCHEMY_REPLICA_URIS set to a list of replica URIs, the SELECTs of code
+marked read only (the control.py getters decorated with @read_only, or a
+``with reading():`` block) go to a replica instead, so browsing scales by
+adding replicas. Everything else still uses the primary:
+
+    - writes, and reads in a transaction that has already written
+    - reads while a replica is more than MAX_LAG seconds behind; lag is
+      checked at most every LAG_CHECK_INTERVAL seconds per replica, a replica
+      that can't be reached counts as lagging
+    - reads by a visitor whose own write was committed less than MAX_LAG
+      seconds ago, tracked in their session cookie, so an admin sees the
+      animal they just added
+    - reads in an ``on_primary()`` block, e.g. rendering a page that is about
+      to be cached (see cache.cached_page)
+
+Replicas are picked at random among the healthy ones. For a local test, run
+a second PostgreSQL as a streaming replica of the first (pg_basebackup -R)
+and set SQLALCHEMY_REPLICA_URIS = ['postgresql://localhost:5433/project'].
+"""
+
+from contextlib import contextmanager
+from functools import wraps
+import logging
+import random
+import threading
+import time
+import flask
+from flask_sqlalchemy import SignallingSession
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.expression import SelectBase
+
+
+logger = logging.getLogger(__name__)
+
+# seconds a replica may be behind, and the primary is used after a write
+MAX_LAG = 5
+
+LAG_CHECK_INTERVAL = 5
+
+STICKY_KEY = 'primary_until'
+
+# seconds behind the primary, 0 on a primary or a replica that has replayed
+# everything it received (its replay timestamp stays old while the primary
+# is idle)
+LAG_QUERY = """
+SELECT CASE WHEN NOT pg_is_in_recovery()
+                 OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+       END
+"""
+
+
+class Replica(object):
+    """ Engine of one replica and its last measured lag """
+
+    def __init__(self, uri, **engine_options):
+        self.engine = sqlalchemy.create_engine(uri, **engine_options)
+        self.lag = None
+        self.checked_at = 0
+        self.lock = threading.Lock()
+
+    def measure_lag(self):
+        """ Seconds behind the primary, None when it can't be reached """
+
+        if self.engine.dialect.name != 'postgresql':
+            return 0
+        try:
+            return float(self.engine.execute(LAG_QUERY).scalar())
+        except DBAPIError:
+            logger.warning('replica %s unreachable', self.engine.url, exc_info=True)
+            return None
+
+    def is_healthy(self):
+        if time.time() - self.checked_at > LAG_CHECK_INTERVAL:
+            # one thread measures, the others use the last value meanwhile
+            if self.lock.acquire(False):
+                try:
+                    self.lag = self.measure_lag()
+                    self.checked_at = time.time()
+                finally:
+                    self.lock.release()
+
+        return self.lag is not None and self.lag <= MAX_LAG
+
+
+_replicas = []
+
+
+def configure(uris, **engine_options):
+    """ Use these replicas from now on
+    Inputs: list of database URIs(strings), keyword arguments of
+    sqlalchemy.create_engine()
+    """
+
+    global _replicas
+
+    old, _replicas = _replicas, [Replica(uri, **engine_options) for uri in uris]
+    for replica in old:
+        replica.engine.dispose()
+
+
+def engines():
+    """ Engines of the configured replicas """
+
+    return [replica.engine for replica in _replicas]
+
+
+def dispose():
+    """ Close the replicas' pooled connections, e.g. in a forked worker """
+
+    for replica in _replicas:
+        replica.engine.dispose()
+
+
+def pick():
+    """ Engine of a healthy replica, or None to use the primary """
+
+    healthy = [replica for replica in _replicas if replica.is_healthy()]
+    if not healthy:
+        return None
+
+    return random.choice(healthy).engine
+
+
+def _is_sticky():
+    """ Whether this visitor wrote recently enough to need the primary """
+
+    return (flask.has_request_context() and
+            flask.session.get(STICKY_KEY, 0) > time.time())
+
+
+class RoutingSession(SignallingSession):
+    """ Session sending the SELECTs of read only code to a replica """
+
+    def get_bind(self, mapper=None, clause=None):
+        if (self.info.get('read_only') and not self.info.get('wrote')
+                and not self.info.get('primary') and not self._flushing and isinstance(clause, SelectBase)
+                and not _is_sticky()):
+            engine = pick()
+            if engine is not None:
+                return engine
+
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+@contextmanager
+def reading(session=None):
+    """ Send the queries of the block to a replica when one is usable """
+
+    if session is None:
+        from model import db
+        session = db.session()
+
+    was_read_only = session.info.get('read_only', False)
+    session.info['read_only'] = True
+    try:
+        yield
+    finally:
+        session.info['read_only'] = was_read_only
+
+
+@contextmanager
+def on_primary(session=None):
+    """ Send every query of the block to the primary, even in read only code """
+
+    if session is None:
+        from model import db
+        session = db.session()
+
+    was_primary = session.info.get('primary', False)
+    session.info['primary'] = True
+    try:
+        yield
+    finally:
+        session.info['primary'] = was_primary
+
+
+def read_only(function):
+    """ Decorator for functions that only read, see reading() """
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with reading():
+            return function(*args, **kwargs)
+    return wrapper
+
+
+@event.listens_for(Session, 'after_flush')
+def _wrote(session, flush_context):
+    session.info['wrote'] = True
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def _wrote_in_bulk(context):
+    # Query.update() and delete() don't flush
+    context.session.info['wrote'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _committed(session):
+    if session.info.pop('wrote', False) and flask.has_request_context():
+        # the replicas may not have this write yet
+        flask.session[STICKY_KEY] = time.time() + MAX_LAG
+
+
+@event.listens_for(Session, 'after_rollback')
+def _rolled_back(session):
+    session.info.pop('wrote', None)
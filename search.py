@@ -0,0 +1,160 @@
+"""Search of available animals across every rescue.
+
+Animals used to be browsable one rescue at a time only. search_animals()
+filters on the lookup tables (gender, age, size, breed, species, several
+labels per kind allowed), on words of the name and bio and on the rescues
+near a place (see geo.py), and pages through the results with the same keyset
+cursors as the rescue pages.
+
+On PostgreSQL the words are matched against animals.search_vector, a
+tsvector kept by a trigger and indexed with a partial GIN index (see
+model.py), so a search reads only the index entries of matching animals.
+Other databases fall back to LIKE on name and bio.
+
+facet_counts() tells, for each kind, how many results every label would
+have, counted with the other kinds' filters applied so a visitor sees what
+picking another label would give. The counts are cached for FACET_TTL
+seconds in the page cache, they don't need to be exact to the second.
+"""
+
+import hashlib
+import json
+import sqlalchemy
+import cache
+import lookups
+import model as m
+import pagination
+import replicas
+
+
+# kind: column the kind's filter and facet use
+FACETS = {
+    'gender': m.Animal.gender_id,
+    'age': m.Animal.age_id,
+    'size': m.Animal.size_id,
+    'breed': m.Animal.breed_id,
+    'species': m.Breed.species_id,
+}
+
+SEARCH_COLUMNS = [m.Animal.animal_id, m.Animal.rescue_id, m.Animal.name,
+                  m.Animal.img_url, m.Animal.img_variants, m.Animal.gender_id,
+                  m.Animal.age_id, m.Animal.size_id, m.Animal.breed_id]
+
+FACET_TTL = 60
+
+# longest search text taken, longer text is cut
+MAX_TEXT_LENGTH = 200
+
+
+def _match_text(query, text):
+    """ Keep the animals whose name or bio has every word of text """
+
+    if m.db.engine.dialect.name == 'postgresql':
+        return query.filter(m.Animal.search_vector.op('@@')(
+            sqlalchemy.func.plainto_tsquery('english', text)))
+
+    for word in text.split():
+        pattern = '%%%s%%' % word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        query = query.filter(sqlalchemy.or_(m.Animal.name.ilike(pattern, escape='\\'),
+                                            m.Animal.bio.ilike(pattern, escape='\\')))
+    return query
+
+
+def _filtered(query, text, filters, rescue_ids=None, skip=None):
+    """ Apply the search text, the rescues and every filter but skip's to a
+    query on animals
+    """
+
+    query = query.filter(m.ANIMAL_IS_AVAILABLE)
+    if rescue_ids is not None:
+        if not rescue_ids:
+            return query.filter(sqlalchemy.false())
+        query = query.filter(m.Animal.rescue_id.in_(rescue_ids))
+    if text:
+        query = _match_text(query, text)
+
+    for kind, labels in sorted(filters.items()):
+        if kind == skip or not labels:
+            continue
+        ids = [lookups.get_id(kind, label) for label in labels]
+        ids = [lookup_id for lookup_id in ids if lookup_id is not None]
+        if not ids:
+            # only labels that don't exist, nothing can match
+            return query.filter(sqlalchemy.false())
+        if kind == 'species':
+            query = query.filter(m.Animal.breed_id.in_(
+                m.db.session.query(m.Breed.breed_id).filter(m.Breed.species_id.in_(ids))))
+        else:
+            query = query.filter(FACETS[kind].in_(ids))
+
+    return query
+
+
+def clean_filters(args):
+    """ Filters of a search from request arguments
+    Input: MultiDict of request arguments, e.g. request.args
+    Output: dictionary of kind -> list of labels(strings)
+    """
+
+    return dict((kind, args.getlist(kind)) for kind in FACETS if args.getlist(kind))
+
+
+@replicas.read_only
+def search_animals(text=None, filters=None, cursor=None, limit=pagination.PAGE_SIZE,
+                   rescue_ids=None):
+    """ Get one page of available animals matching a search
+    Inputs: text(string) words the name or bio must contain, dictionary of
+    kind -> list of labels, cursor(string) of the previous page or None,
+    page size(int), list of the rescue ids(int) to search, e.g. of the rescues
+    near someone, or None for every rescue
+    Output: tuple of (list of rows of SEARCH_COLUMNS, cursor(string) for the
+    next page or None when there are no more animals)
+    """
+
+    text = (text or '').strip()[:MAX_TEXT_LENGTH]
+    query = _filtered(m.db.session.query(*SEARCH_COLUMNS), text, filters or {},
+                      rescue_ids)
+
+    return pagination.seek(query, m.Animal.animal_id, cursor, limit)
+
+
+def _count(kind, text, filters, rescue_ids):
+    """ Number of results per label of one kind """
+
+    column = FACETS[kind]
+    query = m.db.session.query(column, sqlalchemy.func.count(m.Animal.animal_id))
+    if kind == 'species':
+        query = query.select_from(m.Animal).join(m.Breed, m.Animal.breed_id == m.Breed.breed_id)
+    query = _filtered(query, text, filters, rescue_ids, skip=kind).group_by(column)
+
+    counts = [{'value': lookups.get_label(kind, lookup_id), 'count': count}
+              for lookup_id, count in query if lookup_id is not None]
+
+    return sorted(counts, key=lambda facet: (-facet['count'], facet['value']))
+
+
+@replicas.read_only
+def facet_counts(text=None, filters=None, rescue_ids=None):
+    """ Facets of a search
+    Inputs: like search_animals()
+    Output: dictionary of kind -> list of {'value': label, 'count': int},
+    most common first
+    """
+
+    text = (text or '').strip()[:MAX_TEXT_LENGTH]
+    filters = filters or {}
+    search_key = json.dumps([text.lower(),
+                             sorted((kind, sorted(labels)) for kind, labels in filters.items()),
+                             sorted(rescue_ids) if rescue_ids is not None else None])
+    key = 'search:facets:%s' % hashlib.sha1(search_key.encode('utf-8')).hexdigest()
+
+    if cache.backend is not None:
+        cached = cache.backend.get(key)
+        if cached is not None:
+            return json.loads(cached)
+
+    facets = dict((kind, _count(kind, text, filters, rescue_ids)) for kind in FACETS)
+    if cache.backend is not None:
+        cache.backend.set(key, json.dumps(facets), FACET_TTL)
+
+    return facets
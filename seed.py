@@ -3,15 +3,39 @@
 from model import Admin, Animal, Rescue, Age, Gender, Size, Species, Breed
 from model import connect_to_db, db
 from server import app
+import argparse
+import geo
+import lookups
+import os
+import time
 
 
-def load_admins():
+SEED_DIR = 'seed_data'
+
+# (model, seed file, columns of the seed file in order) in foreign key order
+SEED_FILES = [
+    (Species, 'u.species', ['species_id', 'species_type']),
+    (Breed, 'u.breeds', ['breed_id', 'breed_type', 'species_id']),
+    (Age, 'u.age', ['age_id', 'age_category']),
+    (Gender, 'u.gender', ['gender_id', 'gender_type']),
+    (Size, 'u.size', ['size_id', 'size_category']),
+    (Rescue, 'u.rescue', ['rescue_id', 'name', 'phone', 'address', 'email']),
+    (Animal, 'u.animal', ['animal_id', 'name', 'rescue_id', 'gender_id',
+                          'age_id', 'size_id', 'breed_id']),
+    (Admin, 'u.admin', ['admin_id', 'email', 'password', 'rescue_id']),
+]
+
+# Rows per executemany() when COPY isn't available
+INSERT_CHUNK = 10000
+
+
+def load_admins(data_dir=SEED_DIR):
     """Load admins from u.admin into database."""
 
     #print "Administrators"
 
     # Read u.admin file and insert data
-    for row in open("seed_data/u.admin"):
+    for row in open(os.path.join(data_dir, 'u.admin')):
         row = row.rstrip()
         admin_id, email, password, rescue_id = row.split("|")
 
@@ -26,30 +50,31 @@ def load_admins():
     db.session.commit()
 
 
-def load_rescues():
+def load_rescues(data_dir=SEED_DIR):
     """Load rescues from u.rescue into database."""
 
     #print "Rescues"
 
-    for row in open('seed_data/u.rescue'):
+    for row in open(os.path.join(data_dir, 'u.rescue')):
         row = row.rstrip()
         rescue_id, name, phone, address, email = row.split("|")
 
         rescue = Rescue(name=name,
                         phone=phone,
                         address=address,
-                        email=email)
+                        email=email,
+                        **geo.locate(address))
 
         db.session.add(rescue)
     db.session.commit()
 
 
-def load_animals():
+def load_animals(data_dir=SEED_DIR):
     """Load animals from u.animal into database."""
 
     #print "Animals"
 
-    for row in open("seed_data/u.animal"):
+    for row in open(os.path.join(data_dir, 'u.animal')):
         row = row.rstrip()
         animal_id, name, rescue_id, gender_id, age_id, size_id, breed_id = row.split("|")
         animal = Animal(name=name,
@@ -63,12 +88,12 @@ def load_animals():
     db.session.commit()
 
 
-def load_ages():
+def load_ages(data_dir=SEED_DIR):
     """Load ages from u.age into database."""
 
     #print "Ages"
 
-    for row in open('seed_data/u.age'):
+    for row in open(os.path.join(data_dir, 'u.age')):
         row = row.rstrip()
         age_id, age_category = row.split("|")
 
@@ -78,12 +103,12 @@ def load_ages():
     db.session.commit()
 
 
-def load_genders():
+def load_genders(data_dir=SEED_DIR):
     """Load genders from u.gender into database."""
 
     #print "Genders"
 
-    for row in open('seed_data/u.gender'):
+    for row in open(os.path.join(data_dir, 'u.gender')):
         row = row.rstrip()
         gender_id, gender_type = row.split("|")
 
@@ -93,12 +118,12 @@ def load_genders():
     db.session.commit()
 
 
-def load_sizes():
+def load_sizes(data_dir=SEED_DIR):
     """Load sizes from u.size into database."""
 
     #print "Sizes"
 
-    for row in open('seed_data/u.size'):
+    for row in open(os.path.join(data_dir, 'u.size')):
         row = row.rstrip()
         size_id, size_category = row.split("|")
         size = Size(size_category=size_category)
@@ -107,12 +132,12 @@ def load_sizes():
     db.session.commit()
 
 
-def load_species():
+def load_species(data_dir=SEED_DIR):
     """ Load species from u.species """
 
     #print "Species"
 
-    for row in open('seed_data/u.species'):
+    for row in open(os.path.join(data_dir, 'u.species')):
         row = row.rstrip()
         species_id, species_type = row.split("|")
 
@@ -122,12 +147,12 @@ def load_species():
     db.session.commit()
 
 
-def load_breeds():
+def load_breeds(data_dir=SEED_DIR):
     """ Load breeds from u.breeds """
 
     #print "Breeds"
 
-    for row in open('seed_data/u.breeds'):
+    for row in open(os.path.join(data_dir, 'u.breeds')):
         row = row.rstrip()
         breed_id, breed_type, species_id = row.split("|")
 
@@ -137,19 +162,161 @@ def load_breeds():
     db.session.commit()
 
 
-def load_all():
+def load_all(data_dir=SEED_DIR):
     # Import different types of data
-    load_species()
-    load_breeds()
-    load_ages()
-    load_genders()
-    load_sizes()
-    load_rescues()
-    load_animals()
-    load_admins()
+    load_species(data_dir)
+    load_breeds(data_dir)
+    load_ages(data_dir)
+    load_genders(data_dir)
+    load_sizes(data_dir)
+    load_rescues(data_dir)
+    load_animals(data_dir)
+    load_admins(data_dir)
+
+
+##############################################################################
+# Fast path for big seed files: COPY on PostgreSQL, executemany elsewhere.
+# Neither goes through the ORM unit of work, so Python side column defaults
+# are filled in here and the sequences are moved past the copied ids.
+
+def _seed_rows(path, defaults):
+    """ Read a seed file as lists of values, '' becomes NULL and the defaults
+    of the columns the file doesn't have are appended
+    """
+
+    with open(path) as seed_file:
+        for row in seed_file:
+            row = row.rstrip('\r\n')
+            if not row:
+                continue
+            values = [value if value != '' else None for value in row.split('|')]
+            yield values + defaults
+
+
+def _copy_value(value):
+    """ Format one value for COPY's text format """
+
+    if value is None:
+        return '\\N'
+    if value is True or value is False:
+        return 't' if value else 'f'
+
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+class _CopyStream(object):
+    """ File-like object over rows for cursor.copy_expert(), so a seed file
+    is streamed into COPY without building it in memory
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.buffer = ''
+        self.count = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                row = next(self.rows)
+            except StopIteration:
+                break
+            self.count += 1
+            self.buffer += '\t'.join(_copy_value(value) for value in row) + '\n'
+
+        if size < 0:
+            size = len(self.buffer)
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def fast_load(model, path, columns):
+    """ Load one seed file without the ORM
+    Inputs: model class, path to the seed file(string), list of column names
+    in the seed file
+    Output: number of rows loaded(int)
+    """
+
+    table = model.__table__
+    # Python side defaults (img_url, bio, is_adopted...) of the columns the
+    # seed file leaves out
+    extra = [column for column in table.columns
+             if column.name not in columns and column.default is not None
+             and column.default.is_scalar]
+    all_columns = columns + [column.name for column in extra]
+    rows = _seed_rows(path, [column.default.arg for column in extra])
+
+    if db.engine.dialect.name == 'postgresql':
+        stream = _CopyStream(rows)
+        connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.copy_expert('COPY %s (%s) FROM STDIN' % (
+                table.name, ', '.join(all_columns)), stream)
+            connection.commit()
+        finally:
+            connection.close()
+        return stream.count
+
+    count = 0
+    chunk = []
+    for row in rows:
+        chunk.append(dict(zip(all_columns, row)))
+        if len(chunk) >= INSERT_CHUNK:
+            db.engine.execute(table.insert(), chunk)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        db.engine.execute(table.insert(), chunk)
+        count += len(chunk)
+
+    return count
+
+
+def reset_sequences():
+    """ Move each table's id sequence past the ids loaded from the seed files
+    so the next insert doesn't collide with them. Only PostgreSQL has them.
+    """
+
+    if db.engine.dialect.name != 'postgresql':
+        return
+
+    for model, seed_file, columns in SEED_FILES:
+        table = model.__tablename__
+        primary_key = columns[0]
+        db.engine.execute(
+            "SELECT setval(pg_get_serial_sequence('%s', '%s'), "
+            "COALESCE(MAX(%s), 0) + 1, false) FROM %s" % (
+                table, primary_key, primary_key, table))
+
+
+def fast_load_all(data_dir=SEED_DIR):
+    """ Load every seed file with fast_load and report rows/sec per table """
+
+    for model, seed_file, columns in SEED_FILES:
+        started = time.time()
+        count = fast_load(model, os.path.join(data_dir, seed_file), columns)
+        seconds = time.time() - started
+        print "%-10s %9d rows %8.2fs %10.0f rows/sec" % (
+            model.__tablename__, count, seconds, count / max(seconds, 0.001))
+
+    reset_sequences()
+    # rows copied outside the ORM don't fire the reference table events
+    lookups.invalidate()
+    print "Located %d rescues" % geo.backfill()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Seed the project database')
+    parser.add_argument('--fast', action='store_true',
+                        help='stream the seed files with COPY instead of the ORM')
+    parser.add_argument('--data-dir', default=SEED_DIR,
+                        help='directory of u.* seed files')
+    args = parser.parse_args()
+
     connect_to_db(app)
 
     db.drop_all()
@@ -157,4 +324,7 @@ if __name__ == "__main__":
     # In case tables haven't been created, create them
     db.create_all()
 
-    load_all()
+    if args.fast:
+        fast_load_all(args.data_dir)
+    else:
+        load_all(args.data_dir)
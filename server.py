@@ -1,24 +1,149 @@
-from flask import (Flask, render_template, redirect, request, flash,
-                   session)
+from flask import (Blueprint, Flask, current_app, render_template, redirect,
+                   request, flash, session, jsonify, abort)
 from flask_debugtoolbar import DebugToolbarExtension
 from jinja2 import StrictUndefined
 from model import Rescue, connect_to_db
+import api
+import cache
+import conditional
 import control as c
+import geo
+import images
+import imageserving
+import instrumentation
+import intake
+import lookups
+import pagination
+import replicas
+import search
 import sqlalchemy
+import storage
+import templating
+import uploads
 import model as m
+import logging
 import os
+import zipfile
 
 
-app = Flask(__name__)
+# Settings every app starts with, a file named by the PROJECT_SETTINGS
+# environment variable and the config passed to create_app() override them
+DEFAULT_CONFIG = {
+    'SECRET_KEY': 'ABC',
+    'SQLALCHEMY_DATABASE_URI': 'postgresql:///project',
+    # This is the path to the upload directory
+    'UPLOAD_FOLDER': 'static/images/',
+    # These are the extensions accepting to be uploaded
+    'ALLOWED_EXTENSIONS': set(['png', 'jpg', 'jpeg', 'gif']),
+    # level of the log written to stderr (slow queries, lagging replicas, jobs)
+    'LOG_LEVEL': 'INFO',
+}
+
+LOG_FORMAT = '%(asctime)s %(process)d %(levelname)s %(name)s: %(message)s'
+
+# rescues on the homepage near a place, and animals shown for each
+NEARBY_RESCUES = 20
+NEARBY_ANIMALS = 4
+
+main = Blueprint('main', __name__)
+
+
+def create_app(config=None):
+    """ Build the Flask app
+    Input: dictionary of settings overriding DEFAULT_CONFIG, or None
+    Output: Flask app, not connected to the database yet (see connect_to_db)
+    """
+
+    app = Flask(__name__)
+    app.config.update(DEFAULT_CONFIG)
+    app.config.from_envvar('PROJECT_SETTINGS', silent=True)
+    app.config.update(config or {})
+
+    app.jinja_env.undefined = StrictUndefined
+
+    # the modules' loggers have no handler of their own; does nothing when
+    # the server (or a script) has set up logging already
+    logging.basicConfig(level=app.config['LOG_LEVEL'], format=LOG_FORMAT)
+
+    instrumentation.init_app(app)
+    cache.init_app(app)
+    images.init_app(app)
+    uploads.init_app(app)
+    storage.init_app(app)
+    imageserving.init_app(app)
+    geo.init_app(app)
+    templating.init_app(app)
+    app.register_blueprint(main)
+    app.register_blueprint(api.api)
+
+    return app
 
-app.secret_key = 'ABC'
 
-app.jinja_env.undefined = StrictUndefined
+def warmup(app):
+    """ Do the first-request work before taking requests: load the reference
+    tables and the geocoding table and compile every template. Run before
+    forking workers, they all start with it done.
+    """
 
+    with app.app_context():
+        lookups.load()
+        geo.load()
+        for name in app.jinja_env.list_templates():
+            app.jinja_env.get_template(name)
+        # connections opened here mustn't be shared with forked workers
+        m.db.session.remove()
+        m.dispose_engines()
 
-@app.route('/')
+
+@main.route('/')
 def index():
-    """Homepage. Displays list of rescues"""
+    """Homepage. Displays list of rescues, or the rescues near the place in
+    near (a city like "Gainesville, FL" or "latitude, longitude") when given
+    """
+
+    if request.args.get('near'):
+        return nearby_rescues()
+
+    return all_rescues()
+
+
+def _place():
+    """ (latitude, longitude, radius in miles) of the near and radius request
+    arguments, None when there is no such place
+    """
+
+    place = geo.geocode(request.args.get('near'))
+    if place is None:
+        return None
+    radius = request.args.get('radius', geo.DEFAULT_RADIUS, type=float)
+
+    return place[0], place[1], max(0.0, min(radius, geo.MAX_RADIUS))
+
+
+def nearby_rescues():
+    """ Rescues near a place with their first available animals, nearest
+    first
+    """
+
+    place = _place()
+    rescues = geo.nearby_rescues(*place, limit=NEARBY_RESCUES) if place else []
+    animals = c.get_first_available_animals([rescue.rescue_id
+                                             for rescue, miles in rescues],
+                                            NEARBY_ANIMALS)
+
+    return render_template('nearby_rescues.html',
+                           near=request.args.get('near'),
+                           found=place is not None,
+                           rescues=rescues,
+                           animals=animals,
+                           title='Rescues near %s' % request.args.get('near'))
+
+
+@conditional.conditional_page(c.get_homepage_stamp)
+@cache.cached_page(lambda: cache.HOMEPAGE_KEY)
+@replicas.read_only
+def all_rescues():
+    """ Every rescue """
 
     title = 'My page'
     rescues = Rescue.query.all()
@@ -28,22 +153,25 @@ def index():
                            title=title)
 
 
-@app.route('/rescue/<int:rescue_id>')
+@main.route('/rescue/<int:rescue_id>')
+@conditional.conditional_page(c.get_rescue_stamp)
+@cache.cached_page(cache.rescue_page_key)
 def load_rescue_info(rescue_id):
     """ Displays rescue details and list of available dogs & cats """
 
     rescue_info = c.get_rescue(rescue_id)
     title = rescue_info.name
-    available_animals = c.get_available_animals(rescue_id)
-    #available_animals = available_animals[:10]
+    available_animals, next_cursor = c.get_available_animals_page(rescue_id)
 
     return render_template('rescue_info.html',
                            rescue_info=rescue_info,
                            available_animals=available_animals,
+                           next_cursor=next_cursor,
                            title=title)
 
 
-@app.route('/rescue/<int:rescue_id>/animal/<int:animal_id>')
+@main.route('/rescue/<int:rescue_id>/animal/<int:animal_id>')
+@conditional.conditional_page(lambda rescue_id, animal_id: c.get_animal_stamp(animal_id))
 def load_animal_info(rescue_id, animal_id):
     """ Displays details of each animal """
 
@@ -54,29 +182,29 @@ def load_animal_info(rescue_id, animal_id):
                            title=title)
 
 
-@app.route('/admin/<int:admin_id>')
+@main.route('/admin/<int:admin_id>')
 def load_admin_page(admin_id):
     """ Show admin page to add animals """
 
     title = 'Dashboard'
-    admin = c.get_admin_by_id(admin_id)
+    admin = c.get_logged_in_admin(session)
 
     # redirects to homepage if user is not the logged in user
-    if 'current_admin' not in session or admin.email != session['current_admin']:
+    if admin is None or admin.admin_id != admin_id:
         return redirect('/')
     else:
         return render_template('admin_page.html', admin=admin, title=title)
 
 
-@app.route('/admin/<int:admin_id>/rescue-info')
+@main.route('/admin/<int:admin_id>/rescue-info')
 def load_rescue_info_admin_page(admin_id):
     """ Show admin page to add a rescue """
 
     title = 'Dashboard'
-    admin = c.get_admin_by_id(admin_id)
+    admin = c.get_logged_in_admin(session)
 
     # redirects to homepage if user is not the logged in user
-    if 'current_admin' not in session or admin.email != session['current_admin']:
+    if admin is None or admin.admin_id != admin_id:
         return redirect('/')
     else:
         return render_template('rescue_info_admin.html', admin=admin,
@@ -84,15 +212,22 @@ def load_rescue_info_admin_page(admin_id):
 
 
 # Route that will process the file upload and other form input data
-@app.route('/handle-add-animal', methods=['GET', 'POST'])
+@main.route('/handle-add-animal', methods=['GET', 'POST'])
 def add_animal_process():
     """ Sends admins form input to the database """
 
-    email = session['current_admin']
-    admin = c.get_admin_by_session(email)
+    admin = c.get_logged_in_admin(session)
+    if admin is None:
+        return redirect('/')
     admin_id = admin.admin_id
 
     if request.method == 'POST':
+        # The photo was uploaded straight to the image storage
+        if request.form.get('uploaded_key'):
+            if not storage.is_incoming_key(request.form['uploaded_key']):
+                abort(400)
+            animal = c.add_animal(request, session, current_app.config['UPLOAD_FOLDER'])
+            return redirect('/rescue/' + str(animal.rescue_id))
         # Check if the post request has the file part
         if 'file' not in request.files:
             flash('No file part')
@@ -105,22 +240,32 @@ def add_animal_process():
             flash('No selected file')
             return redirect('/admin/' + str(admin_id))
         # Check if the file is one of the allowed types/extensions
-        if uploaded_file and c.allowed_file(uploaded_file.filename, ALLOWED_EXTENSIONS):
+        if uploaded_file and c.allowed_file(uploaded_file.filename,
+                                                    current_app.config['ALLOWED_EXTENSIONS']):
             # passing the request and session object
-            animal = c.add_animal(request, session, app.config['UPLOAD_FOLDER'])
+            animal = c.add_animal(request, session, current_app.config['UPLOAD_FOLDER'])
 
     return redirect('/rescue/' + str(animal.rescue_id))
 
 
-@app.route('/handle-add-rescue', methods=['GET', 'POST'])
+@main.route('/handle-add-rescue', methods=['GET', 'POST'])
 def add_rescue_process():
     """ Sends admins form input to the database """
 
-    email = session['current_admin']
-    admin = c.get_admin_by_session(email)
+    admin = c.get_logged_in_admin(session)
+    if admin is None:
+        return redirect('/')
     admin_id = admin.admin_id
 
     if request.method == 'POST':
+        # The logo was uploaded straight to the image storage
+        if request.form.get('uploaded_key'):
+            if not storage.is_incoming_key(request.form['uploaded_key']):
+                abort(400)
+            rescue = c.add_rescue(request, session, current_app.config['UPLOAD_FOLDER'])
+            c.update_admin_row(admin, rescue)
+            session['rescue_id'] = rescue.rescue_id
+            return redirect('/success')
         # Check if the post request has the file part
         if 'file' not in request.files:
             flash('No file part')
@@ -133,17 +278,72 @@ def add_rescue_process():
             flash('No selected file')
             return redirect('/admin/' + str(admin_id) + '/rescue-info')
         # Check if the file is one of the allowed types/extensions
-        if uploaded_file and c.allowed_file(uploaded_file.filename, ALLOWED_EXTENSIONS):
-            rescue = c.add_rescue(request, session, app.config['UPLOAD_FOLDER'])
-            # Get admin object of currently logged in admin
-            admin = c.get_admin_by_id(admin_id)
+        if uploaded_file and c.allowed_file(uploaded_file.filename,
+                                                    current_app.config['ALLOWED_EXTENSIONS']):
+            rescue = c.add_rescue(request, session, current_app.config['UPLOAD_FOLDER'])
             # update admin row with its new rescue_id
             c.update_admin_row(admin, rescue)
+            session['rescue_id'] = rescue.rescue_id
 
     return redirect('/success')
 
 
-@app.route('/success')
+@main.route('/handle-presign-upload', methods=['POST'])
+def presign_upload():
+    """ Returns the url and form fields the browser posts a photo to when
+    the image storage takes uploads directly (IMAGE_STORAGE = 's3'), and the
+    key to send with the form instead of the file.
+    """
+
+    if 'current_admin' not in session:
+        abort(403)
+
+    filename = request.form.get('filename', '')
+    if not c.allowed_file(filename, uploads.IMAGE_EXTENSIONS):
+        return jsonify(error='Photos must be .png, .jpg or .gif files'), 400
+
+    upload = storage.backend.presigned_upload(
+        filename.rsplit('.', 1)[1].lower(), current_app.config['MAX_IMAGE_SIZE'])
+    if upload is None:
+        abort(404)
+
+    return jsonify(upload)
+
+
+@main.route('/handle-bulk-intake', methods=['POST'])
+def bulk_intake_process():
+    """ Imports a CSV/JSON file of animals, plus an optional zip of their
+    photos, into the logged in admin's rescue. Returns a JSON report.
+    """
+
+    admin = c.get_logged_in_admin(session)
+    if admin is None:
+        return redirect('/')
+    if admin.rescue_id is None:
+        return jsonify(error='Add your rescue before adding animals'), 400
+
+    uploaded_file = request.files.get('file')
+    if uploaded_file is None or uploaded_file.filename == '':
+        return jsonify(error='No selected file'), 400
+
+    photos = None
+    if request.files.get('photos') and request.files['photos'].filename:
+        try:
+            photos = zipfile.ZipFile(request.files['photos'].stream)
+        except zipfile.BadZipfile:
+            return jsonify(error='Photos must be a zip file'), 400
+
+    try:
+        rows = intake.read_rows(uploaded_file.stream, uploaded_file.filename)
+        report = intake.import_animals(rows, admin.rescue_id,
+                                       current_app.config['UPLOAD_FOLDER'], photos)
+    except (intake.RowError, ValueError) as e:
+        return jsonify(error=str(e)), 400
+
+    return jsonify(report)
+
+
+@main.route('/success')
 def add_rescue_success():
     """ Show login page for admins only. """
 
@@ -164,7 +364,7 @@ def add_rescue_success():
         return redirect('/')
 
 
-@app.route('/admin-login')
+@main.route('/admin-login')
 def admin_login_form():
     """ Show login page for admins only. """
 
@@ -174,7 +374,7 @@ def admin_login_form():
                            title=title)
 
 
-@app.route('/handle-admin-login', methods=['POST'])
+@main.route('/handle-admin-login', methods=['POST'])
 def process_admin_login():
     """ Redirect to admin page after login. """
 
@@ -185,7 +385,7 @@ def process_admin_login():
     if admin is False:
         flash('Invalid credentials. Please click on sign up to create an account!')
         return redirect('/')
-    session['current_admin'] = entered_email
+    c.remember_admin(session, admin)
     ad_id = admin.admin_id
     flash('Logged in as %s' % entered_email)
     if admin.rescue_id is None:
@@ -194,17 +394,19 @@ def process_admin_login():
         return redirect('/admin' + '/' + str(ad_id))
 
 
-@app.route('/admin-logout')
+@main.route('/admin-logout')
 def admin_logout():
     """ Logs out admin user """
 
     session.pop('current_admin', None)
+    session.pop('admin_id', None)
+    session.pop('rescue_id', None)
     flash('You have been logged out')
 
     return redirect('/')
 
 
-@app.route('/admin-signup')
+@main.route('/admin-signup')
 def admin_signup():
     """ Sign up page for new admin user """
 
@@ -214,20 +416,79 @@ def admin_signup():
                            title=title)
 
 
-@app.route('/handle-loading')
+@main.route('/handle-loading')
 def handle_dynamic_loading():
-    rescue_id = request.args.get("rescueid")
-    counter = int(request.args.get("counter"))
-    o = 10 + (counter*10)  # offset(skip) this many
-    animals = m.db.session.query(m.Animal).filter(
-        m.Animal.rescue_id == rescue_id, m.Animal.is_adopted == 'f', m.Animal.is_visible == 't').limit(10).offset(o).all()
-    my_html = ''
-    for animal in animals:
-        animal_id = animal.animal_id
-        animal_img = animal.img_url
-        a = '<br><a href = "/rescue/%s/animal/%s"><img alt="portrait" src = "/%s"></a><br>' % (rescue_id, animal_id, animal_img)
-        my_html = my_html + a
-    return my_html
+    """ Returns the next page of animals for the rescue page's infinite scroll
+    as JSON: the rendered html and the cursor to send for the page after it.
+    """
+
+    rescue_id = request.args.get("rescueid", type=int)
+    cursor = request.args.get("cursor")
+
+    try:
+        animals, next_cursor = c.get_available_animals_page(rescue_id, cursor,
+                                                            profile='scroll')
+    except pagination.InvalidCursor:
+        abort(400)
+
+    my_html = render_template('animal_tiles.html', animals=animals,
+                              rescue_id=rescue_id)
+
+    return jsonify(html=my_html, next_cursor=next_cursor)
+
+
+@main.route('/search')
+def search_animals():
+    """ Searches available animals of every rescue. Takes the words to look
+    for in q, labels to filter on in gender, age, size, breed and species
+    (repeat one to allow several), near and radius like the homepage to only
+    search the rescues around a place, and the cursor of the previous page.
+    Returns JSON: a page of animals, the facet counts and the next cursor.
+    """
+
+    text = request.args.get('q')
+    filters = search.clean_filters(request.args)
+
+    # near restricts the search to the rescues within radius miles
+    distances = None
+    if request.args.get('near'):
+        place = _place()
+        if place is None:
+            abort(400)
+        distances = dict((rescue.rescue_id, miles)
+                         for rescue, miles in geo.nearby_rescues(*place))
+    rescue_ids = distances.keys() if distances is not None else None
+
+    try:
+        animals, next_cursor = search.search_animals(text, filters,
+                                                     request.args.get('cursor'),
+                                                     rescue_ids=rescue_ids)
+    except pagination.InvalidCursor:
+        abort(400)
+
+    results = [{'animal_id': animal.animal_id,
+                'rescue_id': animal.rescue_id,
+                'name': animal.name,
+                'url': '/rescue/%s/animal/%s' % (animal.rescue_id, animal.animal_id),
+                'img_url': storage.url(animal.img_url),
+                'gender': lookups.get_label('gender', animal.gender_id),
+                'age': lookups.get_label('age', animal.age_id),
+                'size': lookups.get_label('size', animal.size_id),
+                'breed': lookups.get_label('breed', animal.breed_id)}
+               for animal in animals]
+    if distances is not None:
+        for result in results:
+            result['distance'] = round(distances[result['rescue_id']], 1)
+
+    return jsonify(animals=results,
+                   facets=search.facet_counts(text, filters, rescue_ids),
+                   next_cursor=next_cursor)
+
+
+# The scripts, the tests and the development server use this app, servers
+# build their own in wsgi.py
+app = create_app()
+
 
 if __name__ == "__main__":
     # We have to set debug=True here, since it has to be True at the
@@ -235,16 +496,13 @@ if __name__ == "__main__":
     app.debug = True
     app.jinja_env.auto_reload = app.debug  # make sure templates, etc. are not cached in debug mode
 
-    connect_to_db(app)
+    connect_to_db(app, app.config['SQLALCHEMY_DATABASE_URI'])
+
+    # Load the reference tables once before taking requests
+    lookups.load()
 
     # Use the DebugToolbar
     DebugToolbarExtension(app)
     app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
-    # File uploads
-    UPLOAD_FOLDER = 'static/images/'
-    # These are the extensions accepting to be uploaded
-    ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
-    # This is the path to the upload directory
-    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
     app.run(port=5000, host='0.0.0.0')
@@ -0,0 +1,223 @@
+"""Where uploaded images are kept.
+
+Image keys (the img_url columns) used to be paths under the local
+static/images/ folder, so every app server needed the same disk. The backend
+is picked with IMAGE_STORAGE:
+
+    'local' - files under UPLOAD_FOLDER, served from /images (default, see
+              imageserving.py)
+    's3'    - a bucket on S3 or anything speaking its API (MinIO, Ceph...):
+              S3_BUCKET, S3_PREFIX (default 'images/'), S3_ENDPOINT_URL for
+              non-AWS servers, S3_PUBLIC_URL if the bucket is served from a
+              CDN. Credentials come from the usual AWS environment variables
+              or config files. Needs the boto3 package.
+
+With 's3' the admin forms upload photos straight to the bucket with a
+presigned POST, so the bytes never pass through the app; a background job
+then moves them from incoming/ into the image store (see control.py).
+Templates turn keys into URLs with image_url().
+"""
+
+from contextlib import contextmanager
+import mimetypes
+import os
+import re
+import shutil
+import tempfile
+import uuid
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+
+# Stored images never change, see imagestore.py
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# presigned uploads land here until a job has checked them
+INCOMING = 'incoming/'
+
+INCOMING_NAME = re.compile(r'^[0-9a-f]{32}\.[a-z]+$')
+
+# seconds a presigned upload stays valid
+PRESIGN_EXPIRES = 600
+
+# Mode of stored files: what open() would give them. Their temporary files
+# are 0600, but in IMAGE_SERVING 'x-accel'/'x-sendfile' mode the web server,
+# usually another user, reads them itself.
+_umask = os.umask(0)
+os.umask(_umask)
+FILE_MODE = 0o666 & ~_umask
+
+
+class LocalStorage(object):
+    """ Files in a local folder, keys are paths relative to the app """
+
+    direct_uploads = False
+
+    def __init__(self, folder='static/images/'):
+        self.folder = folder
+
+    def key(self, name):
+        return os.path.join(self.folder, name)
+
+    def put(self, local_path, key):
+        """ Move a local file to key """
+
+        os.chmod(local_path, FILE_MODE)
+        if os.path.abspath(local_path) == os.path.abspath(key):
+            return
+        if not os.path.isdir(os.path.dirname(key)):
+            os.makedirs(os.path.dirname(key))
+        try:
+            os.rename(local_path, key)
+        except OSError:
+            # on another filesystem, copy next to the target so the rename
+            # that makes it appear is still atomic
+            handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(key),
+                                                 prefix='.upload-')
+            os.close(handle)
+            shutil.copyfile(local_path, temp_path)
+            os.chmod(temp_path, FILE_MODE)
+            os.rename(temp_path, key)
+            os.remove(local_path)
+
+    def exists(self, key):
+        return os.path.exists(key)
+
+    def delete(self, key):
+        if os.path.exists(key):
+            os.remove(key)
+
+    @contextmanager
+    def local_copy(self, key):
+        """ Path of the file on local disk while the block runs """
+
+        yield key
+
+    def url(self, key):
+        """ Served by imageserving.py """
+
+        name = os.path.relpath(key, self.folder)
+        if name.startswith(os.pardir):
+            return '/' + key
+        return '/images/' + name.replace(os.sep, '/')
+
+    def presigned_upload(self, extension, max_size):
+        return None
+
+
+class S3Storage(object):
+    """ Objects in an S3 compatible bucket """
+
+    direct_uploads = True
+
+    def __init__(self, bucket, prefix='images/', endpoint_url=None,
+                 public_url=None, client=None):
+        if client is None:
+            if boto3 is None:
+                raise RuntimeError('the boto3 package is needed for IMAGE_STORAGE = "s3"')
+            client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        if public_url is None:
+            public_url = ('%s/%s' % (endpoint_url.rstrip('/'), bucket) if endpoint_url
+                          else 'https://%s.s3.amazonaws.com' % bucket)
+        self.public_url = public_url.rstrip('/')
+
+    def key(self, name):
+        return self.prefix + name
+
+    def put(self, local_path, key):
+        """ Upload a local file to key and remove the local copy """
+
+        content_type = mimetypes.guess_type(key)[0] or 'application/octet-stream'
+        self.client.upload_file(local_path, self.bucket, key, ExtraArgs={
+            'ContentType': content_type,
+            'CacheControl': IMMUTABLE_CACHE_CONTROL})
+        os.remove(local_path)
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    @contextmanager
+    def local_copy(self, key):
+        """ Download the object to a temporary file for the block """
+
+        handle, path = tempfile.mkstemp(suffix=os.path.splitext(key)[1])
+        os.close(handle)
+        try:
+            self.client.download_file(self.bucket, key, path)
+            yield path
+        finally:
+            os.remove(path)
+
+    def url(self, key):
+        return '%s/%s' % (self.public_url, key)
+
+    def presigned_upload(self, extension, max_size):
+        """ Form a browser can POST one file to, straight to the bucket
+        Inputs: extension(string) of the file, largest size in bytes(int)
+        Output: dictionary with the url and fields to post and the key the
+        file will have
+        """
+
+        key = self.key('%s%s.%s' % (INCOMING, uuid.uuid4().hex, extension))
+        content_type = mimetypes.guess_type(key)[0] or 'application/octet-stream'
+        post = self.client.generate_presigned_post(
+            self.bucket, key, Fields={'Content-Type': content_type},
+            Conditions=[{'Content-Type': content_type},
+                        ['content-length-range', 1, max_size]],
+            ExpiresIn=PRESIGN_EXPIRES)
+
+        return {'url': post['url'], 'fields': post['fields'], 'key': key}
+
+
+backend = LocalStorage()
+
+
+def is_incoming_key(key):
+    """ Whether a key is one presigned_upload() handed out """
+
+    prefix = backend.key(INCOMING)
+    return key.startswith(prefix) and INCOMING_NAME.match(key[len(prefix):]) is not None
+
+
+def url(key):
+    """ Template global image_url(): URL of a stored image. Images that ship
+    with the app (the default photos) stay under /static with other backends.
+    """
+
+    if key.startswith('static/') and not isinstance(backend, LocalStorage):
+        return '/' + key
+
+    return backend.url(key)
+
+
+def init_app(app):
+    """ Pick the storage backend from the app's config """
+
+    global backend
+
+    if app.config.get('IMAGE_STORAGE', 'local') == 's3':
+        backend = S3Storage(app.config['S3_BUCKET'],
+                            app.config.get('S3_PREFIX', 'images/'),
+                            app.config.get('S3_ENDPOINT_URL'),
+                            app.config.get('S3_PUBLIC_URL'))
+    else:
+        backend = LocalStorage(app.config.get('UPLOAD_FOLDER', 'static/images/'))
+
+    app.jinja_env.globals['image_url'] = url
+    app.jinja_env.globals['direct_uploads'] = lambda: backend.direct_uploads
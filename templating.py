@@ -0,0 +1,103 @@
+"""Template compilation and fragment caching.
+
+Every worker used to compile each template from source on its first use.
+Compiled templates are now written to a bytecode cache and later processes
+load them instead of compiling again. Jinja checks the template's source, so
+an edited template is compiled again. The cache is Jinja's private per-user
+directory in the system's temp directory by default; JINJA_BYTECODE_CACHE
+names another directory, or None turns the cache off. Whoever can write to
+that directory can run code in the app, so it must belong to the app's user
+and be writable by no one else.
+
+Parts of a page can be cached on their own, in the same backend as the pages
+(see cache.py):
+
+    {% cache animal_tile_key(animal.animal_id, animal.updated_at) %}
+      ...
+    {% endcache %}
+
+keeps the html of the block for FRAGMENT_TTL seconds, or give the seconds
+after the key: {% cache key, 600 %}. When a page has to be rendered again
+(its cache entry was dropped by a write) only the fragments the write
+changed are rendered again. The keys of animal tiles and rescue headers
+include the row's updated_at, so a write (from any worker or the job runner)
+moves the row's fragment to a new key instead of having to delete the old
+one in every process; old versions expire. Fragments are read one by one,
+which is cheap in memory but a round trip each with Redis.
+"""
+
+import os
+import stat
+from jinja2 import FileSystemBytecodeCache, Markup, nodes
+from jinja2.ext import Extension
+import cache
+
+
+FRAGMENT_TTL = 300
+
+
+class FragmentCacheExtension(Extension):
+    """ The {% cache key[, ttl] %}...{% endcache %} tag """
+
+    tags = set(['cache'])
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+
+        args = [parser.parse_expression()]
+        if parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+
+        return nodes.CallBlock(self.call_method('_cached', args), [], [], body).set_lineno(lineno)
+
+    def _cached(self, key, ttl, caller):
+        if cache.backend is None:
+            return caller()
+
+        html = cache.backend.get(key)
+        if html is None:
+            html = caller()
+            cache.backend.set(key, unicode(html), ttl or FRAGMENT_TTL)
+
+        # the block was escaped when it was rendered
+        return Markup(html)
+
+
+def _private_directory(directory):
+    """ Create directory for this user only, or check an existing one is
+    owned by this user and writable by no one else
+    Input: path(string)
+    Output: No output, raises RuntimeError for an unsafe directory
+    """
+
+    try:
+        os.makedirs(directory, stat.S_IRWXU)
+    except OSError:
+        # made by another worker already
+        if not os.path.isdir(directory):
+            raise
+
+    status = os.lstat(directory)
+    if (not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid()
+            or status.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+        raise RuntimeError('JINJA_BYTECODE_CACHE %s must be a directory owned by this '
+                           'user and not writable by others' % directory)
+
+
+def init_app(app):
+    """ Set up the bytecode cache and the cache tag """
+
+    if 'JINJA_BYTECODE_CACHE' not in app.config:
+        # Jinja makes and checks a 0700 directory of this user
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+    elif app.config['JINJA_BYTECODE_CACHE']:
+        _private_directory(app.config['JINJA_BYTECODE_CACHE'])
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['JINJA_BYTECODE_CACHE'])
+
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    app.jinja_env.globals['animal_tile_key'] = cache.animal_tile_key
+    app.jinja_env.globals['rescue_header_key'] = cache.rescue_header_key
@@ -1,8 +1,34 @@
+import datetime
+import filecmp
+import gzip
+import json
+import os
+import shutil
+import sqlalchemy
+from StringIO import StringIO
+import tempfile
 import unittest
 from server import app
-from model import db, connect_to_db
+from model import db, connect_to_db, upgrade_db
 import seed as s
+import benchmark
+import cache
 import control as c
+import generate_seed
+import geo
+import images
+import imageserving
+import imagestore
+import instrumentation
+import jobs
+import intake
+import model as m
+import lookups
+import pagination
+import replicas
+import search
+import storage
+import uploads
 
 
 class RoutesTests(unittest.TestCase):
@@ -23,6 +49,10 @@ class RoutesTests(unittest.TestCase):
 
         s.load_all()
 
+        # pages and admins cached from an earlier test's database
+        cache.clear()
+        c.forget_admins()
+
     def test_homepage(self):
         result = self.client.get('/')
         self.assertEqual(result.status_code, 200)
@@ -44,6 +74,82 @@ class RoutesTests(unittest.TestCase):
         self.assertEqual(result.status_code, 200)
         self.assertIn('Name: Archie', result.data)
 
+    def test_request_stats(self):
+        instrumentation.reset()
+        self.client.get('/')
+        stats = instrumentation.snapshot()['/']
+        self.assertEqual(stats['requests'], 1)
+        self.assertGreaterEqual(stats['db_queries'], 1)
+
+        # behind a proxy every client is 127.0.0.1
+        result = self.client.get('/_stats',
+                                 environ_base={'REMOTE_ADDR': '127.0.0.1'})
+        self.assertEqual(result.status_code, 404)
+
+        with self.client.session_transaction() as sess:
+            sess['current_admin'] = 'test1@gmail.com'
+        result = self.client.get('/_stats')
+        self.assertEqual(result.status_code, 200)
+        self.assertIn('avg_db_queries', result.data)
+
+    def test_rescue_page_queries(self):
+        """Tests that rescue pages and scroll pages load in constant queries"""
+
+        instrumentation.reset()
+        self.client.get('/rescue/1')
+        self.client.get('/handle-loading?rescueid=1')
+        stats = instrumentation.snapshot()
+        # version stamp, rescue and one page of animals
+        self.assertEqual(stats['/rescue/<int:rescue_id>']['db_queries'], 3)
+        self.assertEqual(stats['/handle-loading']['db_queries'], 1)
+
+    def test_homepage_cache(self):
+        """Tests the homepage is served from cache until a write invalidates it"""
+
+        self.client.get('/')
+        # a change that leaves the homepage's version stamp as it was
+        db.session.execute("UPDATE rescues SET name = 'Renamed Rescue' WHERE rescue_id = 1")
+        db.session.commit()
+        self.assertNotIn('Renamed Rescue', self.client.get('/').data)
+
+        c.update_admin_row(c.get_admin_by_id(6), c.get_rescue(1))
+        self.assertIn('Renamed Rescue', self.client.get('/').data)
+
+    def test_page_cache_version(self):
+        """Tests a cached page isn't served for a newer version of its data"""
+
+        self.client.get('/rescue/1')
+        # written without dropping the cached page, like a write another
+        # worker made while this one cached a page from a lagging replica
+        now = datetime.datetime.utcnow()
+        rescue = c.get_rescue(1)
+        rescue.name = 'Renamed Rescue'
+        rescue.updated_at = now
+        animal = m.Animal.query.get(1)
+        animal.img_url = 'static/images/new-photo.png'
+        animal.img_variants = None
+        animal.updated_at = now
+        db.session.commit()
+
+        html = self.client.get('/rescue/1').data
+        # the cached header and tile fragments of the old rows aren't reused
+        self.assertIn('<h2> Renamed Rescue </h2>', html)
+        self.assertIn('new-photo.png', html)
+
+    def test_conditional_get(self):
+        """Tests repeat visits with a current ETag get a 304 without a body"""
+
+        result = self.client.get('/rescue/1')
+        etag = result.headers['ETag']
+        self.assertIn('Last-Modified', result.headers)
+
+        result = self.client.get('/rescue/1', headers={'If-None-Match': etag})
+        self.assertEqual(result.status_code, 304)
+        self.assertEqual(result.data, '')
+
+        result = self.client.get('/rescue/1', headers={'If-None-Match': '"stale"'})
+        self.assertEqual(result.status_code, 200)
+
     def test_login_page(self):
         result = self.client.get('/admin-login')
         self.assertEqual(result.status_code, 200)
@@ -83,6 +189,10 @@ class LoggedUserTests(unittest.TestCase):
 
         s.load_all()
 
+        # pages and admins cached from an earlier test's database
+        cache.clear()
+        c.forget_admins()
+
     def tearDown(self):
         """Do at end of every test."""
 
@@ -108,6 +218,46 @@ class LoggedUserTests(unittest.TestCase):
         self.assertEqual(result.status_code, 200)
         self.assertIn('<b>Please provide information for each animal: </b>', result.data)
 
+    def test_admin_pages_cached_admin(self):
+        """Tests the dashboard finds the logged in admin without a query"""
+
+        self.client.post('/handle-admin-login', data={'email': 'test1@gmail.com',
+                                                      'password': '1234'})
+        with self.client.session_transaction() as sess:
+            self.assertEqual(sess['admin_id'], 1)
+            self.assertEqual(sess['rescue_id'], 1)
+
+        instrumentation.reset()
+        result = self.client.get('/admin/1')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(instrumentation.snapshot()['/admin/<int:admin_id>']['db_queries'], 0)
+
+        # another admin's dashboard
+        self.assertEqual(self.client.get('/admin/2').status_code, 302)
+
+    def test_admin_record_shared_version(self):
+        """Tests a process' copy of an admin without a rescue neither hides
+        the rescue kept in the session nor outlives a newer version"""
+
+        admin = c.get_admin_by_session('test5@gmail.com')
+        db.session.execute('UPDATE admins SET rescue_id = NULL WHERE admin_id = :admin_id',
+                           {'admin_id': admin.admin_id})
+        db.session.commit()
+        self.assertIsNone(c.get_admin_record(admin.admin_id).rescue_id)
+
+        # another process adds the rescue
+        db.session.execute('UPDATE admins SET rescue_id = 1 WHERE admin_id = :admin_id',
+                           {'admin_id': admin.admin_id})
+        db.session.commit()
+
+        session = {'current_admin': admin.email, 'admin_id': admin.admin_id,
+                   'rescue_id': 1}
+        self.assertEqual(c.get_logged_in_admin(session).rescue_id, 1)
+        self.assertEqual(session['rescue_id'], 1)
+
+        cache.backend.set(c.admin_version_key(admin.admin_id), 'new', 60)
+        self.assertEqual(c.get_admin_record(admin.admin_id).rescue_id, 1)
+
     def test_add_rescue_page(self):
         """Tests the admin page that allows a new admin user to add a rescue
         to my page."""
@@ -124,6 +274,49 @@ class LoggedUserTests(unittest.TestCase):
         self.assertEqual(result.status_code, 200)
         self.assertIn("<b>Please provide your rescue's information: </b>", result.data)
 
+    def test_upload_type_checked(self):
+        """Tests an upload whose bytes don't match its extension is refused
+        and leaves nothing in the upload folder."""
+
+        folder = tempfile.mkdtemp()
+        upload_folder = app.config['UPLOAD_FOLDER']
+        app.config['UPLOAD_FOLDER'] = folder
+        with self.client.session_transaction() as sess:
+            sess['current_admin'] = 'test1@gmail.com'
+
+        try:
+            result = self.client.post('/handle-add-animal', data={
+                'name': 'rex', 'file': (StringIO('<html></html>'), 'rex.png')})
+            self.assertEqual(result.status_code, 415)
+            self.assertEqual(os.listdir(folder), [])
+        finally:
+            app.config['UPLOAD_FOLDER'] = upload_folder
+            shutil.rmtree(folder)
+
+    def test_add_animal_without_file(self):
+        """Tests a form whose file input was left blank asks for a file"""
+
+        with self.client.session_transaction() as sess:
+            sess['current_admin'] = 'test1@gmail.com'
+
+        result = self.client.post('/handle-add-animal', data={
+            'name': 'rex', 'file': (StringIO(''), '')})
+        self.assertEqual(result.status_code, 302)
+        with self.client.session_transaction() as sess:
+            self.assertIn('No selected file', sess['_flashes'][0])
+
+    def test_bulk_intake_without_photos(self):
+        """Tests a CSV import with the optional photos input left blank"""
+
+        with self.client.session_transaction() as sess:
+            sess['current_admin'] = 'test1@gmail.com'
+
+        result = self.client.post('/handle-bulk-intake', data={
+            'file': (StringIO('name,gender\nrex,Male\n'), 'animals.csv'),
+            'photos': (StringIO(''), '')})
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(json.loads(result.data)['inserted'], 1)
+
     def test_add_rescue_page_not_logged_in(self):
         """Tests the admin page redirects a non logged in user."""
 
@@ -167,6 +360,10 @@ class TestsDatabase(unittest.TestCase):
 
         s.load_all()
 
+        # pages and admins cached from an earlier test's database
+        cache.clear()
+        c.forget_admins()
+
     def tearDown(self):
         """Do at end of every test."""
 
@@ -195,6 +392,165 @@ class TestsDatabase(unittest.TestCase):
         available_animals = c.get_available_animals(1)
         assert len(available_animals) == 1
 
+    def test_available_animals_page(self):
+        """Tests that the last page of available animals has no next cursor
+        and that a cursor past it returns nothing"""
+
+        animals, next_cursor = c.get_available_animals_page(1)
+        assert next_cursor is None
+
+        cursor = pagination.encode_cursor(animals[-1].animal_id)
+        animals, next_cursor = c.get_available_animals_page(1, cursor)
+        assert animals == []
+        assert next_cursor is None
+
+    def test_handle_loading(self):
+        """Tests the infinite scroll route returns json and rejects bad cursors"""
+
+        result = self.client.get('/handle-loading?rescueid=1')
+        self.assertEqual(result.status_code, 200)
+        self.assertIn('next_cursor', result.data)
+
+        result = self.client.get('/handle-loading?rescueid=1&cursor=!!')
+        self.assertEqual(result.status_code, 400)
+
+    def test_animal_labels(self):
+        """Tests that animal details get their labels from the lookup cache"""
+
+        animal = c.get_animal(1)
+        assert animal.gender_type == lookups.get_label('gender', animal.gender_id)
+        assert lookups.get_id('gender', animal.gender_type) == animal.gender_id
+
+    def test_lookup_invalidation(self):
+        """Tests that adding a row to a reference table reloads the cache"""
+
+        assert lookups.get_id('gender', 'Other') is None
+        db.session.add(m.Gender(gender_type='Rolled back'))
+        db.session.flush()
+        # a load inside the transaction sees the row
+        lookups.load()
+        db.session.rollback()
+        assert lookups.get_id('gender', 'Rolled back') is None
+
+        db.session.add(m.Gender(gender_type='Other'))
+        db.session.commit()
+        assert lookups.get_id('gender', 'Other') is not None
+
+    def test_lookup_shared_version(self):
+        """Tests a change committed by another worker reloads the cache"""
+
+        lookups.load()
+        db.session.execute("INSERT INTO genders (gender_type) VALUES ('Other')")
+        db.session.commit()
+        assert lookups.get_id('gender', 'Other') is None
+
+        # what the other worker's commit stores
+        cache.backend.set(lookups.VERSION_KEY, 'changed')
+        lookups._checked_at = 0
+        assert lookups.get_id('gender', 'Other') is not None
+
+    def test_full_profile(self):
+        """Tests that the full loading profile joins the lookup relationships"""
+
+        animals = c.get_available_animals(1, profile='full')
+        assert 'gender' in animals[0].__dict__
+        assert 'rescue' in animals[0].__dict__
+
+    def test_search(self):
+        """Tests searching animals by words, filters and facets"""
+
+        animals, next_cursor = search.search_animals('archie')
+        assert [animal.animal_id for animal in animals] == [1]
+
+        female = search.search_animals(filters={'gender': ['Female']}, limit=1000)[0]
+        facets = search.facet_counts(filters={'gender': ['Female']})
+        assert sum(facet['count'] for facet in facets['species']) == len(female)
+        # a kind's own filter doesn't narrow its facet
+        assert len(facets['gender']) > 1
+        assert search.search_animals(filters={'gender': ['Nope']})[0] == []
+
+        result = self.client.get('/search?q=archie&species=Dog&species=Cat')
+        self.assertEqual(result.status_code, 200)
+        self.assertIn('"facets"', result.data)
+
+    def test_nearby_rescues(self):
+        """Tests finding rescues by distance from a place"""
+
+        latitude, longitude = geo.geocode('Gainesville, FL')
+        rescues = geo.nearby_rescues(latitude, longitude, 25)
+        assert [rescue.rescue_id for rescue, miles in rescues] == [2, 3]
+        # Miami is about 270 miles away
+        rescues = geo.nearby_rescues(latitude, longitude, 300)
+        assert [rescue.rescue_id for rescue, miles in rescues][-1] == 1
+
+        animals = c.get_first_available_animals([1, 2], 1)
+        assert len(animals[1]) == 1
+
+        result = self.client.get('/?near=Oakland, CA')
+        self.assertIn('Oakland Rescue', result.data)
+        self.assertIn('San Fransico SPCA', result.data)
+        self.assertNotIn('Happy Wag', result.data)
+
+    def test_api(self):
+        """Tests the JSON API's streamed pages and compression"""
+
+        result = self.client.get('/api/v1/rescues?limit=2')
+        page = json.loads(result.data)
+        assert [rescue['rescue_id'] for rescue in page['data']] == [1, 2]
+        result = self.client.get('/api/v1/rescues?cursor=' + page['next_cursor'])
+        page = json.loads(result.data)
+        assert [rescue['rescue_id'] for rescue in page['data']] == [3, 4, 5]
+        assert page['next_cursor'] is None
+
+        result = self.client.get('/api/v1/rescues/2/animals',
+                                 headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(result.headers['Content-Encoding'], 'gzip')
+        page = json.loads(gzip.GzipFile(fileobj=StringIO(result.data)).read())
+        assert page['data'][0]['rescue_id'] == 2
+
+        self.assertIn('"bio"', self.client.get('/api/v1/animals/1').data)
+        result = self.client.get('/api/v1/animals/100000')
+        self.assertEqual(result.status_code, 404)
+        self.assertIn('"error"', result.data)
+        self.assertEqual(self.client.get('/api/v1/rescues?cursor=!!').status_code, 400)
+
+    def test_replica_routing(self):
+        """Tests that read only code reads from a replica until a write"""
+
+        replicas.configure([app.config['SQLALCHEMY_DATABASE_URI']])
+        replica = replicas.pick()
+        select = sqlalchemy.select([m.Rescue.rescue_id])
+        try:
+            assert db.session.get_bind(clause=select) is not replica
+            with replicas.reading():
+                assert db.session.get_bind(clause=select) is replica
+                assert c.get_rescue(2).rescue_id == 2
+                with replicas.on_primary():
+                    assert db.session.get_bind(clause=select) is not replica
+
+            with app.test_request_context('/'):
+                db.session.add(m.Gender(gender_type='Other'))
+                db.session.commit()
+                # the replica may not have the new row yet
+                with replicas.reading():
+                    assert db.session.get_bind(clause=select) is not replica
+        finally:
+            replicas.configure([])
+
+    def test_warmup(self):
+        """Tests the app factory's config and the warmup before forking"""
+
+        import server
+        warm_app = server.create_app({'TESTING': True})
+        assert warm_app.config['UPLOAD_FOLDER'] == 'static/images/'
+        assert 'png' in warm_app.config['ALLOWED_EXTENSIONS']
+
+        lookups.invalidate()
+        server.warmup(app)
+        assert lookups.get_label('gender', 1) is not None
+        # every template compiled
+        assert len(app.jinja_env.cache) == len(app.jinja_env.list_templates())
+
     def test_fetch_admin(self):
         """Tests retrieving the correct admin according to its id"""
 
@@ -214,17 +570,463 @@ class TestsDatabase(unittest.TestCase):
         is_admin = c.get_admin('test8@gmail.com', '8888')
         assert is_admin is False
 
+    def test_upgrade_db(self):
+        """Tests that upgrading an up to date database is a no-op"""
+
+        upgrade_db()
+        assert c.get_rescue(2).name == 'Alachua County Animal Services'
+
     def test_last_admin(self):
         """Tests that the last admin added to the db is retrieved"""
 
         last_admin_added = c.get_last_admin_added()
         assert last_admin_added.admin_id == 6
 
+    def test_add_rescue_failed_upload(self):
+        """Tests that a failed file save leaves no half-written rescue behind"""
+
+        class BrokenUpload(object):
+            filename = 'logo.png'
+
+            def save(self, path):
+                raise IOError('disk full')
+
+        class FakeRequest(object):
+            form = {'rescuename': 'new rescue', 'phone': '', 'address': '',
+                    'email': ''}
+            files = {'file': BrokenUpload()}
+
+        self.assertRaises(IOError, c.add_rescue, FakeRequest(), {}, '/tmp')
+        assert c.get_last_rescue_added().rescue_id == 5
+
+    def test_bulk_import(self):
+        """Tests that a bulk import inserts the valid rows and reports the rest"""
+
+        rows = [{'name': 'rex', 'gender': 'Male', 'breed': 'Akita'},
+                {'name': ''},
+                {'name': 'bob', 'size': 'Huge'}]
+        report = intake.import_animals(rows, 1, '/tmp')
+
+        assert report['inserted'] == 1
+        assert [error['row'] for error in report['errors']] == [2, 3]
+        assert len(c.get_available_animals(1)) == 2
+
+    def test_bulk_import_bad_json_line(self):
+        """Tests a line that isn't JSON is reported and the import goes on"""
+
+        rows = intake.read_json(StringIO('{"name": "rex"}\n{"name": \n{"name": "bob"}\n'))
+        report = intake.import_animals(rows, 1, '/tmp', batch_size=1)
+
+        assert report['inserted'] == 2
+        assert [error['row'] for error in report['errors']] == [2]
+        assert 'line 2' in report['errors'][0]['error']
+
+    def test_bulk_import_broken_file(self):
+        """Tests the rescue's page is refreshed when reading fails half way"""
+
+        def rows():
+            yield {'name': 'rex'}
+            raise ValueError('broken file')
+
+        before = c.get_rescue(1).updated_at
+        self.assertRaises(ValueError, intake.import_animals, rows(), 1, '/tmp', batch_size=1)
+        db.session.expire_all()
+        assert c.get_rescue(1).updated_at != before
+
+    def test_bulk_import_row_errors(self):
+        """Tests rows that aren't objects or have non-ASCII labels are reported"""
+
+        rows = intake.read_json(StringIO('[["rex"], {"name": "bob", "size": "Gro\\u00df"}]'))
+        report = intake.import_animals(rows, 1, '/tmp')
+
+        assert report['inserted'] == 0
+        assert report['errors'][0] == {'row': 1, 'error': 'row is not an object'}
+        assert u'Gro\xdf' in report['errors'][1]['error']
+
+    def test_job_retry(self):
+        """Tests that a failing job is retried with backoff, then marked failed"""
+
+        calls = []
+
+        @jobs.handler('test_fails')
+        def fails(animal_id):
+            calls.append(animal_id)
+            raise ValueError('nope')
+
+        job = jobs.enqueue('test_fails', max_attempts=2, animal_id=1)
+        db.session.commit()
+
+        assert jobs.work(burst=True) == 1
+        assert jobs.status_counts() == {'queued': 1}
+        # the retry isn't due yet
+        assert jobs.work(burst=True) == 0
+
+        job = m.Job.query.get(job.job_id)
+        job.run_after = job.created_at
+        db.session.commit()
+        assert jobs.work(burst=True) == 1
+
+        job = m.Job.query.get(job.job_id)
+        assert calls == [1, 1]
+        assert job.status == 'failed'
+        assert 'nope' in job.last_error
+
+    @unittest.skipIf(images.Image is None, 'Pillow is not installed')
+    def test_image_variants_job(self):
+        """Tests that the variants of an upload are made by the queued job"""
+
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, '1-1.png')
+        images.Image.new('RGB', (800, 600)).save(path)
+        animal = c.get_available_animals(1)[0]
+        animal.img_url = path
+        jobs.enqueue('image_variants', path=path)
+        db.session.commit()
+
+        try:
+            assert jobs.work(burst=True) == 1
+            assert jobs.status_counts() == {'done': 1}
+            variants = images.load_variants(c.get_animal(1).img_variants)
+            assert variants['full']['width'] == 800
+        finally:
+            shutil.rmtree(folder)
+
+    def test_image_store(self):
+        """Tests the same bytes are stored once and collected once unused"""
+
+        folder = tempfile.mkdtemp()
+        local_storage = storage.backend
+        storage.backend = storage.LocalStorage(folder)
+        try:
+            first = imagestore.store_stream(StringIO('GIF89a one'), folder, 'gif')
+            db.session.commit()
+            second = imagestore.store_stream(StringIO('GIF89a one'), folder, 'gif')
+            assert first.path == second.path
+            assert len(os.listdir(os.path.dirname(first.path))) == 1
+
+            animal = m.Animal.query.get(1)
+            animal.img_url = first.path
+            db.session.commit()
+            assert imagestore.collect_garbage(datetime.timedelta(0)) == 0
+
+            animal.img_url = None
+            db.session.commit()
+            assert imagestore.collect_garbage(datetime.timedelta(0)) == 1
+            assert not os.path.exists(first.path)
+        finally:
+            storage.backend = local_storage
+            shutil.rmtree(folder)
+
+    def test_image_store_failed_commit(self):
+        """Tests a failed upload keeps a file another upload committed"""
+
+        folder = tempfile.mkdtemp()
+        local_storage = storage.backend
+        storage.backend = storage.LocalStorage(folder)
+        try:
+            blob = imagestore.store_stream(StringIO('GIF89a two'), folder, 'gif')
+            db.session.rollback()
+            # the same bytes, committed by another upload meanwhile
+            db.session.add(m.ImageBlob(sha256=blob.sha256, path=blob.path, size=blob.size))
+            db.session.commit()
+            imagestore.discard(blob)
+            assert os.path.exists(blob.path)
+
+            # its file lost, the blob gets it back when uploaded again
+            os.remove(blob.path)
+            imagestore.store_stream(StringIO('GIF89a two'), folder, 'gif')
+            db.session.commit()
+            assert os.path.exists(blob.path)
+
+            lost = imagestore.store_stream(StringIO('GIF89a three'), folder, 'gif')
+            db.session.rollback()
+            imagestore.discard(lost)
+            assert not os.path.exists(lost.path)
+        finally:
+            storage.backend = local_storage
+            shutil.rmtree(folder)
+
+    def test_fast_seed(self):
+        """Tests that the COPY/executemany seed loads the same data as the ORM"""
+
+        db.session.close()
+        db.drop_all()
+        db.create_all()
+        s.fast_load_all()
+
+        assert c.get_last_rescue_added().rescue_id == 5
+        assert c.get_animal(1).name == 'Archie'
+        assert len(c.get_available_animals(1)) == 1
+
     def test_last_rescue(self):
         """Tests that the last rescue added to the db is retrieved"""
 
         last_rescue_added = c.get_last_rescue_added()
         assert last_rescue_added.rescue_id == 5
 
+
+class PaginationTests(unittest.TestCase):
+    """Tests the keyset pagination cursors"""
+
+    def test_cursor_round_trip(self):
+        cursor = pagination.encode_cursor(12345)
+        assert pagination.decode_cursor(cursor) == 12345
+
+    def test_no_cursor(self):
+        assert pagination.decode_cursor(None) is None
+        assert pagination.decode_cursor('') is None
+
+    def test_invalid_cursor(self):
+        self.assertRaises(pagination.InvalidCursor,
+                          pagination.decode_cursor, 'not a cursor')
+
+
+class SeedTests(unittest.TestCase):
+    """Tests the COPY stream used by the fast seed"""
+
+    def test_copy_stream(self):
+        stream = s._CopyStream(iter([[1, 'a\tb', None, True]]))
+        assert stream.read() == '1\ta\\tb\t\\N\tt\n'
+        assert stream.read() == ''
+        assert stream.count == 1
+
+
+class GenerateSeedTests(unittest.TestCase):
+    """Tests the large seed file generator"""
+
+    def test_deterministic(self):
+        first, second = tempfile.mkdtemp(), tempfile.mkdtemp()
+        try:
+            for out_dir in (first, second):
+                generate_seed.generate(out_dir, rescues=20, animals=500,
+                                       extra_breeds=5, seed=7)
+            for seed_file in os.listdir(first):
+                assert filecmp.cmp(os.path.join(first, seed_file),
+                                   os.path.join(second, seed_file), shallow=False)
+            assert generate_seed.count_rows(os.path.join(first, 'u.animal')) == 500
+        finally:
+            shutil.rmtree(first)
+            shutil.rmtree(second)
+
+
+class CacheTests(unittest.TestCase):
+    """Tests the in-memory page cache"""
+
+    def test_lru_eviction(self):
+        pages = cache.MemoryCache(max_entries=2)
+        pages.set('a', '1')
+        pages.set('b', '2')
+        pages.get('a')
+        pages.set('c', '3')
+        assert pages.get('a') == '1'
+        assert pages.get('b') is None
+        assert pages.get('c') == '3'
+
+    def test_expiry(self):
+        pages = cache.MemoryCache()
+        pages.set('a', '1', ttl=-1)
+        assert pages.get('a') is None
+
+    def test_bytecode_cache_directory(self):
+        """Tests a bytecode cache directory others can write to is refused"""
+
+        import server
+        directory = tempfile.mkdtemp()
+        try:
+            server.create_app({'JINJA_BYTECODE_CACHE': directory})
+            os.chmod(directory, 0o777)
+            self.assertRaises(RuntimeError, server.create_app,
+                              {'JINJA_BYTECODE_CACHE': directory})
+        finally:
+            shutil.rmtree(directory)
+
+    def test_fragment_cache(self):
+        """Tests a {% cache %} block renders once until its key is dropped"""
+
+        source = "{% cache 'fragment:test', 60 %}<b>{{ name }}</b>{% endcache %}"
+        cache.delete('fragment:test')
+        with app.test_request_context():
+            render = app.jinja_env.from_string(source).render
+            assert render(name='Rex & Co') == '<b>Rex &amp; Co</b>'
+            assert render(name='Fido') == '<b>Rex &amp; Co</b>'
+            cache.delete('fragment:test')
+            assert render(name='Fido') == '<b>Fido</b>'
+        cache.delete('fragment:test')
+
+
+@unittest.skipIf(images.Image is None, 'Pillow is not installed')
+class ImagesTests(unittest.TestCase):
+    """Tests the resized variants of uploads"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_make_variants(self):
+        path = os.path.join(self.folder, '1-1.png')
+        images.Image.new('RGBA', (2000, 1000), (200, 100, 50, 128)).save(path)
+
+        variants = images.make_variants(path)
+        assert variants['thumb']['width'] == 200
+        assert variants['full']['width'] == 1600
+        assert images.Image.open(variants['thumb']['webp']).format == 'WEBP'
+        assert images.Image.open(variants['medium']['jpeg']).size == (600, 300)
+        assert '1-1-thumb.jpg 200w' in images.srcset(variants, 'jpeg')
+
+        images.remove_variants(variants)
+        assert os.listdir(self.folder) == ['1-1.png']
+
+    def test_small_image_not_enlarged(self):
+        path = os.path.join(self.folder, '1-2.jpg')
+        images.Image.new('RGB', (100, 80)).save(path)
+
+        variants = images.make_variants(path)
+        assert variants['full']['width'] == 100
+
+
+class UploadsTests(unittest.TestCase):
+    """Tests the streamed upload checks"""
+
+    def test_sniff(self):
+        assert uploads.sniff('png', '\x89PNG\r\n\x1a\n\x00')
+        assert not uploads.sniff('jpg', '\x89PNG\r\n\x1a\n')
+        assert uploads.sniff('csv', 'name,bre')
+        assert not uploads.sniff('csv', 'PK\x03\x04\x00\x00')
+
+    def test_size_limit(self):
+        folder = tempfile.mkdtemp()
+        upload_file = uploads.UploadFile(folder, 'png', max_size=10)
+        try:
+            upload_file.write('\x89PNG\r\n\x1a\n')
+            self.assertRaises(uploads.RequestEntityTooLarge,
+                              upload_file.write, 'more bytes')
+        finally:
+            upload_file.discard()
+            shutil.rmtree(folder)
+
+
+class StorageTests(unittest.TestCase):
+    """Tests the image storage backends"""
+
+    def test_incoming_key(self):
+        assert storage.is_incoming_key('static/images/incoming/%s.jpg' % ('a' * 32))
+        assert not storage.is_incoming_key('static/images/incoming/../../server.py')
+        assert not storage.is_incoming_key('static/images/ab/%s.jpg' % ('a' * 32))
+
+    def test_stored_file_mode(self):
+        """Tests stored images can be read by a web server running as another user"""
+
+        folder = tempfile.mkdtemp()
+        try:
+            local = storage.LocalStorage(folder)
+            handle, temp_path = tempfile.mkstemp(dir=folder, prefix='.upload-')
+            os.close(handle)
+            local.put(temp_path, local.key('ab/image.png'))
+            mode = os.stat(local.key('ab/image.png')).st_mode & 0o777
+            # 0644 under the usual umask of 022, not the temporary file's 0600
+            self.assertEqual(mode, storage.FILE_MODE)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_s3_presigned_upload(self):
+        class Client(object):
+            def generate_presigned_post(self, bucket, key, Fields, Conditions,
+                                        ExpiresIn):
+                self.conditions = Conditions
+                return {'url': 'http://minio:9000/pets', 'fields': Fields}
+
+        client = Client()
+        s3 = storage.S3Storage('pets', endpoint_url='http://minio:9000',
+                               client=client)
+        upload = s3.presigned_upload('png', 1000)
+        assert upload['key'].startswith('images/incoming/')
+        assert upload['fields']['Content-Type'] == 'image/png'
+        assert ['content-length-range', 1, 1000] in client.conditions
+        assert s3.url('images/ab/cd.png') == 'http://minio:9000/pets/images/ab/cd.png'
+
+
+class ImageServingTests(unittest.TestCase):
+    """Tests the image route"""
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.folder = tempfile.mkdtemp()
+        self.backend = storage.backend
+        storage.backend = storage.LocalStorage(self.folder)
+        self.name = 'ab/%s.png' % ('a' * 64)
+        os.mkdir(os.path.join(self.folder, 'ab'))
+        with open(os.path.join(self.folder, self.name), 'wb') as target:
+            target.write('0123456789')
+
+    def tearDown(self):
+        storage.backend = self.backend
+        shutil.rmtree(self.folder)
+        app.config.pop('IMAGE_SERVING', None)
+
+    def test_image(self):
+        assert storage.url(storage.backend.key(self.name)) == '/images/' + self.name
+        result = self.client.get('/images/' + self.name)
+        assert result.data == '0123456789'
+        assert result.headers['Cache-Control'] == storage.IMMUTABLE_CACHE_CONTROL
+
+        result = self.client.get('/images/' + self.name,
+                                 headers={'If-None-Match': result.headers['ETag']})
+        assert result.status_code == 304
+        assert self.client.get('/images/../tests.py').status_code == 404
+
+    def test_range(self):
+        result = self.client.get('/images/' + self.name,
+                                 headers={'Range': 'bytes=2-4'})
+        assert result.status_code == 206
+        assert result.data == '234'
+        assert result.headers['Content-Range'] == 'bytes 2-4/10'
+
+        result = self.client.get('/images/' + self.name,
+                                 headers={'Range': 'bytes=20-'})
+        assert result.status_code == 416
+
+        result = self.client.get('/images/' + self.name,
+                                 headers={'Range': 'bytes=2-4', 'If-Range': '"old"'})
+        assert result.status_code == 200
+
+    def test_x_accel(self):
+        app.config['IMAGE_SERVING'] = 'x-accel'
+        result = self.client.get('/images/' + self.name)
+        assert result.headers['X-Accel-Redirect'] == '/_images/' + self.name
+        assert result.data == ''
+        assert 'location /_images/' in imageserving.nginx_config(app)
+
+
+class GeoTests(unittest.TestCase):
+    """Tests geocoding and geohash cells"""
+
+    def test_geocode(self):
+        assert geo.geocode('631 South Beach Dr. Miami, FL 07860') == (25.7617, -80.1918)
+        assert geo.geocode('825 Campfire St. San Francisco, CA 28451') == (37.7749, -122.4194)
+        assert geo.geocode('29.65, -82.32') == (29.65, -82.32)
+        assert geo.geocode('Nowhere, ZZ') is None
+
+    def test_geohash(self):
+        assert geo.encode_geohash(57.64911, 10.40744) == 'u4pruydqq'
+
+    def test_covering_cells(self):
+        cells = geo.covering_cells(29.6516, -82.3248, 25)
+        for latitude, longitude in [(29.6516, -82.3248), (29.99, -82.3248),
+                                    (29.6516, -82.75), (29.35, -81.95)]:
+            geohash = geo.encode_geohash(latitude, longitude)
+            assert any(geohash.startswith(cell) for cell in cells)
+
+
+class BenchmarkTests(unittest.TestCase):
+    """Tests the benchmark's latency percentiles"""
+
+    def test_percentile(self):
+        latencies = range(1, 101)
+        assert benchmark.percentile(latencies, 0.5) == 51
+        assert benchmark.percentile(latencies, 0.99) == 99
+        assert benchmark.percentile([], 0.99) is None
+
 if __name__ == "__main__":
     unittest.main()
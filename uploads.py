@@ -0,0 +1,185 @@
+"""Streaming file uploads.
+
+Werkzeug used to keep uploads under 500KB in memory and anything bigger in
+an anonymous temporary file, and the views only looked at the extension once
+the whole body had been received. UploadRequest streams every uploaded file
+in the parser's fixed-size chunks straight to a hidden temporary file inside
+UPLOAD_FOLDER and checks it while it arrives:
+
+    - the first bytes must match the file type the extension claims
+      (PNG/JPEG/GIF/zip signatures, CSV and JSON must not be binary),
+      otherwise the request fails with 415 before the rest is read
+    - an image bigger than MAX_IMAGE_SIZE fails with 413 as soon as it
+      crosses the limit, and MAX_CONTENT_LENGTH caps the whole request
+
+save() then renames the temporary file into place, so a file appears in
+UPLOAD_FOLDER complete or not at all. Temporary files that weren't saved
+are removed when the request ends.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+from flask import Request, current_app
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+
+
+# Defaults for the app's config
+MAX_IMAGE_SIZE = 20 * 1024 * 1024
+MAX_CONTENT_LENGTH = 200 * 1024 * 1024
+
+CHUNK_SIZE = 64 * 1024
+
+# extension -> signatures its first bytes must start with
+SIGNATURES = {
+    'png': ['\x89PNG\r\n\x1a\n'],
+    'jpg': ['\xff\xd8\xff'],
+    'jpeg': ['\xff\xd8\xff'],
+    'gif': ['GIF87a', 'GIF89a'],
+    'zip': ['PK\x03\x04', 'PK\x05\x06'],
+}
+
+IMAGE_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
+
+# accepted without a signature as long as they don't look binary
+TEXT_EXTENSIONS = set(['csv', 'json', 'jsonl'])
+
+# bytes needed to check any of the signatures
+SNIFF_SIZE = 8
+
+
+def _extension(filename):
+    return filename.rsplit('.', 1)[1].lower() if filename and '.' in filename else ''
+
+
+def sniff(extension, head):
+    """ Whether the first bytes of a file fit its extension """
+
+    if extension in SIGNATURES:
+        return any(head.startswith(signature) for signature in SIGNATURES[extension])
+
+    return extension in TEXT_EXTENSIONS and '\0' not in head
+
+
+class UploadFile(object):
+    """ Temporary file an upload is streamed into. Checks the type once the
+    first bytes are in and the size on every chunk.
+    """
+
+    def __init__(self, folder, extension, max_size=None):
+        self.extension = extension
+        self.max_size = max_size
+        self.size = 0
+        self.head = ''
+        self.checked = False
+        # content hash, kept up to date as chunks arrive
+        self.sha256 = hashlib.sha256()
+        self.file = tempfile.NamedTemporaryFile(dir=folder, prefix='.upload-',
+                                                delete=False)
+        self.name = self.file.name
+
+    def _check(self):
+        self.checked = True
+        if not sniff(self.extension, self.head):
+            raise UnsupportedMediaType('The file is not a valid .%s file' %
+                                       self.extension)
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise RequestEntityTooLarge()
+        if not self.checked:
+            self.head += data[:SNIFF_SIZE]
+            if len(self.head) >= SNIFF_SIZE:
+                self._check()
+        self.sha256.update(data)
+        self.file.write(data)
+
+    def seek(self, *args):
+        # the parser rewinds the file once it is complete, short files are
+        # checked then
+        if not self.checked:
+            self._check()
+        self.file.seek(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def discard(self):
+        """ Remove the temporary file unless it was saved """
+
+        self.file.close()
+        if os.path.exists(self.name):
+            os.remove(self.name)
+
+
+class UploadRequest(Request):
+    """ Flask request that streams uploads into UploadFiles """
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        if not filename:
+            # a file input left blank, the views tell the visitor
+            return Request._get_file_stream(self, total_content_length, content_type,
+                                            filename, content_length)
+
+        extension = _extension(filename)
+        if extension not in SIGNATURES and extension not in TEXT_EXTENSIONS:
+            raise UnsupportedMediaType('.%s files are not accepted' % extension)
+
+        config = current_app.config
+        upload_file = UploadFile(
+            config.get('UPLOAD_FOLDER') or tempfile.gettempdir(), extension,
+            config.get('MAX_IMAGE_SIZE') if extension in IMAGE_EXTENSIONS else None)
+        self.__dict__.setdefault('upload_files', []).append(upload_file)
+
+        return upload_file
+
+    def close(self):
+        Request.close(self)
+        for upload_file in self.__dict__.get('upload_files', []):
+            upload_file.discard()
+
+
+def save(uploaded_file, path):
+    """ Move an upload to its final path in one atomic rename
+    Inputs: uploaded file(FileStorage), path(string)
+    Output: No output, the file is at path or an exception was raised
+    """
+
+    stream = getattr(uploaded_file, 'stream', None)
+    folder = os.path.dirname(os.path.abspath(path))
+    if isinstance(stream, UploadFile) and \
+            os.path.dirname(os.path.abspath(stream.name)) == folder:
+        stream.flush()
+        os.rename(stream.name, path)
+        return
+
+    # streamed somewhere else (or not by UploadRequest): copy next to the
+    # target first, so the rename is still atomic
+    handle, temp_path = tempfile.mkstemp(dir=folder, prefix='.upload-')
+    os.close(handle)
+    try:
+        if isinstance(stream, UploadFile):
+            stream.seek(0)
+            with open(temp_path, 'wb') as target:
+                shutil.copyfileobj(stream, target, CHUNK_SIZE)
+        else:
+            uploaded_file.save(temp_path)
+        os.rename(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def init_app(app):
+    """ Use UploadRequest for the app and set the default limits """
+
+    app.request_class = UploadRequest
+    app.config.setdefault('MAX_CONTENT_LENGTH', MAX_CONTENT_LENGTH)
+    app.config.setdefault('MAX_IMAGE_SIZE', MAX_IMAGE_SIZE)
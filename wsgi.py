@@ -0,0 +1,29 @@
+"""WSGI entry point for production servers.
+
+    gunicorn -c gunicorn_config.py wsgi:app
+    uwsgi --master --lazy-apps=false --processes 4 --module wsgi:app
+
+Settings come from the file PROJECT_SETTINGS points at (see
+server.DEFAULT_CONFIG). The app is built, connected and warmed up (see
+server.warmup) once, in the master, before it forks: every worker starts
+with the lookup tables loaded and the templates compiled. Database
+connections can't survive a fork, so each worker drops the pools it
+inherited and opens its own.
+"""
+
+from model import connect_to_db, dispose_engines
+import server
+
+try:
+    from uwsgidecorators import postfork
+except ImportError:
+    postfork = None
+
+
+app = server.create_app()
+connect_to_db(app, app.config['SQLALCHEMY_DATABASE_URI'])
+server.warmup(app)
+
+
+if postfork is not None:
+    postfork(dispose_engines)